@@ -1,10 +1,20 @@
-from datetime import datetime, timedelta
-import pyActigraphy
 import os
 import re
+import sqlite3
+import numpy as np
 import pandas as pd
 from pandas.io.sql import DatabaseError
 
+from profiling import stage
+from wear_times import read_wear_times, wear_time_intervals_by_subject
+
+# version of the reading, masking and summary computation, increase it whenever one of them changes the results to
+# invalidate all cached summaries
+PIPELINE_VERSION = 3
+
+# estimated peak memory of processing a subject per byte of its agd file, measured with multi-week recordings for the
+# lean reader (True) and pyActigraphy's reader (False)
+MEMORY_PER_FILE_BYTE = {True: 4, False: 16}
 
 # Print iterations progress
 def printProgressBar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', printEnd="\r"):
@@ -36,140 +46,484 @@ def get_name_from_fname_pattern(fname_pattern, path):
         return None
 
 
-def read_agd_files(agds, fname_pattern=None):
-    from joblib import delayed, Parallel
+def list_agd_files(agds):
     import glob
+    return glob.glob(agds + "/*.agd") if type(agds) is str and os.path.isdir(agds) else agds
 
-    agd_files = glob.glob(agds + "/*.agd") if type(agds) is str and os.path.isdir(agds) else agds
 
-    def read_agd(fname, fname_pattern=None):
-        try:
+def read_agd(fname, fname_pattern=None, lean=False):
+    """
+    Reads an agd file with pyActigraphy's RawAGD or, if lean is set, with the LeanAGD reader that only loads the
+    activity counts and metadata. Subject data files of a converted agd store are always read with LeanAGD. Returns
+    None if the file is defective.
+    """
+    try:
+        if fname.endswith('.arrow'):
+            from agd_store import read_stored_agd
+            raw_agd = read_stored_agd(fname)
+        elif lean:
+            from agd_reader import LeanAGD
+            raw_agd = LeanAGD(fname)
+        else:
+            # imported here, pyActigraphy takes seconds to import and is not needed by the lean reader
+            import pyActigraphy
             raw_agd = pyActigraphy.io.agd.RawAGD(fname)
-        except DatabaseError:
-            print(f"Could not read in agd file {fname}. File is defective!")
-            return None
+    except (DatabaseError, sqlite3.DatabaseError):
+        print(f"Could not read in agd file {fname}. File is defective!")
+        return None
+
+    if fname_pattern:
+        name = get_name_from_fname_pattern(fname_pattern, fname)
+        raw_agd.display_name = name
+    return raw_agd
+
 
-        if fname_pattern:
-            name = get_name_from_fname_pattern(fname_pattern, fname)
-            raw_agd.display_name = name
-        return raw_agd
+def read_agd_files(agds, fname_pattern=None, n_jobs=4):
+    """
+    Reads all agd files into one pyActigraphy RawReader, which holds the data of all subjects at the same time. Use
+    iter_agd_files to go through a cohort with bounded memory.
+    """
+    import pyActigraphy
+    from joblib import delayed, Parallel
+
+    agd_files = list_agd_files(agds)
 
     def parallel_reader(n_jobs, file_list, prefer=None, verbose=0, **kwargs):
         return Parallel(n_jobs=n_jobs, prefer=prefer, verbose=verbose)(
             delayed(read_agd)(file, **kwargs) for file in file_list
         )
 
-    readers = parallel_reader(4, agd_files, fname_pattern=fname_pattern)
+    readers = parallel_reader(n_jobs, agd_files, fname_pattern=fname_pattern)
     readers = [reader for reader in readers if reader is not None]
     return pyActigraphy.io.RawReader("AGD", readers)
 
 
-def get_wear_time_mask(reader, wear_time_groups):
-    if wear_time_groups and reader.display_name in wear_time_groups.groups:
-        wear_times = wear_time_groups.get_group(reader.display_name)
-        mask = pd.Series(0, index=reader.data.index)
-        for index, wear_time in wear_times.iterrows():
-            mask.loc[(mask.index >= wear_time.start) & (mask.index <= wear_time.stop)] = 1
-
-        return mask
-    else:
-        return None
-
-
-def read_wear_times(wear_time_files, fname_pattern=None):
-    fields = ["Subject", "Wear Time Start", "Wear Time End"]
-
-    files = [wear_time_files] if type(wear_time_files) is str else wear_time_files
-
-    all_data = pd.DataFrame()
+def estimated_subject_memory(agd_file, lean_reader=True):
+    try:
+        size = os.path.getsize(agd_file)
+    except OSError:
+        return 0
+    return size * MEMORY_PER_FILE_BYTE[bool(lean_reader) or agd_file.endswith('.arrow')]
 
-    for file in files:
 
-        with open(file) as report:
-            data = pd.read_csv(report, delimiter=',', quotechar='"', decimal=",",
-                               date_parser=lambda dt: datetime.strptime(dt, "%d.%m.%Y %H:%M:%S"),
-                               parse_dates=["Wear Time Start", "Wear Time End"])
+def _within_memory(in_flight_memory, memory, max_memory):
+    # a single subject is always admitted, even if it exceeds the ceiling on its own
+    return max_memory is None or not in_flight_memory or sum(in_flight_memory) + memory <= max_memory
 
-            data = data[fields]
 
-            data.rename(columns={
-                "Subject": "subject",
-                "Wear Time Start": "start",
-                "Wear Time End": "stop",
-            }, inplace=True)
+def _take(pending):
+    # returns the next file and its reader without keeping a reference to the future holding the reader
+    agd_file, future, _ = pending.popleft()
+    return agd_file, future.result()
 
-            if fname_pattern:
-                data.subject = get_name_from_fname_pattern(fname_pattern, file)
 
-            all_data = pd.concat([all_data, data], ignore_index=True)
+def iter_agd_files(agds, fname_pattern=None, lean=False, prefetch=1, max_memory=None):
+    """
+    Yields (agd file, reader) for each agd file, the reader is None if the file is defective. While the caller
+    processes a reader, the next prefetch files are read by background threads, as long as the estimated memory of
+    the readers stays below max_memory (bytes). If the caller releases each reader before taking the next one, at most
+    prefetch + 1 readers are in memory at a time.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    remaining = deque(list_agd_files(agds))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as executor:
+        while remaining or pending:
+            while remaining and len(pending) <= prefetch and \
+                    _within_memory([memory for _, _, memory in pending],
+                                   estimated_subject_memory(remaining[0], lean), max_memory):
+                agd_file = remaining.popleft()
+                pending.append((agd_file, executor.submit(read_agd, agd_file, fname_pattern, lean),
+                                estimated_subject_memory(agd_file, lean)))
+            yield _take(pending)
+
+
+def interval_mask(index, starts, stops):
+    """
+    Boolean mask of all index values that lie within one of the intervals, start and stop included. The interval
+    boundaries are located by binary search on the sorted index and applied through a cumulative difference array.
+    """
+    diff = np.zeros(len(index) + 1, dtype=np.int32)
+    np.add.at(diff, np.searchsorted(index, starts, side='left'), 1)
+    np.add.at(diff, np.searchsorted(index, stops, side='right'), -1)
+    return np.cumsum(diff[:-1]) > 0
 
-    all_data['subject'] = all_data['subject'].astype(str)
-    all_data.sort_values(by=['subject'], inplace=True)
 
-    return all_data
+def get_wear_time_mask(reader, wear_time_intervals):
+    if wear_time_intervals and reader.display_name in wear_time_intervals:
+        starts, stops = wear_time_intervals[reader.display_name]
+        index = reader.data.index
+        return pd.Series(interval_mask(index.values, starts, stops).astype(np.uint8), index=index)
+    else:
+        return None
 
 
-def summary(reader, mask_set=False):
-    from pyActigraphy.metrics.metrics import _lmx as lmx
+def summary(reader, mask_set=False, lx_hours=(), mx_hours=()):
+    """
+    Summary metrics of a reader. Besides L5 and M10, the values and midpoints of the least active (Lx) and most active
+    (Mx) windows are added for each window length in hours of lx_hours and mx_hours.
+    """
+    from activity_metrics import ActivityMetrics, time_of_day
 
-    L5_start, L5 = lmx(reader.binarized_data(4), '5H', lowest=True)
-    L5_midpoint = (datetime(2021, 1, 1) + timedelta(hours=2.5) + L5_start).time()
+    metrics = ActivityMetrics(reader, threshold=4)
 
-    M10_start, M10 = lmx(reader.binarized_data(4), '10H', lowest=False)
-    M10_midpoint = (datetime(2021, 1, 1) + timedelta(hours=5) + M10_start).time()
+    _, L5, L5_midpoint = metrics.lmx('5H', lowest=True)
+    _, M10, M10_midpoint = metrics.lmx('10H', lowest=False)
 
     data = {
         'subject': reader.display_name,
         'Start_time': reader.start_time,
         'Mask_fraction': reader.mask_fraction() if mask_set else 0,
         'Duration': reader.duration(),
-        'ADAT': reader.ADAT(),
+        'ADAT': metrics.ADAT(),
         'L5': L5,
-        'L5 Midpoint': L5_midpoint,  # L5_midpoint.strftime("%H:%M:%S"),
+        'L5 Midpoint': time_of_day(L5_midpoint),
         'M10': M10,
-        'M10 Midpoint': M10_midpoint,  # M10_midpoint.strftime("%H:%M:%S"),
-        'RA': reader.RA(),
-        'IS': reader.IS(),
-        'IV': reader.IV(),
-        'ISm': reader.ISm(),
-        'IVm': reader.IVm(),
+        'M10 Midpoint': time_of_day(M10_midpoint),
+        'RA': metrics.RA(),
+        'IS': metrics.IS(),
+        'IV': metrics.IV(),
+        'ISm': metrics.ISm(),
+        'IVm': metrics.IVm(),
     }
+
+    for prefix, hours_list, lowest in [('L', lx_hours, True), ('M', mx_hours, False)]:
+        for hours in hours_list:
+            _, value, midpoint = metrics.lmx(pd.Timedelta(hours=hours), lowest=lowest)
+            data[f'{prefix}{hours:g}'] = value
+            data[f'{prefix}{hours:g} Midpoint'] = time_of_day(midpoint)
+
     return data
 
 
-def compute_summary_and_averages(agds, wear_times_files=None, fname_pattern=None):
-    # read agd files
-    raw_reader = read_agd_files(agds, fname_pattern)
+def sweep_summary(reader, mask_set=False, thresholds=(4,), lx_hours=(5,), mx_hours=(10,)):
+    """
+    Long-format table (subject, threshold, metric, value) of the metrics of a reader for every activity threshold and
+    Lx/Mx window length in hours, see ThresholdSweep.long_table.
+    """
+    from activity_metrics import ThresholdSweep
 
-    # read wear times
+    rows = ThresholdSweep(reader, thresholds).long_table(lx_hours, mx_hours)
+    return pd.DataFrame([(reader.display_name,) + row for row in rows],
+                        columns=['subject', 'threshold', 'metric', 'value'])
+
+
+def windows_summary(reader, mask_set=False, window_days=(1,), step_days=1):
+    """
+    Table (subject, days, first_day, start and the metrics) of IS, IV, RA, L5 and M10 of a reader in sliding windows
+    of each number of days in window_days, starting every step_days days, see WindowedMetrics.
+    """
+    from windowed_metrics import WindowedMetrics
+
+    metrics = WindowedMetrics(reader)
+    tables = [metrics.windows(days, step_days).assign(days=days) for days in window_days]
+    data = pd.concat(tables, ignore_index=True)
+    data.insert(0, 'subject', reader.display_name)
+    return data[['subject', 'days'] + [column for column in data.columns if column not in ('subject', 'days')]]
+
+
+def compute_subject_tables(agds, wear_times_files=None, fname_pattern=None, n_jobs=None, summarize=None,
+                           summary_kwargs=None, columns=(), lean_reader=True, prefetch=1, max_memory=None):
+    """
+    Reads and masks each subject once and summarizes it with summarize into a table with a subject column. Returns
+    the tables of all subjects concatenated and indexed by subject.
+    """
+    agd_files = list_agd_files(agds)
+
+    wear_time_intervals = None
     if wear_times_files:
-        print("read wear times...")
-        wear_times = read_wear_times(wear_times_files, fname_pattern)
-        print(wear_times)
-        wear_time_groups = wear_times.groupby('subject')
+        with stage('read wear times'):
+            wear_time_intervals = wear_time_intervals_by_subject(read_wear_times(wear_times_files, fname_pattern,
+                                                                                 n_jobs))
+
+    tables = process_subjects(agd_files, wear_time_intervals, fname_pattern, n_jobs, summary_kwargs, lean_reader,
+                              prefetch=prefetch, max_memory=max_memory, summarize=summarize)
+    tables = [table for table in tables if table is not None]
+    if not tables:
+        return pd.DataFrame(columns=list(columns)).set_index('subject')
+
+    data = pd.concat(tables, ignore_index=True)
+    try:
+        data['subject'] = data['subject'].astype(int)
+    except (TypeError, ValueError):
+        pass
+    # sorted like the summary table, the rows of a subject keep their order
+    return data.sort_values(by=['subject'], kind='mergesort').set_index('subject')
+
+
+def compute_sweep(agds, wear_times_files=None, fname_pattern=None, n_jobs=None, thresholds=(4,), lx_hours=(5,),
+                  mx_hours=(10,), lean_reader=True, prefetch=1, max_memory=None):
+    """
+    Reads and masks each subject once and computes its metrics for the whole grid of thresholds and Lx/Mx window
+    lengths (see sweep_summary). Returns the long-format table of all subjects.
+    """
+    sweep_kwargs = {'thresholds': tuple(thresholds), 'lx_hours': tuple(lx_hours), 'mx_hours': tuple(mx_hours)}
+    return compute_subject_tables(agds, wear_times_files, fname_pattern, n_jobs, sweep_summary, sweep_kwargs,
+                                  ['subject', 'threshold', 'metric', 'value'], lean_reader, prefetch, max_memory)
 
-    # set masks by wear times
-    summaries = []
 
-    for i, reader in enumerate(raw_reader.readers):
+def compute_windows(agds, wear_times_files=None, fname_pattern=None, n_jobs=None, window_days=(1,), step_days=1,
+                    lean_reader=True, prefetch=1, max_memory=None):
+    """
+    Computes IS, IV, RA, L5 and M10 of each subject per day and in sliding multi-day windows (see windows_summary).
+    Returns the table of the windows of all subjects.
+    """
+    from windowed_metrics import METRICS
 
-        if reader is None:
-            continue
-        printProgressBar(i + 1, len(raw_reader.readers), prefix='Progress:', suffix='Complete', length=50)
-        # print("processing subject {}.".format(int(reader.name)))
+    windows_kwargs = {'window_days': tuple(window_days), 'step_days': step_days}
+    return compute_subject_tables(agds, wear_times_files, fname_pattern, n_jobs, windows_summary, windows_kwargs,
+                                  ['subject', 'days', 'first_day', 'start'] + METRICS, lean_reader, prefetch,
+                                  max_memory)
 
-        wear_time_mask = get_wear_time_mask(reader, wear_time_groups) if wear_times_files else None
 
-        if wear_time_mask is not None:
-            reader.mask = wear_time_mask
-            reader.mask_inactivity = True
+def process_subject(agd_file, wear_time_intervals=None, fname_pattern=None, summary_kwargs=None, lean_reader=True,
+                    summarize=None):
+    """
+    Reads, masks and summarizes a single agd file, summary_kwargs are passed on to summary(). Only the summary dict is
+    returned, so that the reader data never has to leave the (worker) process. Returns None if the subject could not
+    be processed.
+    """
+    with stage('read agd') as read_stage:
+        reader = read_agd(agd_file, fname_pattern, lean=lean_reader)
+        read_stage.subject = reader.display_name if reader is not None else None
+    if reader is None:
+        return None
+    return summarize_reader(reader, wear_time_intervals, summary_kwargs, summarize)
+
+
+def summarize_reader(reader, wear_time_intervals=None, summary_kwargs=None, summarize=None):
+    """
+    Masks the non-wear times of a reader and summarizes it with summarize (default: summary). Returns None if the data
+    is incorrect.
+    """
+    subject = reader.display_name
+    with stage('wear time mask', subject):
+        wear_time_mask = get_wear_time_mask(reader, wear_time_intervals)
+
+    if wear_time_mask is not None:
+        reader.mask = wear_time_mask
+        reader.mask_inactivity = True
+    try:
+        with stage('summary', subject):
+            return (summarize or summary)(reader, wear_time_mask is not None, **(summary_kwargs or {}))
+    except ValueError:
+        print(f"Could not process subject {reader.display_name}, the agd file data incorrect!")
+        return None
+
+
+# wear time intervals, file name pattern, summary function and arguments and reader choice of a worker process, set
+# once by the pool initializer
+_worker_args = {}
+
+
+def _init_worker(wear_time_intervals, fname_pattern, summary_kwargs, lean_reader, profile_settings=None,
+                 summarize=None):
+    import profiling
+    profiling.init_worker(profile_settings)
+    _worker_args['wear_time_intervals'] = wear_time_intervals
+    _worker_args['fname_pattern'] = fname_pattern
+    _worker_args['summary_kwargs'] = summary_kwargs
+    _worker_args['lean_reader'] = lean_reader
+    _worker_args['summarize'] = summarize
+
+
+def _process_subject_in_worker(agd_file):
+    return process_subject(agd_file, **_worker_args)
+
+
+def process_subjects(agd_files, wear_time_intervals=None, fname_pattern=None, n_jobs=None, summary_kwargs=None,
+                     lean_reader=True, on_result=None, prefetch=1, max_memory=None, summarize=None):
+    """
+    Processes all agd files, with n_jobs > 1 (default: number of cpus) each subject is read, masked and summarized in
+    a worker process. Returns the summaries in the order of the agd files, None for subjects that failed. If given,
+    on_result(agd_file, summary) is called as soon as a subject is finished. Instead of summary(), the subjects can be
+    summarized by another (module level) function summarize taking the same arguments.
+
+    Only the summaries are kept, the data of a subject is released once it is summarized. At most n_jobs + prefetch
+    subjects are in progress at a time (with n_jobs = 1, prefetch files are read ahead by background threads) and no
+    new subject is started while the estimated memory of the subjects in progress would exceed max_memory (bytes).
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    if n_jobs == 1:
+        summaries = []
+        readers = iter_agd_files(agd_files, fname_pattern, lean_reader, prefetch, max_memory)
+        for i, (agd_file, reader) in enumerate(readers):
+            printProgressBar(i + 1, len(agd_files), prefix='Progress:', suffix='Complete', length=50)
+            summaries.append(summarize_reader(reader, wear_time_intervals, summary_kwargs, summarize)
+                             if reader is not None else None)
+            # released before the next reader is taken, which starts reading another file
+            del reader
+            if on_result:
+                on_result(agd_file, summaries[-1])
+        return summaries
+
+    import profiling
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    summaries = [None] * len(agd_files)
+    remaining = deque(range(len(agd_files)))
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                             initargs=(wear_time_intervals, fname_pattern, summary_kwargs, lean_reader,
+                                       profiling.settings(), summarize)) as executor:
+        n_done = 0
+        while remaining or in_flight:
+            while remaining and len(in_flight) < n_jobs + prefetch and \
+                    _within_memory([memory for _, memory in in_flight.values()],
+                                   estimated_subject_memory(agd_files[remaining[0]], lean_reader), max_memory):
+                i = remaining.popleft()
+                future = executor.submit(_process_subject_in_worker, agd_files[i])
+                in_flight[future] = (i, estimated_subject_memory(agd_files[i], lean_reader))
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, _ = in_flight.pop(future)
+                n_done += 1
+                printProgressBar(n_done, len(agd_files), prefix='Progress:', suffix='Complete', length=50)
+                summaries[i] = future.result()
+                if on_result:
+                    on_result(agd_files[i], summaries[i])
+    return summaries
+
+
+def agd_subject_name(fname, fname_pattern=None):
+    if fname_pattern:
+        return get_name_from_fname_pattern(fname_pattern, fname)
+
+    if fname.endswith('.arrow'):
+        from agd_store import stored_settings
+        return stored_settings(fname)['subjectname']
+
+    try:
+        connection = sqlite3.connect('file:' + os.path.abspath(fname) + '?mode=ro', uri=True)
         try:
-            summaries.append(summary(reader, wear_time_mask is not None))
-        except ValueError:
-            print(f"Could not process subject {reader.display_name}, the agd file data incorrect!")
-        i += 1
+            row = connection.execute("SELECT settingValue FROM settings WHERE settingName = 'subjectname'").fetchone()
+        finally:
+            connection.close()
+    except sqlite3.DatabaseError:
+        return None
+    return row[0] if row else None
+
+
+def summary_cache_keys(agd_files, wear_time_intervals=None, fname_pattern=None, n_jobs=None, summary_kwargs=None,
+                       lean_reader=True):
+    """
+    Computes the summary cache key of each agd file from the pipeline version, the summary arguments, the reader
+    choice, the subject name, the agd file content and the wear times of the subject.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from summary_cache import file_hash, bytes_hash, cache_key
+
+    wear_time_hashes = {subject: bytes_hash(starts.tobytes() + stops.tobytes())
+                        for subject, (starts, stops) in (wear_time_intervals or {}).items()}
+
+    def subject_key(agd_file):
+        subject = agd_subject_name(agd_file, fname_pattern)
+        return cache_key(PIPELINE_VERSION, sorted((summary_kwargs or {}).items()), bool(lean_reader), subject,
+                         file_hash(agd_file), wear_time_hashes.get(subject, ''))
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(subject_key, agd_files))
+
 
+def compute_summary_and_averages(agds, wear_times_files=None, fname_pattern=None, n_jobs=None, cache=None,
+                                 rebuild_cache=False, summary_kwargs=None, lean_reader=True, result_log_file=None,
+                                 resume=False, prefetch=1, max_memory=None, shard=None):
+    """
+    Computes the summaries of all agd files and their averages. If a summary cache is given, only subjects without a
+    cached summary are processed, with rebuild_cache all subjects are processed and their cache entries replaced.
+    If a result log file is given, each summary is appended to it as soon as it is computed and the summary table is
+    read back from the log. With resume, the subjects already in the log are not processed again.
+    prefetch and max_memory bound the subjects in progress, see process_subjects. The shard (i, N) of a sharded run is
+    recorded in the header of the result log.
+    """
+    agd_files = list_agd_files(agds)
+    all_agd_files = set(agd_files)
+
+    # read wear times
+    wear_time_intervals = None
+    if wear_times_files:
+        print("read wear times...")
+        with stage('read wear times'):
+            wear_times = read_wear_times(wear_times_files, fname_pattern, n_jobs)
+            wear_time_intervals = wear_time_intervals_by_subject(wear_times)
+        print(wear_times)
+
+    on_result = None
+    result_log = None
+    if result_log_file:
+        from result_log import ResultLog
+        from summary_cache import bytes_hash
+
+        # a log is only resumed by a run with the same options and wear times
+        wear_times_hash = bytes_hash(b''.join(subject.encode() + starts.tobytes() + stops.tobytes() for subject, (
+            starts, stops) in sorted((wear_time_intervals or {}).items())))
+        header = {'pipeline_version': PIPELINE_VERSION, 'summary_kwargs': summary_kwargs, 'lean_reader': lean_reader,
+                  'wear_times': wear_times_hash}
+        if shard:
+            # the shards read the wear times of their own subjects only, so their hashes differ
+            header.update(shard=shard, wear_times=None)
+        result_log = ResultLog(result_log_file, header, resume)
+        print(f"Found {len(all_agd_files & result_log.done)} of {len(agd_files)} subjects in the result log")
+        agd_files = [agd_file for agd_file in agd_files if agd_file not in result_log.done]
+
+        def on_result(agd_file, subject_summary):
+            if subject_summary is not None:
+                result_log.append(agd_file, subject_summary)
+
+    cached_summaries = {}
+    if cache is not None:
+        with stage('cache lookup'):
+            keys = dict(zip(agd_files, summary_cache_keys(agd_files, wear_time_intervals, fname_pattern, n_jobs,
+                                                          summary_kwargs, lean_reader)))
+            if not rebuild_cache:
+                cached_summaries = cache.get_many(keys.values())
+        print(f"Found {len(cached_summaries)} of {len(agd_files)} subjects in the summary cache")
+        if on_result:
+            for agd_file in agd_files:
+                if keys[agd_file] in cached_summaries:
+                    on_result(agd_file, cached_summaries[keys[agd_file]])
+        agd_files = [agd_file for agd_file in agd_files if keys[agd_file] not in cached_summaries]
+
+    summaries = process_subjects(agd_files, wear_time_intervals, fname_pattern, n_jobs, summary_kwargs, lean_reader,
+                                 on_result, prefetch, max_memory)
+
+    if cache is not None:
+        cache.put_many({keys[agd_file]: subject_summary for agd_file, subject_summary in zip(agd_files, summaries)
+                        if subject_summary is not None})
+
+    if result_log is not None:
+        def logged_summaries():
+            from result_log import read_results
+            return (subject_summary for agd_file, subject_summary in read_results(result_log.log_file)
+                    if agd_file in all_agd_files)
+
+        result_log.close()
+        with stage('averages'):
+            # the averages of the table, like without a result log, so that the outputs are the same
+            data = summary_table(list(logged_summaries()))
+            return data, summary_averages(data)
+
+    summaries = list(cached_summaries.values()) + [subject_summary for subject_summary in summaries
+                                                   if subject_summary is not None]
+
+    with stage('averages'):
+        data = summary_table(summaries)
+        return data, summary_averages(data)
+
+
+def summary_table(summaries):
+    """
+    Table of the subject summaries, indexed and sorted by subject.
+    """
     data = pd.DataFrame(summaries)
+    if data.empty:
+        # e.g. a shard without subjects
+        return pd.DataFrame(index=pd.Index([], name="subject"))
 
     data.set_index("subject", inplace=True)
     try:
@@ -178,23 +532,151 @@ def compute_summary_and_averages(agds, wear_times_files=None, fname_pattern=None
         pass
 
     data.sort_index(inplace=True)
+    return data
 
-    from read_reports import compute_time_averages
 
+def summary_time_names(columns):
     time_names = ['M10 Midpoint', 'L5 Midpoint']
+    return time_names + [name for name in columns if name.endswith(' Midpoint') and name not in time_names]
+
+
+def summary_averages(data):
+    from read_reports import compute_time_averages
+
+    time_names = summary_time_names(data.columns)
     normal_data_averages = data.mean(numeric_only=True)
     time_data_averages = compute_time_averages(data, time_names, pivot=5)
-    averages = pd.concat([normal_data_averages, time_data_averages])
+    return pd.concat([normal_data_averages, time_data_averages])
+
+
+def search_folder_pattern(search_folder, subject_filename_pattern=None):
+    """
+    Pattern taking the subject name from the paths of the files found in the search folder, by default the name of
+    the subject sub-folder.
+    """
+    subfolder = search_folder.split("/")[-1]
+    return re.compile(subject_filename_pattern if subject_filename_pattern else f".*/{subfolder}/(.*?)/.*")
+
+
+def search_folder_files(search_folder, subject_filename_pattern=None, shard=None):
+    """
+    Searches the subject sub-folders for agd and wear time files. Returns the sorted agd files, the wear time files
+    and the pattern taking the subject name from the file paths, by default the name of the subject sub-folder. With a
+    shard (i, N), only the files of the subjects in the shard are returned.
+    """
+    import crawl_files
+    from sharding import select_shard_groups
+
+    subject_filename_pattern = search_folder_pattern(search_folder, subject_filename_pattern)
+    print(subject_filename_pattern)
+
+    manifest_file = crawl_files.default_manifest_file(search_folder)
+    groups_map = select_shard_groups(crawl_files.search_folder(search_folder, manifest_file=manifest_file), shard)
+
+    agd_files = [item['agd_file'] for key, item in groups_map.items() if item['agd_file']]
+    wear_files = [item['wear_time'] for key, item in groups_map.items() if item['wear_time']]
+
+    print(f'Found {len(agd_files)} agd files in {search_folder}')
+    agd_files.sort()
+    return agd_files, wear_files, subject_filename_pattern
+
+
+def convert(argv):
+    import argparse
+    from agd_store import convert_agd_files
+
+    parser = argparse.ArgumentParser(prog='actigraphy_batch.py convert',
+                                     description='Converts agd files into a columnar agd store, which is read much '
+                                                 'faster than the agd files. Analyse the store with -d.')
+
+    two_options = parser.add_mutually_exclusive_group(required=True)
+    two_options.add_argument('-a', '--agd-folder', dest="agd_folder", help='Folder containing all agd files')
+    two_options.add_argument('-s', '--search-folder', dest="search_folder",
+                             help='Folder containing sub-folders for each subject')
+    parser.add_argument('--subject-filename-pattern', dest="subject_filename_pattern",
+                        help='If set, the the subject name will be taken from the file name following this regex pattern')
+    parser.add_argument('-o', '--store', dest="store", required=True, help='Folder of the agd store')
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=None,
+                        help='Number of worker processes converting the agd files. Default is the number of cpus')
+
+    args = parser.parse_args(argv)
+
+    if args.search_folder:
+        agd_files, _, subject_filename_pattern = search_folder_files(args.search_folder,
+                                                                     args.subject_filename_pattern)
+    else:
+        agd_files = sorted(list_agd_files(args.agd_folder))
+        subject_filename_pattern = re.compile(args.subject_filename_pattern) if args.subject_filename_pattern else None
+
+    subjects = [get_name_from_fname_pattern(subject_filename_pattern, agd_file) if subject_filename_pattern else None
+                for agd_file in agd_files]
+
+    index = convert_agd_files(agd_files, args.store, subjects, n_jobs=args.jobs)
+    print(f'Converted {len(index)} subjects into {args.store}')
 
-    return data, averages
+
+def merge(argv):
+    import argparse
+    from output_writers import FORMATS, DEFAULT_FORMATS, write_outputs
+    from result_log import read_results
+    from sharding import check_shard_headers
+
+    parser = argparse.ArgumentParser(prog='actigraphy_batch.py merge',
+                                     description='Combines the result logs of the shards of a run (--shard) into the '
+                                                 'summaries and averages of all subjects.')
+    parser.add_argument('result_logs', nargs='+', help='Result logs of all shards')
+    parser.add_argument('-o', '--reports-output', dest="reports_output", required=True,
+                        help='File for storing the resulting average computations')
+    parser.add_argument('--formats', dest="formats", nargs='+', choices=FORMATS, default=DEFAULT_FORMATS,
+                        help=f'Formats of the output files, default: {" ".join(DEFAULT_FORMATS)}')
+    parser.add_argument('--results-db', dest="results_db", default=None,
+                        help='Results database (sqlite) the results are also stored in, see results_db.py for queries')
+    parser.add_argument('--run-name', dest="run_name", default=None,
+                        help='Name of the run in the results database, the results of its subjects replace those of '
+                             'an earlier run with the same name. Default is the output file')
+
+    args = parser.parse_args(argv)
+
+    try:
+        check_shard_headers(args.result_logs)
+    except ValueError as error:
+        parser.error(str(error))
+
+    def all_summaries():
+        return (subject_summary for result_log in args.result_logs for _, subject_summary in read_results(result_log))
+
+    data = summary_table(list(all_summaries()))
+    averages = summary_averages(data)
+    print(f'Merged the summaries of {len(data)} subjects from {len(args.result_logs)} result logs')
+
+    write_outputs({args.reports_output: data, f"{args.reports_output}_averages": averages}, args.formats)
+    print(data)
+
+    if args.results_db:
+        from results_db import store_results
+        store_results(args.results_db, args.run_name or args.reports_output, data, 'actigraphy_batch',
+                      {'result_logs': args.result_logs})
 
 
 if __name__ == '__main__':
 
     import sys
     import argparse
+    from output_writers import FORMATS, DEFAULT_FORMATS
+    from sharding import parse_shard, select_shard, shard_suffix
+
+    if sys.argv[1:2] == ['convert']:
+        convert(sys.argv[2:])
+        exit()
 
-    parser = argparse.ArgumentParser()
+    if sys.argv[1:2] == ['merge']:
+        merge(sys.argv[2:])
+        exit()
+
+    parser = argparse.ArgumentParser(description='Computes summaries of agd files and their averages. Use '
+                                                 '"actigraphy_batch.py convert -h" for converting agd files into an '
+                                                 'agd store and "actigraphy_batch.py merge -h" for combining the '
+                                                 'results of shards.')
 
     two_options = parser.add_mutually_exclusive_group(required=True)
 
@@ -205,36 +687,111 @@ if __name__ == '__main__':
 
     two_options.add_argument('-s', '--search-folder', dest="search_folder",
                              help='Folder containing sub-folders for each subject')
+    two_options.add_argument('-d', '--agd-store', dest="agd_store",
+                             help='Agd store created by "actigraphy_batch.py convert", used instead of the agd files')
     parser.add_argument('--subject-filename-pattern', dest="subject_filename_pattern",
                         help='If set, the the subject name will be taken from the file name following this regex pattern')
 
     parser.add_argument('-o', '--reports-output', dest="reports_output", required=True,
                         help='File for storing the resulting average computations')
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=None,
+                        help='Number of worker processes reading and summarizing the subjects. '
+                             'Default is the number of cpus, 1 processes all subjects in this process')
+
+    parser.add_argument('--cache-file', dest="cache_file", default=None,
+                        help='Summary cache file, only new or changed subjects are processed. '
+                             'Default is ~/.cache/actigraphy/summaries.sqlite')
+    parser.add_argument('--cache-size', dest="cache_size", type=int, default=None,
+                        help='Maximal number of cached summaries, the least recently used ones are evicted')
+    parser.add_argument('--pyactigraphy-reader', dest="pyactigraphy_reader", action='store_true',
+                        help='Read the agd files with pyActigraphy instead of the lean agd reader')
+    parser.add_argument('--formats', dest="formats", nargs='+', choices=FORMATS, default=DEFAULT_FORMATS,
+                        help=f'Formats of the output files, default: {" ".join(DEFAULT_FORMATS)}')
+    parser.add_argument('--prefetch', dest="prefetch", type=int, default=1,
+                        help='Number of subjects read ahead while others are summarized, default: 1')
+    parser.add_argument('--max-memory', dest="max_memory", type=float, default=None,
+                        help='Memory ceiling in GB, no further subject is started while the estimated memory of the '
+                             'subjects in progress would exceed it')
+    parser.add_argument('--lx', dest="lx_hours", type=float, nargs='+', default=[],
+                        help='Additional window lengths in hours of the least active periods (Lx), e.g. --lx 3 7')
+    parser.add_argument('--mx', dest="mx_hours", type=float, nargs='+', default=[],
+                        help='Additional window lengths in hours of the most active periods (Mx), e.g. --mx 6 12')
+
+    parser.add_argument('--sweep-thresholds', dest="sweep_thresholds", type=float, nargs='+', default=None,
+                        help='Sweep mode: instead of the summaries, compute the metrics for each of these activity '
+                             'thresholds and each Lx/Mx window (L5, M10 and the windows of --lx and --mx), reading '
+                             'each subject once. The long-format table is written to <reports output>_sweep')
+    parser.add_argument('--windows', dest="window_days", type=int, nargs='+', default=None,
+                        help='Windows mode: instead of the summaries, compute IS, IV, RA, L5 and M10 in sliding '
+                             'windows of each of these numbers of days, e.g. --windows 1 7 for every day and every '
+                             'week. The table is written to <reports output>_windows. Every subject is computed again '
+                             'on each run, the running sums of the days are not kept between runs')
+    parser.add_argument('--window-step', dest="window_step", type=int, default=1,
+                        help='Days between the starts of two windows, default: 1')
+    parser.add_argument('--results-db', dest="results_db", default=None,
+                        help='Results database (sqlite) the results are also stored in, see results_db.py for queries')
+    parser.add_argument('--run-name', dest="run_name", default=None,
+                        help='Name of the run in the results database, the results of its subjects replace those of '
+                             'an earlier run with the same name. Default is the output file')
+    parser.add_argument('--result-log', dest="result_log", default=None,
+                        help='File to which each summary is appended as soon as it is computed. '
+                             'Default is <reports output>_results.jsonl')
+    parser.add_argument('--resume', dest="resume", action='store_true',
+                        help='Resume an interrupted run, the subjects in the result log are not processed again')
+    parser.add_argument('--shard', dest="shard", type=parse_shard, default=None,
+                        help='Only process the shard i/N of the subjects, e.g. 2/4 on the second of four nodes. The '
+                             'summaries are written to the result log <reports output>_shard<i>of<N>_results.jsonl, '
+                             'combine the result logs of all shards with "actigraphy_batch.py merge"')
+
+    parser.add_argument('--profile', dest="profile", default=None,
+                        help='Chrome trace file (chrome://tracing, Perfetto) for the wall time and peak memory of each '
+                             'stage and subject')
+    parser.add_argument('--profile-stage', dest="profile_stage", default=None,
+                        help='With --profile, run cProfile during this stage (e.g. "summary"), the statistics are '
+                             'saved to <profile>.prof')
+
+    cache_options = parser.add_mutually_exclusive_group()
+    cache_options.add_argument('--no-cache', dest="no_cache", action='store_true',
+                               help='Process all subjects without reading or writing the summary cache')
+    cache_options.add_argument('--rebuild-cache', dest="rebuild_cache", action='store_true',
+                               help='Process all subjects and replace their entries in the summary cache')
 
     args = parser.parse_args(sys.argv[1:])
 
-    data = None
-    averages = None
+    if any(not 0 < hours <= 24 for hours in args.lx_hours + args.mx_hours):
+        parser.error('Lx/Mx window lengths must be between 0 and 24 hours')
+    summary_kwargs = {'lx_hours': tuple(args.lx_hours), 'mx_hours': tuple(args.mx_hours)}
+    if args.prefetch < 0:
+        parser.error('--prefetch must not be negative')
+    if args.window_days and (min(args.window_days) < 1 or args.window_step < 1):
+        parser.error('window lengths and --window-step must be at least one day')
+    if args.window_days and args.sweep_thresholds:
+        parser.error('--windows and --sweep-thresholds cannot be combined')
+    max_memory = int(args.max_memory * 2 ** 30) if args.max_memory is not None else None
 
-    if args.search_folder:
-        import crawl_files
+    if args.profile:
+        import profiling
+        profiling.start(args.profile, args.profile_stage)
 
-        subfolder = args.search_folder.split("/")[-1]
-        subject_filename_pattern = re.compile(
-        args.subject_filename_pattern if args.subject_filename_pattern else f".*/{subfolder}/(.*?)/.*")
-        print(subject_filename_pattern)
+    result_log_file = args.result_log or f"{args.reports_output}{shard_suffix(args.shard)}_results.jsonl"
 
-        groups_map = crawl_files.search_folder(args.search_folder)
+    wear_files = args.wear_times_file
+    subject_filename_pattern = None
 
-        agd_files = [item['agd_file'] for key, item in groups_map.items() if item['agd_file']]
-        wear_files = [item['wear_time'] for key, item in groups_map.items() if item['wear_time']]
+    if args.search_folder:
+        agd_files, wear_files, subject_filename_pattern = search_folder_files(args.search_folder,
+                                                                              args.subject_filename_pattern,
+                                                                              args.shard)
 
-        #print(wear_files)
+    elif args.agd_store:
+        from agd_store import stored_data_files
 
-        print(f'Found {len(agd_files)} agd files in {args.search_folder}')
-        agd_files.sort()
-        data, averages = compute_summary_and_averages(agd_files, wear_times_files=wear_files,
-                                                      fname_pattern=subject_filename_pattern)
+        if args.wear_times_file and not os.path.exists(args.wear_times_file):
+            print(f'wear time validation details file {args.wear_times_file} does not exist!')
+            parser.print_help()
+            exit()
+
+        agd_files = select_shard(stored_data_files(args.agd_store), args.shard)
 
     else:
         wrong_param = False
@@ -251,28 +808,64 @@ if __name__ == '__main__':
             parser.print_help()
             exit()
 
-        data, averages = compute_summary_and_averages(args.agd_folder, args.wear_times_file)
-
-    print("Averages")
-    print(averages)
+        agd_files = select_shard(sorted(list_agd_files(args.agd_folder)), args.shard)
 
-    from pathlib import Path
-    filepath = Path(args.reports_output)
-    filepath.parent.mkdir(parents=True, exist_ok=True)
-    # write averages to excel and csv
-    averages.to_excel(f"{args.reports_output}_averages.xlsx")
-    averages.to_csv(f"{args.reports_output}_averages.csv")
+    if args.sweep_thresholds:
+        # L5 and M10 and the additional windows for every threshold
+        lx_hours = sorted({5.0, *args.lx_hours})
+        mx_hours = sorted({10.0, *args.mx_hours})
+        sweep = compute_sweep(agd_files, wear_files, subject_filename_pattern, args.jobs, args.sweep_thresholds,
+                              lx_hours, mx_hours, lean_reader=not args.pyactigraphy_reader, prefetch=args.prefetch,
+                              max_memory=max_memory)
+        print(sweep)
 
-    # write actigraphy summary data to html
-    data_html = data.to_html()
-    data_html_file = open(f"{args.reports_output}.html", "w")
-    data_html_file.write(data_html)
-    data_html_file.close()
+        from output_writers import write_outputs
+        write_outputs({f"{args.reports_output}{shard_suffix(args.shard)}_sweep": sweep}, args.formats)
 
-    # write actigraphy summary data to csv
-    data.to_csv(f"{args.reports_output}.csv")
+    elif args.window_days:
+        windows = compute_windows(agd_files, wear_files, subject_filename_pattern, args.jobs, args.window_days,
+                                  args.window_step, lean_reader=not args.pyactigraphy_reader, prefetch=args.prefetch,
+                                  max_memory=max_memory)
+        print(windows)
 
-    # write actigraphy summary data to excel
-    data.to_excel(f"{args.reports_output}.xlsx")
+        from output_writers import write_outputs
+        write_outputs({f"{args.reports_output}{shard_suffix(args.shard)}_windows": windows}, args.formats)
 
-    print(data)
+    else:
+        cache = None
+        if not args.no_cache:
+            import summary_cache
+            cache = summary_cache.SummaryCache(args.cache_file or summary_cache.DEFAULT_CACHE_FILE,
+                                               args.cache_size or summary_cache.DEFAULT_MAX_ENTRIES)
+
+        data, averages = compute_summary_and_averages(agd_files, wear_files, subject_filename_pattern,
+                                                      n_jobs=args.jobs, cache=cache,
+                                                      rebuild_cache=args.rebuild_cache, summary_kwargs=summary_kwargs,
+                                                      lean_reader=not args.pyactigraphy_reader,
+                                                      result_log_file=result_log_file, resume=args.resume,
+                                                      prefetch=args.prefetch, max_memory=max_memory,
+                                                      shard=args.shard)
+
+        if args.shard:
+            # the outputs are written by merge from the result logs of all shards
+            print(f"Wrote the summaries of shard {args.shard[0]}/{args.shard[1]} to {result_log_file}, combine the "
+                  f"shards with actigraphy_batch.py merge")
+
+        else:
+            print("Averages")
+            print(averages)
+
+            # write the actigraphy summary data and the averages in all formats
+            from output_writers import write_outputs
+            write_outputs({args.reports_output: data, f"{args.reports_output}_averages": averages}, args.formats)
+
+            print(data)
+
+            if args.results_db:
+                from results_db import store_results
+                store_results(args.results_db, args.run_name or args.reports_output, data, 'actigraphy_batch',
+                              {'summary_kwargs': summary_kwargs, 'lean_reader': not args.pyactigraphy_reader,
+                               'wear_times': wear_files})
+
+    if args.profile:
+        profiling.finish(args.profile)
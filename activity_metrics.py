@@ -0,0 +1,319 @@
+import numpy as np
+import pandas as pd
+from datetime import time
+
+DAY = pd.Timedelta('1D')
+
+# resampling frequencies of ISm and IVm, divisors of 1440 between 1 and 60 min
+ISM_IVM_FREQS = ['1T', '2T', '3T', '4T', '5T', '6T', '8T', '9T', '10T', '12T', '15T', '16T', '18T', '20T', '24T',
+                 '30T', '32T', '36T', '40T', '45T', '48T', '60T']
+
+
+def _var(values):
+    values = values[~np.isnan(values)]
+    return values.var(ddof=1) if len(values) > 1 else np.nan
+
+
+def _interdaily_stability(values, timestamps):
+    # average each time of the day over all days
+    _, slots = np.unique(timestamps % DAY.value, return_inverse=True)
+    valid = ~np.isnan(values)
+    sums = np.bincount(slots[valid], weights=values[valid], minlength=slots.max() + 1)
+    counts = np.bincount(slots[valid], minlength=slots.max() + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        daily_means = sums / counts
+    return _var(daily_means) / _var(values)
+
+
+def _intradaily_variability(values):
+    diffs = np.diff(values)
+    diffs = diffs[~np.isnan(diffs)]
+    return (np.mean(diffs ** 2) if len(diffs) else np.nan) / _var(values)
+
+
+def time_of_day(offset):
+    """
+    Converts an offset from midnight into a time, offsets of more than a day wrap around.
+    """
+    seconds, microseconds = divmod(pd.Timedelta(offset).value // 1000 % (DAY.value // 1000), 1000000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return time(hours, minutes, seconds, microseconds)
+
+
+def circular_window_means(profile_cumsum, valid_cumsum, n_epochs):
+    """
+    Mean activity of every window of n_epochs epochs of the circular daily profile, one window per onset epoch. The
+    cumulative sums run over the profile followed by its first n_epochs - 1 epochs, windows without data are NaN.
+    """
+    sums = (profile_cumsum[n_epochs:] - profile_cumsum[:-n_epochs]).astype(np.float64)
+    counts = valid_cumsum[n_epochs:] - valid_cumsum[:-n_epochs]
+    return np.where(counts > 0, sums / n_epochs, np.nan)
+
+
+class ActivityMetrics:
+    """
+    Nonparametric metrics of one reader, computed in a single pass over shared intermediates. The data is binarized
+    once, its cumulative sums give every resampling, and the 24h daily profile is computed once for L5, M10 and RA.
+    Lx/Mx windows of any length are evaluated with circular prefix sums over the daily profile.
+    The results match the corresponding pyActigraphy metrics with binarize=True.
+    """
+
+    def __init__(self, reader, threshold=4, binarized=None):
+        data = reader.data
+        self.epoch = pd.Timedelta(reader.frequency)
+        self.timestamps = data.index.asi8
+
+        if binarized is None:
+            values = data.to_numpy(dtype=float)
+            binarized = np.where(values > threshold, 1., 0.)
+            binarized[np.isnan(values)] = np.nan
+        self.binarized = binarized
+
+        self.mask = None
+        if reader.mask_inactivity and reader.mask is not None:
+            self.mask = reader.mask.reindex(data.index).to_numpy()
+        self.exclude_if_mask = getattr(reader, 'exclude_if_mask', True)
+
+        self._cumsum = None
+        self._resampled = {}
+        self._daily_profile = None
+        self._profile_cumsum = None
+        self._lmx = {}
+
+    def resampled(self, freq):
+        """
+        Sums of the binarized data per resampling period, with origin at the first sample. If a mask is set, periods
+        that are (partially, depending on exclude_if_mask) masked are NaN. Returns the values and their timestamps.
+        """
+        if freq not in self._resampled:
+            self._resampled[freq] = self._resample(pd.Timedelta(freq))
+        return self._resampled[freq]
+
+    def _resample(self, freq):
+        # frequencies up to the epoch length return the binarized data as it is
+        if freq <= self.epoch:
+            return self.binarized, self.timestamps
+
+        epochs, remainder = divmod(freq.value, self.epoch.value)
+        if remainder:
+            return self._resample_pandas(freq)
+
+        if self._cumsum is None:
+            self._cumsum = np.concatenate([[0.], np.cumsum(np.nan_to_num(self.binarized))])
+            if self.mask is not None:
+                self._mask_cumsum = np.concatenate([[0], np.cumsum(self.mask > 0)])
+
+        n = len(self.binarized)
+        begins = np.arange(0, n, epochs)
+        ends = np.minimum(begins + epochs, n)
+        values = self._cumsum[ends] - self._cumsum[begins]
+
+        if self.mask is not None:
+            unmasked = self._mask_cumsum[ends] - self._mask_cumsum[begins]
+            valid = unmasked == ends - begins if self.exclude_if_mask else unmasked > 0
+            values = np.where(valid, values, np.nan)
+
+        return values, self.timestamps[0] + begins // epochs * freq.value
+
+    def _resample_pandas(self, freq):
+        index = pd.to_datetime(self.timestamps)
+        resampled = pd.Series(self.binarized, index=index).resample(freq, origin='start').sum()
+        if self.mask is not None:
+            resampled_mask = pd.Series(self.mask, index=index).resample(freq, origin='start')
+            resampled_mask = resampled_mask.min() if self.exclude_if_mask else resampled_mask.max()
+            resampled = resampled.where(resampled_mask > 0)
+        return resampled.to_numpy(dtype=float), resampled.index.asi8
+
+    @property
+    def daily_profile(self):
+        """
+        Mean binarized activity for each epoch of the day, starting at midnight.
+        """
+        if self._daily_profile is None:
+            time_of_day = self.timestamps % DAY.value
+            slots = (time_of_day - time_of_day[0] % self.epoch.value) // self.epoch.value
+            n_slots = DAY // self.epoch
+
+            if len(np.unique(slots)) != n_slots:
+                raise ValueError("The recording does not cover every epoch of a day.")
+
+            valid = ~np.isnan(self.binarized)
+            sums = np.bincount(slots[valid], weights=self.binarized[valid], minlength=n_slots)
+            counts = np.bincount(slots[valid], minlength=n_slots)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self._daily_profile = sums / counts
+        return self._daily_profile
+
+    def ADAT(self):
+        """
+        Total daily activity averaged over all days, rescaled to account for masked epochs.
+        """
+        days = self.timestamps // DAY.value
+        days -= days[0]
+        valid = ~np.isnan(self.binarized)
+        sums = np.bincount(days[valid], weights=self.binarized[valid], minlength=days[-1] + 1)
+        counts = np.bincount(days[valid], minlength=days[-1] + 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            daily_sums = sums * ((DAY // self.epoch) / counts)
+        return np.nanmean(daily_sums)
+
+    def lmx_windows(self, period):
+        """
+        Mean activity of the windows of length period starting at each epoch of the (circular) daily profile.
+        """
+        n_epochs = int(pd.Timedelta(period) / self.epoch)
+        profile = self.daily_profile
+        if not 0 < n_epochs <= len(profile):
+            raise ValueError(f"Period {period} must be between one epoch and one day.")
+
+        if self._profile_cumsum is None:
+            # prefix sums over two days, the profile is wrapped around at midnight. They are accumulated in extended
+            # precision (where available) to keep the rounding errors of the window sums at the level of float64.
+            circular = np.concatenate([profile, profile])
+            self._profile_cumsum = np.concatenate([[0.], np.cumsum(np.nan_to_num(circular), dtype=np.longdouble)])
+            self._valid_cumsum = np.concatenate([[0], np.cumsum(~np.isnan(circular))])
+
+        end = len(profile) + n_epochs
+        return circular_window_means(self._profile_cumsum[:end], self._valid_cumsum[:end], n_epochs)
+
+    def lmx(self, period, lowest=True):
+        """
+        Onset, mean activity and midpoint of the window of lowest/highest activity in the daily profile. Onset and
+        midpoint are offsets from midnight.
+        """
+        key = (pd.Timedelta(period), lowest)
+        if key not in self._lmx:
+            means = self.lmx_windows(period)
+            # ties are broken by the earliest onset, also when the sums only differ by rounding errors
+            rounded = np.round(means, 12)
+            onset = np.nanargmin(rounded) if lowest else np.nanargmax(rounded)
+            onset_time = onset * self.epoch
+            self._lmx[key] = onset_time, means[onset], (onset_time + pd.Timedelta(period) / 2) % DAY
+        return self._lmx[key]
+
+    def L5(self):
+        return self.lmx('5H', lowest=True)[1]
+
+    def M10(self):
+        return self.lmx('10H', lowest=False)[1]
+
+    def RA(self):
+        l5, m10 = self.L5(), self.M10()
+        return (m10 - l5) / (m10 + l5)
+
+    def IS(self, freq='1H'):
+        return _interdaily_stability(*self.resampled(freq))
+
+    def IV(self, freq='1H'):
+        return _intradaily_variability(self.resampled(freq)[0])
+
+    def ISm(self, freqs=ISM_IVM_FREQS):
+        return np.mean([self.IS(freq) for freq in freqs])
+
+    def IVm(self, freqs=ISM_IVM_FREQS):
+        return np.mean([self.IV(freq) for freq in freqs])
+
+
+class ThresholdSweep:
+    """
+    Metrics of one reader for several activity thresholds. The data is binarized for all thresholds at once and the
+    daily profiles and their circular prefix sums of all thresholds are computed as one array, over which each Lx/Mx
+    window length is evaluated for all thresholds together. IS, IV and ADAT are computed by an ActivityMetrics per
+    threshold on the shared binarized data. The results equal those of ActivityMetrics(reader, threshold).
+    """
+
+    def __init__(self, reader, thresholds):
+        data = reader.data
+        self.thresholds = list(thresholds)
+        values = data.to_numpy(dtype=float)
+
+        # one row per threshold
+        self.binarized = np.where(values[np.newaxis, :] > np.asarray(self.thresholds, dtype=float)[:, np.newaxis],
+                                  1., 0.)
+        self.binarized[:, np.isnan(values)] = np.nan
+        self.metrics = [ActivityMetrics(reader, threshold, binarized)
+                        for threshold, binarized in zip(self.thresholds, self.binarized)]
+        self.epoch = self.metrics[0].epoch if self.metrics else None
+        self._lmx = {}
+
+        if self.metrics:
+            self._set_daily_profiles()
+
+    def _set_daily_profiles(self):
+        timestamps = self.metrics[0].timestamps
+        time_of_day = timestamps % DAY.value
+        slots = (time_of_day - time_of_day[0] % self.epoch.value) // self.epoch.value
+        n_slots = DAY // self.epoch
+        n_thresholds = len(self.thresholds)
+
+        if len(np.unique(slots)) != n_slots:
+            raise ValueError("The recording does not cover every epoch of a day.")
+
+        # missing values are the same for all thresholds, the bins of all thresholds are counted in one pass
+        valid = ~np.isnan(self.binarized[0])
+        bins = (np.arange(n_thresholds)[:, np.newaxis] * n_slots + slots[valid][np.newaxis, :]).ravel()
+        sums = np.bincount(bins, weights=self.binarized[:, valid].ravel(), minlength=n_thresholds * n_slots)
+        counts = np.bincount(slots[valid], minlength=n_slots)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.daily_profiles = sums.reshape(n_thresholds, n_slots) / counts
+
+        circular = np.concatenate([self.daily_profiles, self.daily_profiles], axis=1)
+        self.profile_cumsums = np.concatenate([np.zeros((n_thresholds, 1), dtype=np.longdouble),
+                                               np.cumsum(np.nan_to_num(circular), axis=1, dtype=np.longdouble)],
+                                              axis=1)
+        self.valid_cumsum = np.concatenate([[0], np.cumsum(~np.isnan(circular[0]))])
+
+        for i, metrics in enumerate(self.metrics):
+            metrics._daily_profile = self.daily_profiles[i]
+            metrics._profile_cumsum = self.profile_cumsums[i]
+            metrics._valid_cumsum = self.valid_cumsum
+
+    def lmx(self, period, lowest=True):
+        """
+        Onsets, mean activities and midpoints of the windows of lowest/highest activity of all thresholds, see
+        ActivityMetrics.lmx.
+        """
+        key = (pd.Timedelta(period), lowest)
+        if key not in self._lmx:
+            n_epochs = int(pd.Timedelta(period) / self.epoch)
+            n_slots = self.daily_profiles.shape[1]
+            if not 0 < n_epochs <= n_slots:
+                raise ValueError(f"Period {period} must be between one epoch and one day.")
+
+            end = n_slots + n_epochs
+            sums = (self.profile_cumsums[:, n_epochs:end] - self.profile_cumsums[:, :end - n_epochs]).astype(np.float64)
+            counts = self.valid_cumsum[n_epochs:end] - self.valid_cumsum[:end - n_epochs]
+            means = np.where(counts > 0, sums / n_epochs, np.nan)
+
+            rounded = np.round(means, 12)
+            onsets = np.nanargmin(rounded, axis=1) if lowest else np.nanargmax(rounded, axis=1)
+            self._lmx[key] = [(onset * self.epoch, row_means[onset],
+                               (onset * self.epoch + pd.Timedelta(period) / 2) % DAY)
+                              for onset, row_means in zip(onsets, means)]
+        return self._lmx[key]
+
+    def long_table(self, lx_hours=(5,), mx_hours=(10,)):
+        """
+        Rows (threshold, metric, value) of ADAT, IS, IV, ISm, IVm, the Lx/Mx values and midpoints of each window length
+        in hours and RA for each pair of Lx and Mx window, for every threshold.
+        """
+        rows = []
+        for i, (threshold, metrics) in enumerate(zip(self.thresholds, self.metrics)):
+            rows += [(threshold, name, value) for name, value in [
+                ('ADAT', metrics.ADAT()), ('IS', metrics.IS()), ('IV', metrics.IV()), ('ISm', metrics.ISm()),
+                ('IVm', metrics.IVm())]]
+
+            windows = {}
+            for prefix, hours_list, lowest in [('L', lx_hours, True), ('M', mx_hours, False)]:
+                for hours in hours_list:
+                    _, value, midpoint = self.lmx(pd.Timedelta(hours=hours), lowest)[i]
+                    windows[(prefix, hours)] = value
+                    rows += [(threshold, f'{prefix}{hours:g}', value),
+                             (threshold, f'{prefix}{hours:g} Midpoint', time_of_day(midpoint))]
+
+            for lx in lx_hours:
+                for mx in mx_hours:
+                    l_value, m_value = windows[('L', lx)], windows[('M', mx)]
+                    rows.append((threshold, f'RA (L{lx:g}, M{mx:g})', (m_value - l_value) / (m_value + l_value)))
+        return rows
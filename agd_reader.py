@@ -0,0 +1,125 @@
+import os
+import sqlite3
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+# .NET ticks (100 ns intervals since 0001-01-01) at the unix epoch
+TICKS_AT_UNIX_EPOCH = 621355968000000000
+
+
+def ticks_to_datetime64(ticks):
+    return ((np.asarray(ticks, dtype=np.int64) - TICKS_AT_UNIX_EPOCH) * 100).astype('datetime64[ns]')
+
+
+def read_agd_arrays(fname):
+    """
+    Reads the settings and the timestamps and axis counts of an agd file. The database is opened read-only and the
+    rows are streamed from the cursor into one typed array. Returns the settings dict, the timestamps as datetime64
+    array and the counts as int64 array with one column per axis.
+    """
+    connection = sqlite3.connect('file:' + os.path.abspath(fname) + '?mode=ro', uri=True)
+    try:
+        settings = dict(connection.execute("SELECT settingName, settingValue FROM settings").fetchall())
+        n_rows = connection.execute("SELECT COUNT(*) FROM data").fetchone()[0]
+        cursor = connection.execute("SELECT dataTimestamp, axis1, axis2, axis3 FROM data")
+        rows = np.fromiter(chain.from_iterable(cursor), dtype=np.int64, count=4 * n_rows).reshape(n_rows, 4)
+    finally:
+        connection.close()
+
+    if not np.all(rows[1:, 0] > rows[:-1, 0]):
+        rows = rows[np.argsort(rows[:, 0], kind='stable')]
+
+    return settings, ticks_to_datetime64(rows[:, 0]), rows[:, 1:]
+
+
+class LeanAGD:
+    """
+    Activity counts (vector magnitude of the three axes) and metadata of an agd file. Only the columns needed by
+    summary() are read, it can be used there in place of pyActigraphy's RawAGD and gives the same data. The vertical
+    axis counts are kept in raw_axis1 for sleep scoring.
+    """
+
+    def __init__(self, fname, settings=None, timestamps=None, counts=None):
+        # the arrays can also be given directly, e.g. when they are read from a converted agd store
+        if settings is None:
+            settings, timestamps, counts = read_agd_arrays(fname)
+
+        self.fpath = os.path.abspath(fname)
+        self.name = settings['subjectname']
+        self.display_name = self.name
+        self.uuid = settings.get('deviceserial')
+        self.frequency = pd.Timedelta(int(settings['epochlength']), unit='s')
+        self.start_time = pd.Timestamp(ticks_to_datetime64(int(settings['startdatetime'])))
+
+        magnitude = np.sqrt(np.square(counts, dtype=np.float64).sum(axis=1))
+        # the vertical axis counts are kept for sleep scoring, whose algorithms are calibrated on them
+        data = pd.DataFrame({'magnitude': magnitude, 'axis1': counts[:, 0].astype(np.float64)},
+                            index=pd.DatetimeIndex(timestamps))
+
+        # fill missing epochs with NaN, like RawAGD does with asfreq
+        index = pd.date_range(data.index[0], data.index[-1], freq=self.frequency)
+        if len(index) != len(data) or not index.equals(data.index):
+            data = data.reindex(index)
+        else:
+            data.index = index
+
+        data = data.loc[self.start_time:]
+        self.raw_data = data['magnitude'].rename(None)
+        self.raw_axis1 = data['axis1'].rename(None)
+        self.period = data.index[-1] - self.start_time
+
+        self.mask = None
+        self.mask_inactivity = False
+        self.exclude_if_mask = True
+
+    @property
+    def data(self):
+        data = self.raw_data
+        if self.mask_inactivity and self.mask is not None:
+            data = data.where(self.mask > 0)
+        return data
+
+    def length(self):
+        return len(self.raw_data)
+
+    def duration(self):
+        return self.frequency * self.length()
+
+    def mask_fraction(self):
+        return 1. - self.mask.sum() / len(self.mask)
+
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+    import argparse
+    import warnings
+
+    parser = argparse.ArgumentParser(
+        description='Compares reading agd files with LeanAGD and with pyActigraphy\'s RawAGD.')
+    parser.add_argument('agd_files', nargs='+', help='agd files to read')
+    parser.add_argument('-n', '--repeat', dest="repeat", type=int, default=3, help='Number of reads of each file')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    import pyActigraphy
+    warnings.simplefilter(action='ignore', category=UserWarning)
+
+    def best_time(read, fname):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            reader = read(fname)
+            times.append(time.perf_counter() - start)
+        return min(times), reader
+
+    print(f"{'file':40} {'epochs':>9} {'RawAGD [s]':>11} {'LeanAGD [s]':>12} {'speedup':>8} {'same data':>10}")
+    for agd_file in args.agd_files:
+        raw_time, raw_agd = best_time(pyActigraphy.io.agd.RawAGD, agd_file)
+        lean_time, lean_agd = best_time(LeanAGD, agd_file)
+        same = raw_agd.data.equals(lean_agd.data) and raw_agd.start_time == lean_agd.start_time
+        print(f"{os.path.basename(agd_file):40} {lean_agd.length():9d} {raw_time:11.3f} {lean_time:12.3f} "
+              f"{raw_time / lean_time:8.1f} {str(same):>10}")
@@ -0,0 +1,147 @@
+import os
+import json
+from urllib.parse import quote
+
+import numpy as np
+
+from agd_reader import LeanAGD, read_agd_arrays, TICKS_AT_UNIX_EPOCH
+
+INDEX_FILE = 'subjects.parquet'
+DATA_FILE = 'part-0.arrow'
+
+# settings kept from the agd files, the subject name is the (possibly renamed) display name
+STORED_SETTINGS = ['subjectname', 'deviceserial', 'epochlength', 'startdatetime']
+
+
+def downcast_counts(counts):
+    """
+    Smallest unsigned integer type holding all counts, uint16 for regular actigraphy counts.
+    """
+    for dtype in (np.uint16, np.uint32):
+        if counts.size == 0 or (counts.min() >= 0 and counts.max() <= np.iinfo(dtype).max):
+            return counts.astype(dtype)
+    return counts
+
+
+def subject_data_file(store, subject):
+    return os.path.join(store, f"subject={quote(str(subject), safe='')}", DATA_FILE)
+
+
+def convert_agd_file(agd_file, store, subject=None):
+    """
+    Writes the timestamps (int64 ns since the unix epoch) and downcast axis counts of an agd file to an uncompressed
+    Arrow IPC file in the subject partition of the store, so that it can be memory-mapped. Returns the index row of
+    the subject.
+    """
+    import pyarrow as pa
+
+    settings, timestamps, counts = read_agd_arrays(agd_file)
+    settings = {name: settings[name] for name in STORED_SETTINGS if name in settings}
+    if subject is not None:
+        settings['subjectname'] = subject
+    subject = settings['subjectname']
+
+    counts = downcast_counts(counts)
+    table = pa.table({
+        'timestamp': timestamps.view(np.int64),
+        'axis1': counts[:, 0],
+        'axis2': counts[:, 1],
+        'axis3': counts[:, 2],
+    })
+    table = table.replace_schema_metadata({'settings': json.dumps(settings), 'source': os.path.abspath(agd_file)})
+
+    data_file = subject_data_file(store, subject)
+    os.makedirs(os.path.dirname(data_file), exist_ok=True)
+    with pa.OSFile(data_file, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    start = (int(settings['startdatetime']) - TICKS_AT_UNIX_EPOCH) * 100
+    return {'subject': subject, 'path': os.path.relpath(data_file, store), 'source': os.path.abspath(agd_file),
+            'start_time': np.datetime64(start, 'ns'), 'epoch_length': int(settings['epochlength']),
+            'epochs': len(table)}
+
+
+def convert_agd_files(agd_files, store, subjects=None, n_jobs=None):
+    """
+    Converts all agd files into the store and writes the subject index. subjects optionally gives the subject name
+    of each file, otherwise the subject names of the agd files are used. Subjects already in the store are replaced.
+    Defective agd files are skipped.
+    """
+    import sqlite3
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+
+    subjects = subjects or [None] * len(agd_files)
+    os.makedirs(store, exist_ok=True)
+
+    def report(agd_file, error):
+        print(f"Could not convert agd file {agd_file}: {error}")
+
+    rows = []
+    if n_jobs == 1:
+        for agd_file, subject in zip(agd_files, subjects):
+            try:
+                rows.append(convert_agd_file(agd_file, store, subject))
+            except sqlite3.DatabaseError as error:
+                report(agd_file, error)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(convert_agd_file, agd_file, store, subject)
+                       for agd_file, subject in zip(agd_files, subjects)]
+            for agd_file, future in zip(agd_files, futures):
+                try:
+                    rows.append(future.result())
+                except sqlite3.DatabaseError as error:
+                    report(agd_file, error)
+
+    index = pd.DataFrame(rows, columns=['subject', 'path', 'source', 'start_time', 'epoch_length', 'epochs'])
+    index_file = os.path.join(store, INDEX_FILE)
+    if os.path.exists(index_file):
+        previous = pd.read_parquet(index_file)
+        index = pd.concat([previous[~previous.subject.isin(index.subject)], index], ignore_index=True)
+    index.sort_values(by='subject').to_parquet(index_file, index=False)
+    return index
+
+
+def read_store_index(store):
+    import pandas as pd
+    return pd.read_parquet(os.path.join(store, INDEX_FILE))
+
+
+def stored_data_files(store):
+    """
+    Data files of all subjects of the store.
+    """
+    return [os.path.join(store, path) for path in read_store_index(store).path]
+
+
+def read_stored_table(data_file):
+    """
+    Memory-maps a subject data file. The returned table references the mapped file, its columns are not copied.
+    """
+    import pyarrow as pa
+    return pa.ipc.open_file(pa.memory_map(data_file, 'r')).read_all()
+
+
+def stored_settings(data_file):
+    import pyarrow as pa
+    schema = pa.ipc.open_file(pa.memory_map(data_file, 'r')).schema
+    return json.loads(schema.metadata[b'settings'])
+
+
+def _column(table, name):
+    # a single chunk is converted without copying the mapped data
+    column = table.column(name)
+    return column.chunk(0).to_numpy() if column.num_chunks == 1 else column.to_numpy()
+
+
+def read_stored_agd(data_file):
+    """
+    Reads a subject of the store as LeanAGD, which can be used by summary() like an agd file reader.
+    """
+    table = read_stored_table(data_file)
+    settings = json.loads(table.schema.metadata[b'settings'])
+    timestamps = _column(table, 'timestamp').view('datetime64[ns]')
+    counts = np.column_stack([_column(table, axis) for axis in ('axis1', 'axis2', 'axis3')])
+    return LeanAGD(data_file, settings, timestamps, counts)
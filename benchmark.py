@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+from datetime import datetime
+
+
+# startup time budgets in seconds of cli.py commands, each run in a fresh interpreter
+STARTUP_BUDGETS = {
+    '-h': 0.3,
+    'subject -h': 0.3,
+    'crawl -h': 0.3,
+    'acti -h': 2.0,
+    'reports -h': 0.3,
+}
+
+# modules that must not be imported by importing a module, as they are slow to import and not always needed
+DEFERRED_IMPORTS = {
+    'cli': ['pandas', 'numpy'],
+    'crawl_files': ['pandas', 'numpy'],
+    'actigraphy_batch': ['pyActigraphy'],
+    'read_reports': ['pandas', 'numpy', 'chardet', 'pyActigraphy'],
+    'output_writers': ['pandas', 'numpy'],
+    'wear_times': ['pyActigraphy'],
+}
+
+# modules that must not be imported by running a cli.py command
+DEFERRED_COMMAND_IMPORTS = {
+    '-h': ['pandas', 'numpy', 'pyActigraphy'],
+    'subject -h': ['pandas', 'numpy', 'pyActigraphy'],
+    'crawl -h': ['pandas', 'numpy', 'pyActigraphy'],
+    'acti -h': ['pyActigraphy'],
+    'reports -h': ['pandas', 'numpy', 'chardet', 'pyActigraphy'],
+}
+
+
+def timings(function, repeat):
+    # the untimed first run pays for lazy imports and warms the file system cache
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_cohort(folder, repeat=3, n_jobs=1, formats=('csv', 'xlsx', 'html', 'parquet', 'feather')):
+    """
+    Times the stages of both scripts on the subjects of a search folder. Each stage processes all subjects and is
+    repeated repeat times. Returns a dict mapping each stage to its times in seconds.
+    """
+    import tempfile
+    import crawl_files
+    from actigraphy_batch import (search_folder_pattern, read_agd, read_agd_files, get_wear_time_mask, summary,
+                                  summary_table)
+    from wear_times import read_wear_times, wear_time_intervals_by_subject
+    from read_reports import parse_header, read_data
+    from output_writers import write_outputs
+
+    groups_map = crawl_files.search_folder(folder)
+    agd_files = sorted(item['agd_file'] for item in groups_map.values() if item['agd_file'])
+    wear_files = sorted(item['wear_time'] for item in groups_map.values() if item['wear_time'])
+    reports_files = sorted(item['sleep_report'] for item in groups_map.values() if item['sleep_report'])
+    pattern = search_folder_pattern(folder)
+
+    results = {}
+    results['read_agd_files'] = timings(lambda: read_agd_files(agd_files, pattern, n_jobs), repeat)
+    results['read_agd (lean)'] = timings(lambda: [read_agd(agd_file, pattern, lean=True) for agd_file in agd_files],
+                                         repeat)
+    readers = [read_agd(agd_file, pattern, lean=True) for agd_file in agd_files]
+
+    results['read_wear_times'] = timings(lambda: read_wear_times(wear_files, pattern), repeat)
+    wear_time_intervals = wear_time_intervals_by_subject(read_wear_times(wear_files, pattern))
+
+    results['get_wear_time_mask'] = timings(
+        lambda: [get_wear_time_mask(reader, wear_time_intervals) for reader in readers], repeat)
+    for reader in readers:
+        reader.mask = get_wear_time_mask(reader, wear_time_intervals)
+        reader.mask_inactivity = reader.mask is not None
+
+    results['summary'] = timings(lambda: [summary(reader, reader.mask_inactivity) for reader in readers], repeat)
+    data = summary_table([summary(reader, reader.mask_inactivity) for reader in readers])
+
+    results['parse_header'] = timings(lambda: [parse_header(report_file) for report_file in reports_files], repeat)
+    headers = [parse_header(report_file) for report_file in reports_files]
+    results['read_data'] = timings(
+        lambda: [read_data(report_file, header_lines, charenc)
+                 for report_file, (_, header_lines, charenc) in zip(reports_files, headers)], repeat)
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        output = os.path.join(output_folder, 'summary')
+        for output_format in formats:
+            results[f'write {output_format}'] = timings(lambda: write_outputs({output: data}, [output_format]),
+                                                        repeat)
+
+    return results
+
+
+def startup_times(repeat=3, commands=None):
+    """
+    Times the startup of the cli.py commands (default: those of STARTUP_BUDGETS), each in a fresh interpreter. Returns
+    a dict mapping each command to its times in seconds.
+    """
+    import subprocess
+
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    results = {}
+    for command in commands or STARTUP_BUDGETS:
+        def run():
+            subprocess.run([sys.executable, cli] + command.split(), stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=True)
+        results[command] = timings(run, repeat)
+    return results
+
+
+def deferred_import_violations():
+    """
+    Imports each module of DEFERRED_IMPORTS in a fresh interpreter. Returns the (module, imported module) pairs of
+    modules that were imported although they should be deferred.
+    """
+    import subprocess
+
+    violations = []
+    for module, deferred in DEFERRED_IMPORTS.items():
+        imported = subprocess.run([sys.executable, '-c', f'import sys, {module}; print(" ".join(sys.modules))'],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                  check=True).stdout.split()
+        violations += [(module, name) for name in deferred if name in imported]
+    return violations
+
+
+def command_import_violations():
+    """
+    Runs each cli.py command of DEFERRED_COMMAND_IMPORTS with -X importtime. Returns the (command, imported module)
+    pairs of modules that were imported although they should be deferred.
+    """
+    import subprocess
+
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    violations = []
+    for command, deferred in DEFERRED_COMMAND_IMPORTS.items():
+        # importtime reports each import on stderr as "import time: <self> | <cumulative> | <indented module name>"
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', cli] + command.split(), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True, check=True).stderr
+        imported = {line.rsplit('|', 1)[-1].strip() for line in stderr.splitlines() if line.startswith('import time:')}
+        violations += [(command, name) for name in deferred if name in imported]
+    return violations
+
+
+def check_startup(repeat=3):
+    """
+    Prints the best startup time of each cli.py command and its budget. Returns the number of commands over their
+    budget and of deferred modules that are imported.
+    """
+    failures = 0
+    print(f"{'command':24} {'best [s]':>10} {'budget [s]':>11}")
+    for command, times in startup_times(repeat).items():
+        over = min(times) > STARTUP_BUDGETS[command]
+        failures += over
+        print(f"{'cli.py ' + command:24} {min(times):10.3f} {STARTUP_BUDGETS[command]:11.1f}"
+              f"{'  over budget' if over else ''}")
+
+    for module, name in deferred_import_violations():
+        failures += 1
+        print(f"import {module} imports {name}, which should be imported when needed")
+    for command, name in command_import_violations():
+        failures += 1
+        print(f"cli.py {command} imports {name}, which should be imported when needed")
+    return failures
+
+
+def environment():
+    import numpy
+    import pandas
+    return {'python': platform.python_version(), 'numpy': numpy.__version__, 'pandas': pandas.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the best times of the results relative to the baseline results. Returns the (stage, subjects) of all
+    stages that are slower than the baseline by more than the tolerance.
+    """
+    baseline_times = {(entry['stage'], entry['subjects']): entry['best'] for entry in baseline['results']}
+    regressions = []
+    print(f"{'stage':24} {'subjects':>8} {'baseline [s]':>13} {'now [s]':>10} {'ratio':>7}")
+    for entry in results:
+        key = (entry['stage'], entry['subjects'])
+        if key not in baseline_times:
+            continue
+        ratio = entry['best'] / baseline_times[key]
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(key)
+        print(f"{entry['stage']:24} {entry['subjects']:8d} {baseline_times[key]:13.4f} {entry['best']:10.4f} "
+              f"{ratio:7.2f}{'  slower' if slower else ''}")
+    return regressions
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import tempfile
+    import warnings
+    from synthetic_data import write_cohort
+
+    parser = argparse.ArgumentParser(
+        description='Times the stages of actigraphy_batch.py and read_reports.py on synthetic cohorts of different '
+                    'sizes and saves the times as json, optionally compared with the times of an earlier run.')
+
+    parser.add_argument('-n', '--subjects', dest="subjects", type=int, nargs='+', default=[4, 16],
+                        help='Cohort sizes, default: 4 16')
+    parser.add_argument('--weeks', dest="weeks", type=float, default=1, help='Weeks of recording per subject')
+    parser.add_argument('--epoch', dest="epoch", type=int, default=60, help='Epoch length in seconds')
+    parser.add_argument('--gaps-per-week', dest="gaps_per_week", type=float, default=2,
+                        help='Average number of non-wear gaps per week')
+    parser.add_argument('-r', '--repeat', dest="repeat", type=int, default=3,
+                        help='Number of runs of each stage, the best time is compared')
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=1,
+                        help='Number of jobs of read_agd_files')
+    parser.add_argument('-o', '--output', dest="output", default=None,
+                        help='Json file for the results. Default is benchmark-<date>.json')
+    parser.add_argument('--compare', dest="baseline", default=None,
+                        help='Json file of an earlier run to compare the results with')
+    parser.add_argument('--tolerance', dest="tolerance", type=float, default=0.1,
+                        help='Relative slowdown against the baseline that is reported as regression, default: 0.1')
+    parser.add_argument('--startup', dest="startup", action='store_true',
+                        help='Only check the startup times of the cli.py commands against their budgets and that slow '
+                             'modules are imported when needed, exits with 1 on failures')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.startup:
+        failures = check_startup(args.repeat)
+        sys.exit(1 if failures else 0)
+    warnings.simplefilter(action='ignore', category=UserWarning)
+
+    results = []
+    for n_subjects in args.subjects:
+        with tempfile.TemporaryDirectory() as folder:
+            print(f"Writing {n_subjects} synthetic subjects...")
+            write_cohort(folder, n_subjects, args.weeks, args.epoch, args.gaps_per_week)
+            print(f"Timing {n_subjects} subjects...")
+            for stage, times in benchmark_cohort(folder, args.repeat, args.jobs).items():
+                results.append({'stage': stage, 'subjects': n_subjects, 'times': times, 'best': min(times),
+                                'median': statistics.median(times)})
+                print(f"{stage:24} {n_subjects:8d} {min(times):10.4f} s")
+
+    output = args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as file:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'environment': environment(),
+                   'parameters': {'weeks': args.weeks, 'epoch': args.epoch, 'gaps_per_week': args.gaps_per_week,
+                                  'repeat': args.repeat, 'jobs': args.jobs},
+                   'results': results}, file, indent=2)
+    print(f"Saved the results to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stages are slower than the baseline")
+            sys.exit(1)
@@ -0,0 +1,108 @@
+import os
+import sys
+
+# subcommands running a script, the script is only imported when its subcommand is run
+COMMANDS = {
+    'acti': ('actigraphy_batch', 'Summaries of agd files and their averages (actigraphy_batch.py)'),
+    'reports': ('read_reports', 'Averages of the sleep reports (read_reports.py)'),
+    'crawl': ('crawl_files', 'Searches the files of the subject sub-folders (crawl_files.py)'),
+    'watch': ('watch_folder', 'Keeps the outputs of a search folder up to date (watch_folder.py)'),
+    'sst': ('generate_sst_log', 'SST logs from wear time files (generate_sst_log.py)'),
+    'synthetic': ('synthetic_data', 'Writes synthetic subjects (synthetic_data.py)'),
+    'benchmark': ('benchmark', 'Times the stages of both scripts (benchmark.py)'),
+    'results': ('results_db', 'Queries the results database of both scripts (results_db.py)'),
+}
+
+
+def run_script(module, argv):
+    """
+    Runs a script with the arguments argv as if it was started directly.
+    """
+    import runpy
+    sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{module}.py")] + argv
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def subject(argv):
+    """
+    Fast path for a single subject: summarizes one agd file with the lean reader, which does not need pyActigraphy,
+    and appends the summary to a result log. The logs of many subjects are combined with "actigraphy_batch.py merge".
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='cli.py subject',
+                                     description='Summarizes a single agd file and appends the summary to a result '
+                                                 'log, e.g. for single subject jobs of a scheduler. Combine the logs '
+                                                 'with "cli.py acti merge".')
+    parser.add_argument('agd_file', help='The agd file (or data file of an agd store) of the subject')
+    parser.add_argument('-w', '--wear_times_file', dest="wear_times_file",
+                        help='The wear time validation details file.')
+    parser.add_argument('--subject-filename-pattern', dest="subject_filename_pattern",
+                        help='If set, the the subject name will be taken from the file name following this regex pattern')
+    parser.add_argument('-o', '--result-log', dest="result_log", required=True,
+                        help='Result log the summary is appended to, a subject already in the log is skipped')
+    parser.add_argument('--lx', dest="lx_hours", type=float, nargs='+', default=[],
+                        help='Additional window lengths in hours of the least active periods (Lx), e.g. --lx 3 7')
+    parser.add_argument('--mx', dest="mx_hours", type=float, nargs='+', default=[],
+                        help='Additional window lengths in hours of the most active periods (Mx), e.g. --mx 6 12')
+
+    args = parser.parse_args(argv)
+
+    if any(not 0 < hours <= 24 for hours in args.lx_hours + args.mx_hours):
+        parser.error('Lx/Mx window lengths must be between 0 and 24 hours')
+    for fname in filter(None, [args.agd_file, args.wear_times_file]):
+        if not os.path.exists(fname):
+            parser.error(f'{fname} does not exist!')
+
+    import re
+    from actigraphy_batch import PIPELINE_VERSION, process_subject
+    from result_log import ResultLog
+
+    summary_kwargs = {'lx_hours': tuple(args.lx_hours), 'mx_hours': tuple(args.mx_hours)}
+    fname_pattern = re.compile(args.subject_filename_pattern) if args.subject_filename_pattern else None
+
+    # the same header for all subjects, so that merge accepts their logs
+    result_log = ResultLog(args.result_log, {'pipeline_version': PIPELINE_VERSION, 'summary_kwargs': summary_kwargs,
+                                             'lean_reader': True, 'wear_times': None}, resume=True)
+    if args.agd_file in result_log.done:
+        print(f'{args.agd_file} is already in {args.result_log}')
+        result_log.close()
+        return
+
+    wear_time_intervals = None
+    if args.wear_times_file:
+        from wear_times import read_wear_time_intervals
+        # the subjects of the wear times are resolved like in the batch, see compute_summary_and_averages
+        wear_time_intervals = read_wear_time_intervals(args.wear_times_file, fname_pattern)
+
+    subject_summary = process_subject(args.agd_file, wear_time_intervals, fname_pattern, summary_kwargs)
+    if subject_summary is not None:
+        result_log.append(args.agd_file, subject_summary)
+        print(f'Appended the summary of {subject_summary["subject"]} to {args.result_log}')
+    result_log.close()
+    if subject_summary is None:
+        sys.exit(1)
+
+
+def usage():
+    lines = ['usage: cli.py <command> [arguments]', '', 'commands:']
+    lines += [f'  {command:10} {description}' for command, (_, description) in COMMANDS.items()]
+    lines += [f'  {"subject":10} Summarizes a single agd file into a result log, without loading pyActigraphy', '',
+              'Use "cli.py <command> -h" for the arguments of a command.']
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print(usage())
+        sys.exit(0 if len(sys.argv) >= 2 else 2)
+
+    command, argv = sys.argv[1], sys.argv[2:]
+    if command == 'subject':
+        subject(argv)
+    elif command in COMMANDS:
+        run_script(COMMANDS[command][0], argv)
+    else:
+        print(f'cli.py: unknown command {command!r}\n\n{usage()}')
+        sys.exit(2)
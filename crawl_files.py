@@ -1,42 +1,161 @@
 import os
-import glob
 import json
-
-
-def search_file(wildcard):
-    file_list = glob.glob(wildcard)
-    file = file_list[0] if len(file_list) > 0 else None
-    if not file:
-        print(wildcard)
-    return file
+import time
+import fnmatch
+
+DEFAULT_MANIFEST_DIR = os.path.join(os.path.expanduser("~"), ".cache", "actigraphy", "manifests")
+MANIFEST_VERSION = 1
+
+# listings of directories modified shortly before they were scanned are not reused, further changes within the
+# timestamp resolution of the file system would not change their mtime
+RACY_MTIME_NS = 2 * 10 ** 9
+
+
+def default_manifest_file(folder):
+    from summary_cache import bytes_hash
+    return os.path.join(DEFAULT_MANIFEST_DIR, bytes_hash(os.path.abspath(folder).encode()) + ".json")
+
+
+def read_manifest(manifest_file, folder):
+    """
+    Directory listings of a previous search of the folder, empty if there is no (valid) manifest.
+    """
+    try:
+        with open(manifest_file) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('folder') != os.path.abspath(folder):
+        return {}
+    return manifest['dirs']
+
+
+def write_manifest(manifest_file, folder, dirs):
+    from pathlib import Path
+    Path(manifest_file).parent.mkdir(parents=True, exist_ok=True)
+    manifest = {'version': MANIFEST_VERSION, 'folder': os.path.abspath(folder), 'dirs': dirs}
+    temp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(temp_file, manifest_file)
+
+
+def pattern_components(pattern):
+    return [component for component in pattern.split('/') if component]
+
+
+def matches(name, component):
+    # like glob, wildcards do not match hidden files
+    if name.startswith('.') and not component.startswith('.'):
+        return False
+    return fnmatch.fnmatch(name, component)
+
+
+def list_dir(path, key, cached_dirs, dirs):
+    """
+    Sub-directories and files (with size and mtime) of a directory. The listing of the manifest is reused if the mtime
+    of the directory did not change since it was scanned. The listing is stored under key in dirs.
+    """
+    if key in dirs:
+        return dirs[key]
+
+    mtime_ns = os.stat(path).st_mtime_ns
+    cached = cached_dirs.get(key)
+    if cached and cached['mtime_ns'] == mtime_ns and cached['scanned_ns'] - mtime_ns > RACY_MTIME_NS:
+        dirs[key] = cached
+        return cached
+
+    scanned_ns = time.time_ns()
+    subdirs, files = [], {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+
+    dirs[key] = listing = {'mtime_ns': mtime_ns, 'scanned_ns': scanned_ns, 'dirs': sorted(subdirs), 'files': files}
+    return listing
+
+
+def find_files(path, key, components, cached_dirs, dirs):
+    """
+    Files below path matching the pattern components (one per directory level), as paths relative to path.
+    """
+    listing = list_dir(path, key, cached_dirs, dirs)
+    if len(components) == 1:
+        return [name for name in sorted(listing['files']) if matches(name, components[0])]
+
+    found = []
+    for subdir in listing['dirs']:
+        if matches(subdir, components[0]):
+            found += [subdir + '/' + name for name in
+                      find_files(path + '/' + subdir, key + '/' + subdir, components[1:], cached_dirs, dirs)]
+    return found
+
+
+def search_subfolder(folder, item, patterns, cached_dirs):
+    # each subfolder is listed only once for all patterns, the first matching file (in name order) is taken
+    subfolder = folder + "/" + item
+    dirs = {}
+    files = {}
+    stats = {}
+    for kind, pattern in patterns.items():
+        found = find_files(subfolder, item, pattern_components(pattern), cached_dirs, dirs)
+        files[kind] = subfolder + "/" + found[0] if found else None
+        if found:
+            directory, _, name = (item + "/" + found[0]).rpartition("/")
+            stats[files[kind]] = dirs[directory]['files'][name]
+        else:
+            print(subfolder + pattern)
+    return files, dirs, stats
 
 
 def search_folder(folder,
                   agd_search_pattern='/*.agd',
                   reports_search_pattern='/*sleep-report.csv',
-                  wear_times_search_pattern='/*/*WearTimeValidationDetails.csv'):
-    items = os.listdir(folder)
-    group_map = {}
+                  wear_times_search_pattern='/*/*WearTimeValidationDetails.csv',
+                  manifest_file=None,
+                  n_jobs=None,
+                  file_stats=None):
+    """
+    Searches the agd file, sleep report and wear times file in each sub-folder of folder. The patterns are glob
+    patterns relative to the sub-folders. The sub-folders are searched in parallel by n_jobs threads (default: number
+    of cpus + 4, at most 32). If a manifest file is given, the directory listings are stored in it and only
+    directories whose mtime changed since the last search are listed again. If a file_stats dict is given, it is
+    filled with the size and mtime (ns) of each found file, as recorded when its directory was listed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    cached_dirs = read_manifest(manifest_file, folder) if manifest_file else {}
+    dirs = {}
+    items = list_dir(folder, '.', cached_dirs, dirs)['dirs']
+    patterns = {'agd_file': agd_search_pattern,
+                'sleep_report': reports_search_pattern,
+                'wear_time': wear_times_search_pattern}
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(lambda item: search_subfolder(folder, item, patterns, cached_dirs), items))
 
-    for item in items:
-        subfolder = folder + "/" + item
-        if os.path.isdir(subfolder):
-            agd_file = search_file(subfolder + agd_search_pattern)
-            sleep_report = search_file(subfolder + reports_search_pattern)
-            wear_times = search_file(subfolder + wear_times_search_pattern)
+    group_map = {}
+    for item, (files, subfolder_dirs, stats) in zip(items, results):
+        group_map[item] = files
+        dirs.update(subfolder_dirs)
+        if file_stats is not None:
+            file_stats.update(stats)
 
-            group_map[item] = {'agd_file': agd_file,
-                               'sleep_report': sleep_report,
-                               'wear_time': wear_times}
+        if files['agd_file'] is None:
+            print("agd file is None for", item)
 
-            if agd_file is None:
-                print("agd file is None for", item)
+        if files['sleep_report'] is None:
+            print("sleep report is None for", item)
 
-            if sleep_report is None:
-                print("sleep report is None for", item)
+        if files['wear_time'] is None:
+            print("wear times file is None for", item)
 
-            if wear_times is None:
-                print("wear times file is None for", item)
+    if manifest_file:
+        write_manifest(manifest_file, folder, dirs)
 
     return group_map
 
@@ -52,8 +171,16 @@ if __name__ == '__main__':
 
     parser.add_argument('-s', '--search-folder', dest="search_folder", required=True,
                         help='Folder containing sub-folders for each subject')
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=None,
+                        help='Number of threads searching the sub-folders')
+    parser.add_argument('--manifest', dest="manifest_file", default=None,
+                        help='File storing the directory listings, so that only changed directories are listed again. '
+                             'Default is a file in ~/.cache/actigraphy/manifests')
+    parser.add_argument('--no-manifest', dest="no_manifest", action='store_true',
+                        help='List all directories without using a manifest')
 
     args = parser.parse_args(sys.argv[1:])
 
-    group_map = search_folder(args.search_folder)
+    manifest_file = None if args.no_manifest else args.manifest_file or default_manifest_file(args.search_folder)
+    group_map = search_folder(args.search_folder, manifest_file=manifest_file, n_jobs=args.jobs)
     print(json.dumps(group_map, sort_keys=True, indent=4))
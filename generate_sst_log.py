@@ -1,22 +1,33 @@
 import os
-import pandas as pd
-from datetime import datetime
 
+from wear_times import read_wear_times
 
-def date_parser(dt):
-    return datetime.strptime(dt, "%d.%m.%Y %H:%M:%S")
 
+def sst_log(wear_times):
+    """
+    SST log table of pyActigraphy (Subject_id, Start_time, Stop_time, Remarks) of the wear time intervals.
+    """
+    log = wear_times.rename(columns={
+        "subject": "Subject_id",
+        "start": "Start_time",
+        "stop": "Stop_time",
+    })
+    log['Remarks'] = ""
+    return log.sort_values(by=['Subject_id'], kind='mergesort')
 
-def read_wear_times(wear_time_file):
-    fields = ["Subject", "Wear Time Start", "Wear Time End"]
 
-    with open(wear_time_file) as report:
+def search_folder_wear_times(search_folder, n_jobs=None):
+    """
+    Reads the wear time files of all subject sub-folders of a search folder, the sub-folder names are the subjects.
+    """
+    import crawl_files
 
-        data = pd.read_csv(report, delimiter=',', quotechar='"', decimal=",",
-                           date_parser=date_parser,
-                           parse_dates=["Wear Time Start", "Wear Time End"])
-
-        return data[fields]
+    manifest_file = crawl_files.default_manifest_file(search_folder)
+    groups_map = crawl_files.search_folder(search_folder, manifest_file=manifest_file)
+    subjects = sorted(subject for subject, files in groups_map.items() if files['wear_time'])
+    print(f'Found {len(subjects)} wear time files in {search_folder}')
+    return read_wear_times([groups_map[subject]['wear_time'] for subject in subjects], n_jobs=n_jobs,
+                           subjects=subjects)
 
 
 if __name__ == '__main__':
@@ -24,26 +35,45 @@ if __name__ == '__main__':
     import sys
     import argparse
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-w', '--wear_times_file', dest="wear_times_file",
-                        help='The wear time validation details file.', default="./Batchfiles_WearTimeValidationDetails.csv")
+    parser = argparse.ArgumentParser(description='Generates the SST log of pyActigraphy from wear time validation '
+                                                 'details files.')
+    two_options = parser.add_mutually_exclusive_group()
+    two_options.add_argument('-w', '--wear_times_file', dest="wear_times_file",
+                             help='The wear time validation details file.',
+                             default="./Batchfiles_WearTimeValidationDetails.csv")
+    two_options.add_argument('-s', '--search-folder', dest="search_folder",
+                             help='Folder containing sub-folders for each subject, the SST log is generated for the '
+                                  'wear time files of all subjects')
+    parser.add_argument('-o', '--output', dest="output", default="sstlog.csv",
+                        help='SST log file of all subjects, default: sstlog.csv')
+    parser.add_argument('--per-subject', dest="per_subject_folder", default=None,
+                        help='Folder to which an SST log <subject>_sstlog.csv is written for each subject in addition')
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=None,
+                        help='Number of threads reading the wear time files')
     args = parser.parse_args(sys.argv[1:])
 
-    wear_times_file = args.wear_times_file
-    if not os.path.exists(wear_times_file):
-        print('wear time validation details file "{}" does not exist!'.format(wear_times_file))
-        parser.print_help()
-        exit()
+    if args.search_folder:
+        if not os.path.isdir(args.search_folder):
+            print('search folder "{}" does not exist!'.format(args.search_folder))
+            parser.print_help()
+            exit()
+        wear_times = search_folder_wear_times(args.search_folder, args.jobs)
+
+    else:
+        wear_times_file = args.wear_times_file
+        if not os.path.exists(wear_times_file):
+            print('wear time validation details file "{}" does not exist!'.format(wear_times_file))
+            parser.print_help()
+            exit()
 
-    # read wear times
-    wear_times = read_wear_times(wear_times_file)
+        # read wear times
+        wear_times = read_wear_times(wear_times_file)
 
-    wear_times.rename(columns={
-        "Subject": "Subject_id",
-        "Wear Time Start": "Start_time",
-        "Wear Time End": "Stop_time",
-    }, inplace=True)
+    log = sst_log(wear_times)
+    log.to_csv(args.output, index=False)
+    print(f'Wrote the SST log of {log["Subject_id"].nunique()} subjects to {args.output}')
 
-    wear_times['Remarks'] = ""
-    wear_times.sort_values(by=['Subject_id'], inplace=True)
-    wear_times.to_csv("sstlog.csv", index=False)
+    if args.per_subject_folder:
+        os.makedirs(args.per_subject_folder, exist_ok=True)
+        for subject, subject_log in log.groupby('Subject_id', sort=False):
+            subject_log.to_csv(os.path.join(args.per_subject_folder, f"{subject}_sstlog.csv"), index=False)
@@ -0,0 +1,121 @@
+import math
+import numbers
+from datetime import datetime, date, time, timedelta
+
+from profiling import stage
+
+# pandas is imported by the writers, so that the formats can be imported without it, e.g. for the help of the scripts
+FORMATS = ['csv', 'xlsx', 'html', 'parquet', 'feather']
+DEFAULT_FORMATS = ['xlsx', 'csv', 'html']
+
+
+def _frame(table):
+    # Series (e.g. the averages) are written like pandas writes them to csv and excel, as a single column named 0
+    import pandas as pd
+    return table.to_frame() if isinstance(table, pd.Series) else table
+
+
+def write_csv(table, output):
+    table.to_csv(f"{output}.csv")
+
+
+def write_html(table, output):
+    with open(f"{output}.html", "w") as html_file:
+        html_file.write(_frame(table).to_html())
+
+
+def _excel_value(value):
+    # cells are written like DataFrame.to_excel writes them: times as text and durations as days
+    import pandas as pd
+
+    if value is None or isinstance(value, (str, bool, datetime, date)):
+        return value
+    if isinstance(value, time):
+        return str(value)
+    if isinstance(value, pd.Timestamp):
+        return None if pd.isna(value) else value.to_pydatetime()
+    if isinstance(value, (pd.Timedelta, timedelta)):
+        return None if pd.isna(value) else pd.Timedelta(value).total_seconds() / 86400
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return None if math.isnan(value) else float(value)
+    return str(value)
+
+
+def write_xlsx(table, output):
+    """
+    Writes the table with openpyxl's write-only workbook, which streams the rows into the file instead of building
+    the whole sheet with styled cells in memory like DataFrame.to_excel.
+    """
+    from openpyxl import Workbook
+
+    table = _frame(table)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Sheet1')
+
+    index_names = [name if name is not None else '' for name in table.index.names]
+    sheet.append(index_names + [_excel_value(column) for column in table.columns])
+    index_values = table.index.to_list()
+    for index_value, row in zip(index_values, table.itertuples(index=False, name=None)):
+        index_value = list(index_value) if isinstance(index_value, tuple) else [index_value]
+        sheet.append([_excel_value(value) for value in index_value + list(row)])
+
+    workbook.save(f"{output}.xlsx")
+
+
+def _arrow_table(table):
+    import pandas as pd
+    import pyarrow as pa
+
+    table = _frame(table).reset_index()
+    columns = {}
+    for column in table.columns:
+        try:
+            columns[str(column)] = pa.array(table[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # columns mixing types, e.g. numbers and times in the averages, are stored as text
+            columns[str(column)] = pa.array(table[column].map(lambda value: None if pd.isna(value) else str(value)))
+    return pa.table(columns)
+
+
+def write_parquet(table, output):
+    import pyarrow.parquet as pq
+    pq.write_table(_arrow_table(table), f"{output}.parquet")
+
+
+def write_feather(table, output):
+    import pyarrow.feather as feather
+    feather.write_feather(_arrow_table(table), f"{output}.feather")
+
+
+def _write(output_format, table, output):
+    with stage(f'write {output_format}', output):
+        WRITERS[output_format](table, output)
+
+
+WRITERS = {
+    'csv': write_csv,
+    'xlsx': write_xlsx,
+    'html': write_html,
+    'parquet': write_parquet,
+    'feather': write_feather,
+}
+
+
+def write_outputs(tables, formats=DEFAULT_FORMATS, n_jobs=None):
+    """
+    Writes each table (DataFrame or Series) of the dict output -> table to the files <output>.<format> of all
+    formats. The files are written concurrently by a pool of n_jobs threads.
+    """
+    from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor
+
+    for output in tables:
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(_write, output_format, table, output)
+                   for output, table in tables.items() for output_format in formats]
+        for future in futures:
+            future.result()
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+
+
+class _NoStage:
+    # stage of a process that is not profiled, the subject may be set but is not recorded
+    subject = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+# profiler of this process, None if profiling is off
+_profiler = None
+
+
+class Profiler:
+    """
+    Collects the stage events of one process. The events are appended to a part file of the process whenever an
+    outermost stage ends, as worker processes may end without running exit handlers. The memory allocations of the
+    process are traced with tracemalloc while it is profiled.
+    """
+
+    def __init__(self, parts_folder, cprofile_stage=None):
+        self.parts_folder = parts_folder
+        self.cprofile_stage = cprofile_stage
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.cprofile = None
+        os.makedirs(parts_folder, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+            if events:
+                with open(os.path.join(self.parts_folder, f"trace-{os.getpid()}.jsonl"), 'a') as file:
+                    file.writelines(json.dumps(event) + '\n' for event in events)
+            if self.cprofile is not None:
+                self.cprofile.dump_stats(os.path.join(self.parts_folder, f"cprofile-{os.getpid()}.prof"))
+
+
+class Stage:
+    """
+    Records the wall time and the peak memory of a stage as a Chrome trace event: the peak of the memory traced by
+    tracemalloc during the stage above the memory at its start. If it is the stage chosen for cProfile, it is also
+    profiled with cProfile. The subject may also be set in the stage, e.g. once it is read.
+    """
+
+    def __init__(self, profiler, name, subject=None):
+        self.profiler = profiler
+        self.name = name
+        self.subject = subject
+        self.profiling = False
+        # the highest peak of the stages within this stage, the traced peak is reset at the start of each stage
+        self.inner_peak = 0
+
+    def __enter__(self):
+        profiler = self.profiler
+        self.depth = getattr(profiler.local, 'depth', 0)
+        profiler.local.depth = self.depth + 1
+        self.outer = getattr(profiler.local, 'stage', None)
+        profiler.local.stage = self
+
+        if self.name == profiler.cprofile_stage and not getattr(profiler.local, 'cprofiling', False):
+            import cProfile
+            if profiler.cprofile is None:
+                profiler.cprofile = cProfile.Profile()
+            profiler.local.cprofiling = self.profiling = True
+            profiler.cprofile.enable()
+
+        current, peak = tracemalloc.get_traced_memory()
+        if self.outer is not None:
+            self.outer.inner_peak = max(self.outer.inner_peak, peak)
+        tracemalloc.reset_peak()
+        self.start_memory = current
+
+        self.timestamp = time.time_ns() // 1000
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = (time.perf_counter_ns() - self.start) / 1000
+        profiler = self.profiler
+        peak = max(tracemalloc.get_traced_memory()[1], self.inner_peak)
+
+        if self.profiling:
+            profiler.cprofile.disable()
+            profiler.local.cprofiling = False
+
+        args = {'peak_mb': round((peak - self.start_memory) / 2 ** 20, 1)}
+        if self.subject is not None:
+            args['subject'] = str(self.subject)
+        profiler.add({'name': self.name, 'cat': 'stage', 'ph': 'X', 'ts': self.timestamp, 'dur': duration,
+                      'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+        if self.outer is not None:
+            self.outer.inner_peak = max(self.outer.inner_peak, peak)
+        profiler.local.stage = self.outer
+        profiler.local.depth = self.depth
+        if self.depth == 0:
+            profiler.flush()
+        return False
+
+
+def stage(name, subject=None):
+    """
+    Context manager timing a stage of the processing of (optionally) a subject, it returns the stage so that the subject
+    can be set once it is known. Does nothing if profiling is off.
+    """
+    if _profiler is None:
+        return _NO_STAGE
+    return Stage(_profiler, name, subject)
+
+
+def enable(parts_folder, cprofile_stage=None):
+    global _profiler
+    _profiler = Profiler(parts_folder, cprofile_stage)
+
+
+def settings():
+    """
+    Profiling settings to pass on to worker processes, None if profiling is off.
+    """
+    return (_profiler.parts_folder, _profiler.cprofile_stage) if _profiler is not None else None
+
+
+def init_worker(profile_settings):
+    # a new profiler, a forked worker must not write the events it inherited from its parent
+    global _profiler
+    _profiler = None
+    if profile_settings is not None:
+        enable(*profile_settings)
+
+
+def start(trace_file, cprofile_stage=None):
+    """
+    Starts profiling this process and the worker processes started with init_worker. The events are collected in the
+    folder <trace_file>.parts until finish() merges them.
+    """
+    import shutil
+    parts_folder = f"{trace_file}.parts"
+    shutil.rmtree(parts_folder, ignore_errors=True)
+    enable(parts_folder, cprofile_stage)
+
+
+def finish(trace_file):
+    """
+    Merges the events of all processes into a Chrome trace file (to be opened with chrome://tracing or Perfetto)
+    and the cProfile statistics into <trace_file>.prof, and prints the total time of each stage.
+    """
+    import glob
+    import shutil
+    global _profiler
+
+    if _profiler is None:
+        return
+    _profiler.flush()
+    parts_folder = _profiler.parts_folder
+    _profiler = None
+    tracemalloc.stop()
+
+    events = []
+    for part_file in sorted(glob.glob(os.path.join(parts_folder, "trace-*.jsonl"))):
+        with open(part_file) as file:
+            events += [json.loads(line) for line in file]
+    events.sort(key=lambda event: event['ts'])
+
+    from pathlib import Path
+    Path(trace_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(trace_file, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+    cprofile_files = sorted(glob.glob(os.path.join(parts_folder, "cprofile-*.prof")))
+    if cprofile_files:
+        import pstats
+        pstats.Stats(*cprofile_files).dump_stats(f"{trace_file}.prof")
+        print(f"Wrote the cProfile statistics to {trace_file}.prof")
+
+    shutil.rmtree(parts_folder, ignore_errors=True)
+    print_stage_totals(events)
+    print(f"Wrote the trace to {trace_file}")
+
+
+def print_stage_totals(events):
+    totals = {}
+    for event in events:
+        count, duration, peak = totals.get(event['name'], (0, 0., 0.))
+        totals[event['name']] = (count + 1, duration + event['dur'],
+                                 max(peak, event['args'].get('peak_mb', 0.)))
+
+    # the peak memory is the highest peak of the stage's events, each above the memory at the start of the event
+    print(f"{'stage':24} {'count':>7} {'total [s]':>10} {'peak memory [MB]':>17}")
+    for name, (count, duration, peak) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print(f"{name:24} {count:7d} {duration / 1e6:10.3f} {peak:17.1f}")
@@ -3,79 +3,136 @@ import os
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-import chardet
-import pandas as pd
-import datetime
+import codecs
+import io
 import re
 
+# pandas and the modules depending on it are imported when needed, so that e.g. -h starts fast
+from output_writers import FORMATS, DEFAULT_FORMATS
+from profiling import stage
+
 subject_pattern = re.compile("Subject Name: (.+)")
 header_line_pattern = re.compile("In Bed Date")
 
+DATE_FORMAT = "%d.%m.%Y %H:%M"
+DATE_COLUMNS = ['In Bed', 'Out Bed', 'Onset']
+
+
+def detect_encoding(rawdata):
+    """
+    Encoding of the raw report data. Files starting with a BOM, UTF-16 files without BOM and valid UTF-8 (or ASCII)
+    files are recognized directly, chardet is only used for the remaining files, e.g. cp1252 encoded ones.
+    """
+    if rawdata.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if rawdata.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    sample = rawdata[:4096]
+    if b'\x00' in sample:
+        # NUL bytes are valid UTF-8, but text has none. In UTF-16 without BOM they are the high bytes of the ASCII
+        # characters, at the odd positions in little endian and at the even positions in big endian.
+        zeros_even, zeros_odd = sample[0::2].count(0), sample[1::2].count(0)
+        if zeros_odd > zeros_even:
+            return 'utf-16-le'
+        if zeros_even > zeros_odd:
+            return 'utf-16-be'
+        import chardet
+        return chardet.detect(rawdata[:100000])['encoding']
+    try:
+        rawdata.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        import chardet
+        return chardet.detect(rawdata[:100000])['encoding']
+
+
+def decode_report(rawdata, charenc=None):
+    charenc = charenc or detect_encoding(rawdata)
+    text = rawdata.decode(charenc, errors='ignore')
+    # translate line endings like reading the file in text mode
+    return text.replace('\r\n', '\n').replace('\r', '\n'), charenc
+
+
+def find_header(text):
+    """
+    Finds the subject name and the column header line ("In Bed Date") in the report text. Returns the subject, the
+    offset of the header line in the text and the number of lines before it, or -1 if there is no header line.
+    """
+    found_header_line = header_line_pattern.search(text)
+    if not found_header_line:
+        found_subject = subject_pattern.findall(text)
+        return (found_subject[-1] if found_subject else None), -1, -1
+
+    offset = text.rfind('\n', 0, found_header_line.start()) + 1
+    found_subject = subject_pattern.findall(text, 0, offset)
+    return (found_subject[-1] if found_subject else None), offset, text.count('\n', 0, offset)
 
-def parse_header(report_file):
-    subject = None
-    header_lines = -1
 
-    # print(f"Try to open {report_file}")
+def parse_header(report_file):
     with open(report_file, 'rb') as rawdata:
-        result = chardet.detect(rawdata.read(100000))
-    charenc = result['encoding']
-    # print(charenc)
+        text, charenc = decode_report(rawdata.read())
 
-    with open(report_file, 'r', encoding=charenc) as report:
+    subject, _, line = find_header(text)
+    header_lines = line - 1 if line >= 0 else -1
 
-        i = 0
-        for line in report:
-            found_subject = re.findall(subject_pattern, line)
-            if found_subject:
-                subject = found_subject[0]
+    # print("Subject {}, header lines {}".format(subject, header_lines))
+    return subject, header_lines, charenc
 
-            found_header_line = re.findall(header_line_pattern, line)
-            if found_header_line:
-                header_lines = i - 1
-                break
-            i += 1
 
-        # print("Subject {}, header lines {}".format(subject, header_lines))
-    return subject, header_lines, charenc
+def combine_date_columns(data):
+    """
+    Combines the date and time columns of in bed, out bed and onset into datetime columns in front of the other ones.
+    """
+    import pandas as pd
 
+    dates = pd.DataFrame({
+        name: pd.to_datetime(data.pop(f'{name} Date') + ' ' + data.pop(f'{name} Time'), format=DATE_FORMAT)
+        for name in DATE_COLUMNS
+    })
+    return pd.concat([dates, data], axis=1)
 
-def compute_mid_point_of_sleep(row):
-    row['MPOS'] = row['Onset'] + pd.Timedelta(minutes=row["TST"] / 2)
-    return row
 
+def read_csv_text(text, header):
+    import pandas as pd
 
-def read_data(report_file, header_lines, charenc):
-    date_parser = lambda date, time: pd.datetime.strptime(f"{date} {time}", "%d.%m.%Y %H:%M")
+    data = pd.read_csv(io.StringIO(text), delimiter=',', quotechar='"', decimal=",", header=header)
+    return combine_date_columns(data)
+
+
+def read_report(report_file):
+    """
+    Reads a report in a single pass: the file is read once, decoded, and the part from the column header line on is
+    parsed by the C csv parser. Returns the subject name from the report header, the data and the encoding.
+    """
+    with open(report_file, 'rb') as rawdata:
+        text, charenc = decode_report(rawdata.read())
+
+    subject, offset, _ = find_header(text)
+    if offset < 0:
+        raise ValueError(f"Could not find the header line in {report_file}")
 
-    with open(report_file, 'r', encoding=charenc) as report:
-        data = pd.read_csv(report, engine='python', encoding=charenc, encoding_errors='ignore',
-                           delimiter=',', quotechar='"', decimal=",",
-                           header=header_lines,
-                           parse_dates={'In Bed': ['In Bed Date', 'In Bed Time'],
-                                        'Out Bed': ['Out Bed Date', 'Out Bed Time'],
-                                        'Onset': ['Onset Date', 'Onset Time']},
-                           date_parser=date_parser)
+    return subject, read_csv_text(text[offset:], header=0), charenc
 
-        return data
 
+def compute_mid_point_of_sleep(data):
+    from time_stats import mid_point_of_sleep
 
-def average_time_48(datetimes, pivot=14):
-    times = [dt.time() if type(dt) is datetime else dt for dt in datetimes]
-    minutes = sum(
-        (int(t.minute) + int(t.hour) * 60) if t.hour > pivot else (int(t.minute) + int(t.hour + 24) * 60) for t in
-        times)
-    average = minutes / len(times)
-    day = 24 * 60
-    average = average if average < day else average - day
-    h, m = divmod(average, 60)
-    return datetime.time(hour=int(h), minute=int(m), second=0)
+    data['MPOS'] = mid_point_of_sleep(data['Onset'], data['TST'])
+    return data
+
+
+def read_data(report_file, header_lines, charenc):
+    with open(report_file, 'rb') as rawdata:
+        text, _ = decode_report(rawdata.read(), charenc)
+
+    return read_csv_text(text, header_lines)
 
 
 def compute_time_averages(data, time_names=None, pivot=14):
     # time_names = ['In Bed', 'Onset', 'MPOS', 'Out Bed']
 
     from numpy import datetime64
+    from time_stats import average_times_48
 
     if time_names is None:
         time_names = []
@@ -84,30 +141,12 @@ def compute_time_averages(data, time_names=None, pivot=14):
             if dtype is datetime64:
                 time_names.append(column)
 
-    time_averages = pd.Series()
-
-    for column_name in time_names:
-        time_data = data[column_name]
-        time_averages[column_name] = average_time_48(time_data.array, pivot)
+    time_averages = average_times_48(data, time_names, pivot)
 
     print("averages", time_averages)
     return time_averages
 
 
-def compute_averages(data):
-    normal_data_averages = data.mean(numeric_only=True)
-    normal_data_averages['TBT'] = (pd.datetime.min + pd.Timedelta(minutes=int(normal_data_averages['TBT']))).time()
-    normal_data_averages['TST'] = (pd.datetime.min + pd.Timedelta(minutes=int(normal_data_averages['TST']))).time()
-
-    # normal_data_averages['TST'] = pd.to_datetime(normal_data_averages['TST']).dt.floor('T').time()
-
-    time_names = ['In Bed', 'Onset', 'MPOS', 'Out Bed']
-    time_data_averages = compute_time_averages(data, time_names)
-    averages = pd.concat([normal_data_averages, time_data_averages])
-
-    return averages
-
-
 def combine_same_days(data):
     out_bed_group = data.groupby([data['Out Bed'].dt.date])
     ret = out_bed_group.sum()
@@ -117,14 +156,13 @@ def combine_same_days(data):
     return ret
 
 
-def compute_averages_for_all_reports(reports_files, output, subject_filename_pattern):
-    average_all_list = []  # data list all days
-    average_we_list = []  # data list weekend days
-    average_wd_list = []  # data list weekday days
-    meta_data_list = []  # data list for meta data
-
-    for report_file in reports_files:
-        subject, header_lines, charenc = parse_header(report_file)
+def read_nights(report_file, subject_filename_pattern):
+    """
+    Reads a report, combines the sleeps of the same nights and computes the mid points of sleep. Returns the meta data
+    Series and the nights of the subject.
+    """
+    with stage('read report') as read_stage:
+        subject, data, charenc = read_report(report_file)
 
         if subject_filename_pattern:
             try:
@@ -133,107 +171,260 @@ def compute_averages_for_all_reports(reports_files, output, subject_filename_pat
                 subject = re.match(subject_filename_pattern, filename).group(1)
             except:
                 pass
+        read_stage.subject = subject
 
-        #print(f"read {report_file}, subject {subject}, with encoding {charenc} and {header_lines} header lines")
+    #print(f"read {report_file}, subject {subject}, with encoding {charenc}")
 
-        data = read_data(report_file, header_lines, charenc)
+    return combine_nights(subject, data)
 
-        # rename some columns
-        data.rename(columns={
-            "Total Sleep Time (TST)": "TST",
-            "Total Minutes in Bed": "TBT",
-            "Number of Awakenings": "Awakenings",
-            "Wake After Sleep Onset (WASO)": "WASO",
-            "Average Awakening Length": "AAL",
-            "Sleep Fragmentation Index": "SFI"
-        }, inplace=True)
 
-        # save number of sleeps before combining multiple sleeps for one night.
-        meta_data = pd.Series()
-        meta_data["# Sleeps"] = num_sleeps = len(data.index)
-        meta_data["Subject"] = subject
+def combine_nights(subject, data):
+    """
+    Combines the sleeps of the same nights of a subject's sleep periods, read from a report or scored from its agd file,
+    and computes the mid points of sleep. Returns the meta data Series and the nights of the subject.
+    """
+    import pandas as pd
 
-        data = combine_same_days(data)
-        meta_data["# Nights"] = num_nights = len(data.index)
+    # rename some columns
+    data.rename(columns={
+        "Total Sleep Time (TST)": "TST",
+        "Total Minutes in Bed": "TBT",
+        "Number of Awakenings": "Awakenings",
+        "Wake After Sleep Onset (WASO)": "WASO",
+        "Average Awakening Length": "AAL",
+        "Sleep Fragmentation Index": "SFI"
+    }, inplace=True)
 
-        if num_sleeps is not len(data.index):
-            print(f"{subject} has more sleep periods in same nights, combined from {num_sleeps} sleeps to {num_nights} nights.")
+    # save number of sleeps before combining multiple sleeps for one night.
+    meta_data = pd.Series()
+    meta_data["# Sleeps"] = num_sleeps = len(data.index)
+    meta_data["Subject"] = subject
 
-        # compute mid point of sleep
-        data = data.apply(compute_mid_point_of_sleep, axis=1)
-
-        # compute averages from all days
-        averages = compute_averages(data)
+    with stage('combine nights', subject):
+        data = combine_same_days(data)
+    meta_data["# Nights"] = num_nights = len(data.index)
 
-        # compute filter for out bed in the week and not at the weekend
-        weekday = data['Out Bed'].dt.weekday
-        in_week = (weekday < 5)  # 0 = Monday, 5 = Saturday
+    if num_sleeps is not len(data.index):
+        print(f"{subject} has more sleep periods in same nights, combined from {num_sleeps} sleeps to {num_nights} nights.")
 
-        # compute averages for weekday and weekends separately
-        averages_weekday = compute_averages(data[in_week])
-        averages_weekend = compute_averages(data[~in_week])
+    # compute mid point of sleep
+    data = compute_mid_point_of_sleep(data)
 
-        # set subject columns
-        averages_weekday["Subject"] = subject
-        averages_weekend["Subject"] = subject
-        averages["Subject"] = subject
+    return meta_data, data
 
-        #print(f"Subject {subject}")
 
-        # append result for this subject
-        average_we_list.append(averages_weekend)
-        average_wd_list.append(averages_weekday)
-        average_all_list.append(averages)
-        meta_data_list.append(meta_data)
+def try_read_nights(report_file, subject_filename_pattern):
+    # a defective report is reported and skipped instead of aborting the whole batch
+    try:
+        return read_nights(report_file, subject_filename_pattern)
+    except Exception as error:
+        print(f"Could not process report {report_file}: {error!r}")
+        return None
 
-    average_all = pd.DataFrame(average_all_list)  # averages over all days
-    average_we = pd.DataFrame(average_we_list)  # averages over weekend days
-    average_wd = pd.DataFrame(average_wd_list)  # averages over weekday days
-    meta_data = pd.DataFrame(meta_data_list)  # averages over weekday days
 
-    # set subjects as index field
-    average_we.set_index("Subject", inplace=True)
-    average_wd.set_index("Subject", inplace=True)
-    average_all.set_index("Subject", inplace=True)
-    meta_data.set_index("Subject", inplace=True)
+def compute_cohort_averages(meta_data_list, nights_list, circular=False):
+    """
+    Computes the averages over all days, workdays and weekend days of all subjects at once. The nights of all subjects
+    are concatenated into one table, in which every night appears once for all days and once for its day type, and
+    all averages are computed by grouping this table by subject and days. Returns one row per subject with the meta
+    data and the averages.
+    """
+    import pandas as pd
+    from time_stats import average_times_48, circular_time_stats, minutes_to_time
 
+    time_names = ['In Bed', 'Onset', 'MPOS', 'Out Bed']
 
+    # the position of a subject is the group key, so that subjects keep their order
+    nights = pd.concat(nights_list, keys=range(len(nights_list)), names=['Report', None]).reset_index(level=0)
+    in_week = nights['Out Bed'].dt.weekday < 5  # 0 = Monday, 5 = Saturday
+    nights = pd.concat([nights.assign(Days='All'),
+                        nights.assign(Days=in_week.map({True: 'Workdays', False: 'Weekend'}))], ignore_index=True)
+    keys = [nights['Report'], nights['Days']]
+
+    values = nights.drop(columns=['Report']).select_dtypes('number')
+    averages = values.groupby(keys).mean().astype(object)
+    averages['TBT'] = averages['TBT'].map(minutes_to_time)
+    averages['TST'] = averages['TST'].map(minutes_to_time)
+
+    averages = averages.join(average_times_48(nights, time_names, by=keys))
+    if circular:
+        averages = averages.join(circular_time_stats(nights, time_names, by=keys))
+
+    meta_data = pd.DataFrame(meta_data_list, index=range(len(meta_data_list)))
+    average_data = meta_data
+    for days in ['All', 'Workdays', 'Weekend']:
+        # subjects without nights of a day type get no averages for it
+        days_averages = averages[averages.index.get_level_values('Days') == days].droplevel('Days')
+        days_averages = days_averages.reindex(meta_data.index)
+        average_data = average_data.join(days_averages.add_suffix(f' ({days})').add_prefix('Average '))
+
+    return average_data.set_index("Subject").sort_index(axis=1)
+
+
+def read_all_nights(reports_files, subject_filename_pattern, n_jobs=None):
+    """
+    Reads the meta data and nights of all reports, with n_jobs > 1 (default: number of cpus) by a pool of worker
+    processes. The results keep the order of the report files, defective reports give None.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    patterns = [subject_filename_pattern] * len(reports_files)
+
+    if n_jobs == 1:
+        return list(map(try_read_nights, reports_files, patterns))
+
+    import profiling
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=profiling.init_worker,
+                             initargs=(profiling.settings(),)) as executor:
+        return list(executor.map(try_read_nights, reports_files, patterns,
+                                 chunksize=max(1, len(reports_files) // (4 * n_jobs))))
+
+
+def score_all_nights(agd_files, wear_time_intervals=None, fname_pattern=None, algorithm='sadeh', n_jobs=None):
+    """
+    Scores the sleep of all agd files instead of reading exported reports (see sleep_scoring.score_sleep), with
+    n_jobs > 1 (default: number of cpus) by a pool of worker processes. The non-wear times of the wear time intervals
+    are not scored as sleep. Returns the meta data and nights of each agd file like read_all_nights, None for files
+    that could not be scored.
+    """
+    from actigraphy_batch import process_subjects
+    from sleep_scoring import scored_sleep_periods
+
+    scored = process_subjects(agd_files, wear_time_intervals, fname_pattern, n_jobs, {'algorithm': algorithm},
+                              lean_reader=True, summarize=scored_sleep_periods)
+    return [combine_nights(*result) if result is not None else None for result in scored]
+
+
+def compute_scored_averages(agd_files, wear_times_files=None, fname_pattern=None, algorithm='sadeh', n_jobs=None,
+                            circular=False):
+    """
+    Computes the averages of the sleep scored from the agd files (see score_all_nights) like those of the reports.
+    Returns the scored agd files and the averages table with one row per scored agd file.
+    """
+    from wear_times import read_wear_time_intervals
+
+    wear_time_intervals = None
+    if wear_times_files:
+        with stage('read wear times'):
+            wear_time_intervals = read_wear_time_intervals(wear_times_files, fname_pattern, n_jobs)
+    return cohort_averages(agd_files, score_all_nights(agd_files, wear_time_intervals, fname_pattern, algorithm,
+                                                       n_jobs), circular)
+
+
+def compute_report_averages(reports_files, subject_filename_pattern, n_jobs=None, circular=False):
+    """
+    Computes the averages of all reports. The reports are read by n_jobs worker processes (see read_all_nights), the
+    averages of all subjects are computed together from their nights. Returns the readable report files and the
+    averages table with one row per report file.
+    """
+    return cohort_averages(reports_files, read_all_nights(reports_files, subject_filename_pattern, n_jobs), circular)
+
+
+def cohort_averages(files, results, circular=False):
+    # results holds the meta data and nights of each file, None for files that could not be read
+    import pandas as pd
+
+    read_files = [fname for fname, result in zip(files, results) if result is not None]
+    results = [result for result in results if result is not None]
+    if not results:
+        # e.g. a shard without reports
+        return read_files, pd.DataFrame()
+    with stage('cohort averages'):
+        average_data = compute_cohort_averages([meta_data for meta_data, _ in results],
+                                               [nights for _, nights in results], circular)
+    return read_files, average_data
+
+
+def write_shard_results(result_log_file, reports_files, average_data, header):
+    """
+    Writes the averages row of each report to a result log, the partial results of a shard combined by merge.
+    """
+    from result_log import ResultLog
+
+    result_log = ResultLog(result_log_file, header)
+    for report_file, (subject, row) in zip(reports_files, average_data.iterrows()):
+        result_log.append(report_file, {"Subject": subject, **row.to_dict()})
+    result_log.close()
+
+
+def merge_shard_results(result_log_files):
+    """
+    Combines the averages rows of the result logs of all shards into the averages table of a run without shards, with
+    the rows in the order of the report files.
+    """
+    import pandas as pd
+    from result_log import read_results
+
+    rows = sorted((report_file, row) for result_log_file in result_log_files
+                  for report_file, row in read_results(result_log_file))
+    return pd.DataFrame([row for _, row in rows]).set_index("Subject").sort_index(axis=1)
+
+
+def compute_averages_for_all_reports(reports_files, output, subject_filename_pattern, n_jobs=None, circular=False,
+                                     formats=DEFAULT_FORMATS):
+    """
+    Computes the averages of all reports (see compute_report_averages) and writes them to the output files of the
+    formats.
+    """
+    _, average_data = compute_report_averages(reports_files, subject_filename_pattern, n_jobs, circular)
+    write_averages(average_data, output, formats)
+
+
+def write_averages(average_data, output, formats=DEFAULT_FORMATS):
     # print results to console
     print("averages over all days")
-    print(average_all)
-    print(list(average_all))
+    print(average_data.filter(like=' (All)'))
+
+    from output_writers import write_outputs
+    write_outputs({output: average_data}, formats)
 
-    average_all = average_all.add_suffix(' (All)')
-    average_all = average_all.add_prefix('Average ')
+    print(average_data)
 
-    average_wd = average_wd.add_suffix(' (Workdays)')
-    average_wd = average_wd.add_prefix('Average ')
 
-    average_we = average_we.add_suffix(' (Weekend)')
-    average_we = average_we.add_prefix('Average ')
+def merge(argv):
+    import argparse
+    from sharding import check_shard_headers
 
-    average_data = meta_data.join(average_all).join(average_wd).join(average_we).sort_index(axis=1)
+    parser = argparse.ArgumentParser(prog='read_reports.py merge',
+                                     description='Combines the result logs of the shards of a run (--shard) into the '
+                                                 'averages of all reports.')
+    parser.add_argument('result_logs', nargs='+', help='Result logs of all shards')
+    parser.add_argument('-o', '--reports-output', dest="reports_output", required=True,
+                        help='File for storing the resulting average computation of all reports')
+    parser.add_argument('--formats', dest="formats", nargs='+', choices=FORMATS, default=DEFAULT_FORMATS,
+                        help=f'Formats of the output files, default: {" ".join(DEFAULT_FORMATS)}')
+    parser.add_argument('--results-db', dest="results_db", default=None,
+                        help='Results database (sqlite) the results are also stored in, see results_db.py for queries')
+    parser.add_argument('--run-name', dest="run_name", default=None,
+                        help='Name of the run in the results database, the results of its subjects replace those of '
+                             'an earlier run with the same name. Default is the output file')
 
-    from pathlib import Path
-    filepath = Path(args.reports_output)
-    filepath.parent.mkdir(parents=True, exist_ok=True)
+    args = parser.parse_args(argv)
 
-    average_data.to_excel(f"{args.reports_output}.xlsx")
-    average_data.to_csv(f"{args.reports_output}.csv")
+    try:
+        check_shard_headers(args.result_logs)
+    except ValueError as error:
+        parser.error(str(error))
 
-    # write data to html
-    data_html = average_data.to_html()
-    data_html_file = open(f"{args.reports_output}.html", "w")
-    data_html_file.write(data_html)
-    data_html_file.close()
+    average_data = merge_shard_results(args.result_logs)
+    print(f'Merged the averages of {len(average_data)} reports from {len(args.result_logs)} result logs')
+    write_averages(average_data, args.reports_output, args.formats)
 
-    print(average_data)
+    if args.results_db:
+        from results_db import store_results
+        store_results(args.results_db, args.run_name or args.reports_output, average_data, 'read_reports',
+                      {'result_logs': args.result_logs})
 
 
 if __name__ == '__main__':
 
     import sys
     import argparse
+    from sharding import parse_shard, select_shard, select_shard_groups, shard_suffix
+
+    if sys.argv[1:2] == ['merge']:
+        merge(sys.argv[2:])
+        exit()
 
     parser = argparse.ArgumentParser(description='TODO Description')
 
@@ -242,24 +433,82 @@ if __name__ == '__main__':
     parser_group.add_argument('-r', '--reports', dest="reports_folder",
                         help='Folder containing all report csv files. Default ist "data/reports"', default="data/reports")
     parser_group.add_argument('-s', '--search-folder', dest="search_folder", help='Folder containing sub-folders for each subject')
+    parser_group.add_argument('-a', '--agd-folder', dest="agd_folder",
+                              help='Folder containing agd files, whose sleep is scored (requires --score-sleep)')
 
     parser.add_argument('-o', '--reports-output', dest="reports_output", required=True,
                         help='File for storing the resulting average computation of all reports')
     parser.add_argument('--subject-filename-pattern', dest="subject_filename_pattern", default="(.*)-sleep-report*",
                         help='If set, the the subject name will be taken from the file name following this regex pattern')
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=None,
+                        help='Number of worker processes reading the reports. '
+                             'Default is the number of cpus, 1 processes all reports in this process')
+    parser.add_argument('--formats', dest="formats", nargs='+', choices=FORMATS, default=DEFAULT_FORMATS,
+                        help=f'Formats of the output files, default: {" ".join(DEFAULT_FORMATS)}')
+    parser.add_argument('--circular-times', dest="circular", action='store_true',
+                        help='Also compute the circular mean and standard deviation (in minutes) of the times')
+    parser.add_argument('--score-sleep', dest="score_sleep", metavar='ALGORITHM', default=None,
+                        help='Score the sleep of the agd files (of the search folder or the agd folder) with this '
+                             'algorithm (sadeh or cole-kripke) instead of reading exported sleep reports')
+    parser.add_argument('-w', '--wear_times_file', dest="wear_times_file", default=None,
+                        help='With --score-sleep and an agd folder, the wear time validation details file, the '
+                             'non-wear times are not scored as sleep')
+    parser.add_argument('--results-db', dest="results_db", default=None,
+                        help='Results database (sqlite) the results are also stored in, see results_db.py for queries')
+    parser.add_argument('--run-name', dest="run_name", default=None,
+                        help='Name of the run in the results database, the results of its subjects replace those of '
+                             'an earlier run with the same name. Default is the output file')
+    parser.add_argument('--shard', dest="shard", type=parse_shard, default=None,
+                        help='Only process the shard i/N of the reports, e.g. 2/4 on the second of four nodes. The '
+                             'averages are written to the result log <reports output>_shard<i>of<N>_results.jsonl, '
+                             'combine the result logs of all shards with "read_reports.py merge"')
+    parser.add_argument('--profile', dest="profile", default=None,
+                        help='Chrome trace file (chrome://tracing, Perfetto) for the wall time and peak memory of each '
+                             'stage and report')
+    parser.add_argument('--profile-stage', dest="profile_stage", default=None,
+                        help='With --profile, run cProfile during this stage (e.g. "read report"), the statistics are '
+                             'saved to <profile>.prof')
 
     args = parser.parse_args(sys.argv[1:])
 
+    if args.profile:
+        import profiling
+        profiling.start(args.profile, args.profile_stage)
+
     subject_filename_pattern = re.compile(args.subject_filename_pattern) if args.subject_filename_pattern else None
 
-    if args.search_folder:
+    if args.agd_folder and not args.score_sleep:
+        parser.error('an agd folder (-a) requires --score-sleep')
+    if args.score_sleep:
+        from sleep_scoring import ALGORITHMS
+        if args.score_sleep not in ALGORITHMS:
+            parser.error(f"--score-sleep must be one of {', '.join(ALGORITHMS)}")
+
+    if args.score_sleep:
+        from actigraphy_batch import list_agd_files, search_folder_files
+        if args.search_folder:
+            # the default pattern is that of the report file names, the agd files are named after their sub-folder
+            reports_files, wear_files, subject_filename_pattern = search_folder_files(args.search_folder, None,
+                                                                                      args.shard)
+        elif not os.path.exists(args.agd_folder):
+            print(f' agd folder {args.agd_folder} does not exist!')
+            parser.print_help()
+            exit()
+        else:
+            reports_files = select_shard(sorted(list_agd_files(args.agd_folder)), args.shard)
+            wear_files = [args.wear_times_file] if args.wear_times_file else None
+            subject_filename_pattern = None
+            print(f'Found {len(reports_files)} agd files in {args.agd_folder}')
+
+    elif args.search_folder:
         import crawl_files
-        groups_map = crawl_files.search_folder(args.search_folder)
+        manifest_file = crawl_files.default_manifest_file(args.search_folder)
+        groups_map = select_shard_groups(crawl_files.search_folder(args.search_folder, manifest_file=manifest_file),
+                                         args.shard)
 
         reports_files = [item['sleep_report'] for key, item in groups_map.items() if item['sleep_report']]
         print(f'Found {len(reports_files)} report files in {args.search_folder}')
         reports_files.sort()
-        compute_averages_for_all_reports(reports_files, args.reports_output, subject_filename_pattern)
 
     elif not os.path.exists(args.reports_folder):
         print(f' reports folder {args.reports_folder} does not exist!')
@@ -268,6 +517,40 @@ if __name__ == '__main__':
 
     else:
         reports_files = [os.path.join(args.reports_folder, file) for file in os.listdir(args.reports_folder) if file.endswith('.csv')]
+        reports_files = select_shard(reports_files, args.shard, args.subject_filename_pattern)
         print(f'Found {len(reports_files)} report files in {args.reports_folder}')
         reports_files.sort()
-        compute_averages_for_all_reports(reports_files, args.reports_output, None)
+        subject_filename_pattern = None
+
+    if args.shard:
+        # the outputs are written by merge from the result logs of all shards
+        result_log_file = f"{args.reports_output}{shard_suffix(args.shard)}_results.jsonl"
+        if args.score_sleep:
+            read_files, average_data = compute_scored_averages(reports_files, wear_files, subject_filename_pattern,
+                                                               args.score_sleep, args.jobs, args.circular)
+        else:
+            read_files, average_data = compute_report_averages(reports_files, subject_filename_pattern, args.jobs,
+                                                               args.circular)
+        header = {'circular': args.circular, 'shard': args.shard,
+                  'subject_filename_pattern': subject_filename_pattern.pattern if subject_filename_pattern else None}
+        if args.score_sleep:
+            header['score_sleep'] = args.score_sleep
+        write_shard_results(result_log_file, read_files, average_data, header)
+        print(f"Wrote the averages of shard {args.shard[0]}/{args.shard[1]} to {result_log_file}, combine the "
+              f"shards with read_reports.py merge")
+    else:
+        if args.score_sleep:
+            _, average_data = compute_scored_averages(reports_files, wear_files, subject_filename_pattern,
+                                                      args.score_sleep, args.jobs, args.circular)
+        else:
+            _, average_data = compute_report_averages(reports_files, subject_filename_pattern, args.jobs,
+                                                      args.circular)
+        write_averages(average_data, args.reports_output, args.formats)
+
+        if args.results_db:
+            from results_db import store_results
+            store_results(args.results_db, args.run_name or args.reports_output, average_data, 'read_reports',
+                          {'circular': args.circular, 'score_sleep': args.score_sleep})
+
+    if args.profile:
+        profiling.finish(args.profile)
@@ -0,0 +1,121 @@
+import os
+import json
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+# values json cannot represent are written as single-key objects tagged with their type
+_TAGS = {
+    '__datetime__': pd.Timestamp,
+    '__time__': time.fromisoformat,
+    '__timedelta__': lambda ns: pd.Timedelta(ns, unit='ns'),
+}
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, time):
+        return {'__time__': value.isoformat()}
+    if isinstance(value, timedelta):
+        return {'__timedelta__': pd.Timedelta(value).value}
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    raise TypeError(f"Cannot write {value!r} of type {type(value).__name__} to a result log")
+
+
+def decode_object(obj):
+    if len(obj) == 1:
+        tag, value = next(iter(obj.items()))
+        if tag in _TAGS:
+            return _TAGS[tag](value)
+    return obj
+
+
+def _read_lines(log_file):
+    """
+    Yields the decoded lines of a log file and the offset after each of them. Reading stops at an incomplete last
+    line, which is left by a run that was killed while writing it.
+    """
+    offset = 0
+    with open(log_file, 'rb') as file:
+        for line in file:
+            if not line.endswith(b'\n'):
+                return
+            try:
+                record = json.loads(line, object_hook=decode_object)
+            except ValueError:
+                return
+            offset += len(line)
+            yield record, offset
+
+
+def read_header(log_file):
+    """
+    Returns the header of a result log, None if the file has none.
+    """
+    first = next(_read_lines(log_file), None)
+    return first[0].get('header') if first is not None and isinstance(first[0], dict) else None
+
+
+def read_results(log_file):
+    """
+    Streams the (file, summary) records of a result log, without the header.
+    """
+    lines = _read_lines(log_file)
+    next(lines, None)
+    for record, _ in lines:
+        yield record['file'], record['summary']
+
+
+class ResultLog:
+    """
+    JSON-lines file to which the summary of each subject is appended as soon as it is computed, so that the results of
+    an interrupted run are not lost. The first line holds the header identifying the run. With resume, the results of
+    a previous run with the same header are kept and new results are appended, otherwise the log is started anew.
+    """
+
+    def __init__(self, log_file, header, resume=False):
+        from pathlib import Path
+        Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+
+        self.log_file = log_file
+        self.done = set()
+        # compared as read back from the log, e.g. tuples become lists
+        header = json.loads(json.dumps(header, default=encode_value), object_hook=decode_object)
+
+        end = 0
+        if resume and os.path.exists(log_file):
+            lines = _read_lines(log_file)
+            first = next(lines, None)
+            if first is not None and first[0] == {'header': header}:
+                end = first[1]
+                for record, end in lines:
+                    self.done.add(record['file'])
+            else:
+                print(f"Result log {log_file} is of another run and is started anew")
+
+        if end:
+            # an incomplete last line is cut off before appending
+            self.file = open(log_file, 'r+')
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(log_file, 'w')
+            self._write({'header': header})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, default=encode_value) + '\n')
+        self.file.flush()
+
+    def append(self, fname, subject_summary):
+        self._write({'file': fname, 'summary': subject_summary})
+        self.done.add(fname)
+
+    def close(self):
+        self.file.close()
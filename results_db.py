@@ -0,0 +1,262 @@
+import re
+import json
+import math
+import time
+import numbers
+import sqlite3
+from datetime import datetime, date, timedelta
+from datetime import time as time_of_day
+
+import pandas as pd
+
+from time_stats import pivot_minutes, minutes_to_time
+
+# comparisons of the query conditions, longest operators first
+CONDITION_PATTERN = re.compile(r"^\s*(.+?)\s*(<=|>=|!=|=|<|>)\s*(.+?)\s*$")
+TIME_PATTERN = re.compile(r"^\d{1,2}:\d{2}(:\d{2})?$")
+
+# times of day up to these hours are stored as times of the next day, like the scripts average them: the midpoints of
+# the actigraphy summaries (e.g. L5 at night, M10 in the afternoon) with the pivot 5, the sleep times with the pivot 14
+MIDPOINT_PIVOT = 5
+SLEEP_TIME_PIVOT = 14
+
+# ISO text of a time of day, as stored for the times of day
+TIME_GLOB = '[0-2][0-9]:[0-5][0-9]:[0-5][0-9]*'
+
+
+def time_pivot(metric):
+    return MIDPOINT_PIVOT if metric.endswith(' Midpoint') else SLEEP_TIME_PIVOT
+
+
+def time_minutes(value, metric):
+    """
+    Minutes of a time of day of a metric on the 48h scale of the averages of the scripts: times up to the pivot hour
+    of the metric (see time_pivot) count as times of the next day, so that e.g. an onset at 03:00 is later than one
+    at 23:30.
+    """
+    minutes = value.hour * 60 + value.minute + value.second / 60 + value.microsecond / 6e7
+    return float(pivot_minutes(minutes, time_pivot(metric)))
+
+
+def _db_value(value, metric):
+    """
+    Numeric value and text of a table cell. Numbers, durations (in seconds) and times of day (in minutes, see
+    time_minutes) are stored as value to be compared numerically, times of day and dates also as ISO text. Returns
+    None for missing values.
+    """
+    if value is None or isinstance(value, str):
+        return (None, value) if value else None
+    if isinstance(value, (pd.Timedelta, timedelta)):
+        return None if pd.isna(value) else (pd.Timedelta(value).total_seconds(), str(pd.Timedelta(value)))
+    if isinstance(value, time_of_day):
+        return time_minutes(value, metric), value.isoformat()
+    if isinstance(value, (datetime, date)):
+        return None if pd.isna(value) else (None, value.isoformat())
+    if isinstance(value, numbers.Real):
+        return None if math.isnan(value) else (float(value), None)
+    return None, str(value)
+
+
+def parse_condition(text):
+    """
+    Parses a query condition "<metric> <op> <value>", e.g. "IS < 0.4" or "Average MPOS (Workdays) > 03:00". Numbers
+    and times of day (see time_minutes) are compared with the numeric values, anything else, e.g. dates, with the
+    text. Raises ValueError.
+    """
+    match = CONDITION_PATTERN.match(text)
+    if not match:
+        raise ValueError(f"Condition {text!r} is not of the form <metric> <op> <value>")
+    metric, operator, value = match.groups()
+    if TIME_PATTERN.match(value):
+        hours, minutes, seconds = (value.split(':') + ['0'])[:3]
+        return metric, operator, 'value', time_minutes(time_of_day(int(hours), int(minutes), int(seconds)), metric)
+    try:
+        return metric, operator, 'value', float(value)
+    except ValueError:
+        return metric, operator, 'text', value
+
+
+class ResultsDB:
+    """
+    Results of the runs of both scripts in a sqlite file, in long format with one row per run, subject and metric. The
+    primary key indexes the rows by run and subject, two more indexes serve the lookups of a subject and the filters on
+    a metric's value, so queries only read the rows they need.
+    """
+
+    def __init__(self, db_file):
+        from pathlib import Path
+        Path(db_file).parent.mkdir(parents=True, exist_ok=True)
+
+        self.connection = sqlite3.connect(db_file)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS runs "
+                                    "(run TEXT PRIMARY KEY, script TEXT, options TEXT, updated REAL NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (run TEXT NOT NULL, subject TEXT NOT NULL, "
+                                    "metric TEXT NOT NULL, value REAL, text TEXT, PRIMARY KEY (run, subject, metric)) "
+                                    "WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_subject ON results (subject, run)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_metric ON results (metric, value, text)")
+
+    def upsert(self, run, table, script=None, options=None):
+        """
+        Inserts the results of a table with one row per subject (the index) and one column per metric in a single
+        transaction, replacing the results the subjects had in the run before. Missing values are not stored.
+        """
+        subjects = [str(subject) for subject in table.index]
+        columns = [str(column) for column in table.columns]
+        rows = ((run, subject, metric) + stored
+                for subject, values in zip(subjects, table.itertuples(index=False, name=None))
+                for metric, stored in zip(columns, map(_db_value, values, columns)) if stored is not None)
+
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO runs (run, script, options, updated) VALUES (?, ?, ?, ?)",
+                                    (run, script, json.dumps(options, default=str), time.time()))
+            self.connection.executemany("DELETE FROM results WHERE run = ? AND subject = ?",
+                                        [(run, subject) for subject in subjects])
+            self.connection.executemany("INSERT OR REPLACE INTO results (run, subject, metric, value, text) "
+                                        "VALUES (?, ?, ?, ?, ?)", rows)
+        return len(subjects)
+
+    def runs(self):
+        return pd.read_sql_query("SELECT runs.run, script, COUNT(DISTINCT subject) AS subjects, options, "
+                                 "datetime(updated, 'unixepoch', 'localtime') AS updated FROM runs "
+                                 "LEFT JOIN results ON results.run = runs.run GROUP BY runs.run ORDER BY updated",
+                                 self.connection).set_index('run')
+
+    def _in_runs(self, runs, column='run'):
+        return (f" AND {column} IN ({','.join('?' * len(runs))})", list(runs)) if runs else ("", [])
+
+    def _matches(self, runs=None, conditions=()):
+        """
+        SQL selecting the subjects that fulfil all conditions, and its parameters. A condition is fulfilled if the
+        metric of one of the runs fulfils it, so that e.g. actigraphy and sleep report metrics can be combined.
+        """
+        runs_sql, runs_parameters = self._in_runs(runs)
+        queries, parameters = [], []
+        for metric, operator, column, value in conditions:
+            queries.append(f"SELECT subject FROM results WHERE metric = ? AND {column} {operator} ?{runs_sql}")
+            parameters += [metric, value] + runs_parameters
+        if not queries:
+            queries.append(f"SELECT DISTINCT subject FROM results WHERE 1{runs_sql}")
+            parameters += runs_parameters
+        return " INTERSECT ".join(queries), parameters
+
+    def query(self, runs=None, conditions=(), metrics=None):
+        """
+        Results of the subjects that fulfil all conditions (see parse_condition) in the runs, with one row per subject
+        and one column per metric (default: all metrics). A metric stored by more than one of the runs gets a column
+        '<metric> [<run>]' per run.
+        """
+        matches, parameters = self._matches(runs, conditions)
+        runs_sql, runs_parameters = self._in_runs(runs)
+        sql = f"SELECT run, subject, metric, value, text FROM results WHERE subject IN ({matches}){runs_sql}"
+        parameters += runs_parameters
+        if metrics:
+            sql += f" AND metric IN ({','.join('?' * len(metrics))})"
+            parameters += list(metrics)
+
+        data = pd.read_sql_query(sql, self.connection, params=parameters)
+        data['value'] = data['value'].astype(object).where(data['text'].isna(), data['text'])
+        runs_of_metric = data.groupby('metric')['run'].transform('nunique')
+        data['column'] = data['metric'].where(runs_of_metric == 1, data['metric'] + ' [' + data['run'] + ']')
+
+        table = data.pivot(index='subject', columns='column', values='value')
+        table.columns.name = None
+        if metrics:
+            order = {metric: i for i, metric in enumerate(metrics)}
+            columns = data.drop_duplicates('column').sort_values('metric', key=lambda names: names.map(order),
+                                                                 kind='mergesort')['column']
+            table = table[list(columns)]
+        return table
+
+    def aggregate(self, runs=None, conditions=(), metrics=None):
+        """
+        Cohort aggregates (count, mean, standard deviation, minimum and maximum) of the numeric metrics of each run over
+        the subjects that fulfil all conditions, computed by sqlite. Times of day are averaged on the 48h scale (see
+        time_minutes) and returned as times of day, their standard deviation in minutes.
+        """
+        matches, parameters = self._matches(runs, conditions)
+        runs_sql, runs_parameters = self._in_runs(runs)
+        sql = (f"SELECT run, metric, COUNT(value) AS count, AVG(value) AS mean, AVG(value * value) AS mean_of_squares, "
+               f"MIN(value) AS min, MAX(value) AS max, MIN(text GLOB ?) AS is_time FROM results "
+               f"WHERE subject IN ({matches}){runs_sql} AND value IS NOT NULL")
+        parameters = [TIME_GLOB] + parameters + runs_parameters
+        if metrics:
+            sql += f" AND metric IN ({','.join('?' * len(metrics))})"
+            parameters += list(metrics)
+        sql += " GROUP BY run, metric ORDER BY run, metric"
+
+        data = pd.read_sql_query(sql, self.connection, params=parameters).set_index(['run', 'metric'])
+        # sample standard deviation from the mean and the mean of squares
+        count = data['count']
+        variance = (data.pop('mean_of_squares') - data['mean'] ** 2) * count / (count - 1).where(count > 1)
+        data.insert(2, 'std', variance.clip(lower=0) ** 0.5)
+
+        # the times of day back from the 48h scale
+        is_time = data.pop('is_time') == 1
+        for column in ['mean', 'min', 'max']:
+            data[column] = data[column].astype(object)
+            data.loc[is_time, column] = data.loc[is_time, column].map(minutes_to_time)
+        return data
+
+    def close(self):
+        self.connection.close()
+
+
+def store_results(db_file, run, table, script=None, options=None):
+    # writes a results table of a run of one of the scripts to the results database
+    results_db = ResultsDB(db_file)
+    try:
+        n_subjects = results_db.upsert(run, table, script, options)
+    finally:
+        results_db.close()
+    print(f"Stored the results of {n_subjects} subjects as run {run!r} in {db_file}")
+
+
+if __name__ == '__main__':
+
+    import sys
+    import argparse
+    from output_writers import write_outputs, FORMATS
+
+    parser = argparse.ArgumentParser(description='Queries the results database written by actigraphy_batch.py and '
+                                                 'read_reports.py with --results-db.')
+    parser.add_argument('results_db', help='The results database file')
+    parser.add_argument('--runs', dest="runs", action='store_true', help='List the runs in the database')
+    parser.add_argument('-r', '--run', dest="run", nargs='+', default=None,
+                        help='Only these runs, default: all runs')
+    parser.add_argument('-w', '--where', dest="conditions", nargs='+', default=[],
+                        help='Conditions the subjects must all fulfil in one of the runs, e.g. -w "IS < 0.4" '
+                             '"Mask_fraction > 0.2" "Average MPOS (Workdays) > 03:00". Times of day are compared on '
+                             'a 48h scale, times up to 5:00 (midpoints) or 14:00 (sleep times) count as times of the '
+                             'next day')
+    parser.add_argument('-m', '--metrics', dest="metrics", nargs='+', default=None,
+                        help='Metrics to return, default: all metrics')
+    parser.add_argument('--aggregate', dest="aggregate", action='store_true',
+                        help='Return the cohort aggregates of the metrics per run instead of the subjects')
+    parser.add_argument('-o', '--output', dest="output", default=None,
+                        help='File to write the result to (without extension), default: print it')
+    parser.add_argument('--formats', dest="formats", nargs='+', choices=FORMATS, default=['csv'],
+                        help='Formats of the output files, default: csv')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    try:
+        conditions = [parse_condition(condition) for condition in args.conditions]
+    except ValueError as error:
+        parser.error(str(error))
+
+    results_db = ResultsDB(args.results_db)
+    if args.runs:
+        result = results_db.runs()
+    elif args.aggregate:
+        result = results_db.aggregate(args.run, conditions, args.metrics)
+    else:
+        result = results_db.query(args.run, conditions, args.metrics)
+    results_db.close()
+
+    if args.output:
+        write_outputs({args.output: result}, args.formats)
+    else:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None):
+            print(result)
@@ -0,0 +1,90 @@
+import os
+import hashlib
+
+# the subject partitions of an agd store, see agd_store.subject_data_file
+STORE_PARTITION = 'subject='
+REPORT_SUFFIX = '-sleep-report'
+
+
+def parse_shard(text):
+    """
+    Parses a shard 'i/N' of N shards, numbered from 1 to N. Returns the tuple (i, N).
+    """
+    import argparse
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard {text!r} is not of the form i/N")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {text!r} is not between 1/{count} and {count}/{count}")
+    return index, count
+
+
+def shard_of(subject, n_shards):
+    # a stable hash, unlike hash() it does not change between processes and machines
+    digest = hashlib.sha256(str(subject).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % n_shards + 1
+
+
+def in_shard(subject, shard):
+    return shard is None or shard_of(subject, shard[1]) == shard[0]
+
+
+def file_subject(fname, fname_pattern=None):
+    """
+    Subject id of a file outside of a search folder, so that the agd file, the sleep report and the stored data of a
+    subject share a shard. A data file of an agd store is in the folder of its subject. Otherwise the subject is
+    matched by the subject filename pattern in the file name without extension, like the subject of a report, and is
+    the name without extension and without the suffix of the sleep reports if the pattern does not match.
+    """
+    import re
+    from urllib.parse import unquote
+
+    folder = os.path.basename(os.path.dirname(fname))
+    if folder.startswith(STORE_PARTITION):
+        return unquote(folder[len(STORE_PARTITION):])
+
+    name = os.path.splitext(os.path.basename(fname))[0]
+    match = re.match(fname_pattern, name) if fname_pattern else None
+    if match:
+        return match.group(1)
+    return name[:-len(REPORT_SUFFIX)] if name.endswith(REPORT_SUFFIX) else name
+
+
+def select_shard(files, shard, fname_pattern=None):
+    return [fname for fname in files if in_shard(file_subject(fname, fname_pattern), shard)]
+
+
+def select_shard_groups(groups_map, shard):
+    # the sub-folders of a search folder are the subjects, so agd files and reports of a subject share a shard
+    return {subject: files for subject, files in groups_map.items() if in_shard(subject, shard)}
+
+
+def shard_suffix(shard):
+    return f"_shard{shard[0]}of{shard[1]}" if shard else ""
+
+
+def check_shard_headers(log_files):
+    """
+    Checks that the result logs to merge were written with the same options and, if they are shards, that they are
+    all shards of one run. Raises ValueError otherwise.
+    """
+    from result_log import read_header
+
+    headers = [read_header(log_file) for log_file in log_files]
+    options = [{key: value for key, value in (header or {}).items() if key != 'shard'} for header in headers]
+    for log_file, header, log_options in zip(log_files, headers, options):
+        if header is None:
+            raise ValueError(f"{log_file} is not a result log")
+        if log_options != options[0]:
+            raise ValueError(f"{log_file} was written with other options than {log_files[0]}")
+
+    shards = [header.get('shard') for header in headers]
+    if any(shards):
+        counts = {shard[1] for shard in shards if shard}
+        if None in shards or len(counts) != 1:
+            raise ValueError("The result logs are not shards of the same number of shards")
+        missing = set(range(1, counts.pop() + 1)) - {shard[0] for shard in shards}
+        duplicates = len(shards) - len({shard[0] for shard in shards})
+        if missing or duplicates:
+            raise ValueError(f"Missing shards {sorted(missing)}" if missing else "A shard is given more than once")
@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ActiLife caps the counts per minute at 300 for Sadeh
+SADEH_COUNT_CAP = 300
+
+# weights of the counts (divided by 100) of the 4 minutes before to the 2 minutes after the scored minute
+COLE_KRIPKE_WEIGHTS = 0.001 * np.array([106, 54, 58, 76, 230, 74, 67])
+
+ALGORITHMS = ['sadeh', 'cole-kripke']
+
+# columns of the sleep periods, named like those of ActiLife's sleep reports
+REPORT_COLUMNS = ['In Bed', 'Out Bed', 'Onset', 'Latency', 'Total Counts', 'Efficiency', 'Total Minutes in Bed',
+                  'Total Sleep Time (TST)', 'Wake After Sleep Onset (WASO)', 'Number of Awakenings',
+                  'Average Awakening Length', 'Movement Index', 'Fragmentation Index', 'Sleep Fragmentation Index']
+
+
+def minute_counts(reader):
+    """
+    Vertical axis counts per minute of a LeanAGD reader and whether each minute is valid, i.e. has no missing epochs
+    and, if the reader is masked, lies completely in the wear time. Epochs shorter than a minute are summed.
+    """
+    counts = reader.raw_axis1
+    epochs_per_minute = pd.Timedelta(minutes=1) // reader.frequency
+    if epochs_per_minute < 1 or pd.Timedelta(minutes=1) % reader.frequency:
+        raise ValueError(f"Sleep scoring needs epochs that divide a minute, not {reader.frequency}")
+
+    valid = counts.notna()
+    if reader.mask is not None:
+        valid &= reader.mask.reindex(counts.index).fillna(0) > 0
+    if epochs_per_minute > 1:
+        minutes = counts.resample('60s', origin='start')
+        counts = minutes.sum(min_count=epochs_per_minute)
+        valid = valid.resample('60s', origin='start').sum() == epochs_per_minute
+    return counts.to_numpy(), valid.to_numpy()
+
+
+def sadeh(counts):
+    """
+    Sleep (True) or wake of each minute by the algorithm of Sadeh et al. (1994), computed for all minutes at once
+    with convolutions over the 11 minute window and a sliding window for the standard deviation.
+    """
+    counts = np.minimum(np.nan_to_num(counts), SADEH_COUNT_CAP)
+    window = np.ones(11)
+
+    mean_w5 = np.convolve(np.pad(counts, 5), window, 'valid') / len(window)
+    nats = np.convolve(np.pad(((counts >= 50) & (counts < 100)).astype(np.float64), 5), window, 'valid')
+    # standard deviation of the scored minute and the 5 minutes before
+    sd_last6 = sliding_window_view(np.pad(counts, (5, 0)), 6).std(axis=1, ddof=1)
+
+    ps = 7.601 - 0.065 * mean_w5 - 1.08 * nats - 0.056 * sd_last6 - 0.703 * np.log(counts + 1)
+    return ps > -4
+
+
+def cole_kripke(counts):
+    """
+    Sleep (True) or wake of each minute by the algorithm of Cole and Kripke (1992) for one minute epochs, as applied
+    by ActiLife, computed for all minutes at once by correlating the counts with the weights.
+    """
+    counts = np.minimum(np.nan_to_num(counts) / 100, 300)
+    return np.correlate(np.pad(counts, (4, 2)), COLE_KRIPKE_WEIGHTS, 'valid') < 1
+
+
+def run_lengths(values):
+    """
+    Run length encoding of an array. Returns the starts, lengths and values of the runs of equal values.
+    """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), values
+    starts = np.concatenate([[0], np.flatnonzero(values[1:] != values[:-1]) + 1])
+    return starts, np.diff(np.append(starts, len(values))), values[starts]
+
+
+def _range_sums(values, begins, ends):
+    cumsum = np.concatenate([[0], np.cumsum(values)])
+    return cumsum[ends] - cumsum[begins]
+
+
+def _count_in_ranges(positions, begins, ends):
+    # number of the sorted positions within each range [begin, end)
+    return np.searchsorted(positions, ends) - np.searchsorted(positions, begins)
+
+
+def sleep_periods(asleep, valid, counts, min_onset=5, max_wake=10, min_period=160):
+    """
+    Detects the sleep periods in the scored minutes: wake bouts shorter than max_wake minutes between sleep are
+    bridged, and every bridged sleep bout of at least min_period minutes is a sleep period (in bed to out bed). The
+    onset is the first sleep bout of at least min_onset minutes in the period. Invalid minutes end a period. Returns
+    a dict of arrays with the start, onset and end (exclusive) minute and the statistics of each period.
+    """
+    state = np.where(valid, asleep.astype(np.int8), -1)
+    starts, lengths, values = run_lengths(state)
+
+    # interior wake bouts between two sleep bouts are bridged if they are short
+    bridged = (values == 0) & (lengths < max_wake)
+    bridged[[0, -1]] = False
+    bridged[1:-1] &= (values[:-2] == 1) & (values[2:] == 1)
+    period_starts, period_lengths, in_period = run_lengths(np.repeat((values == 1) | bridged, lengths))
+
+    is_period = in_period & (period_lengths >= min_period)
+    begins = period_starts[is_period]
+    ends = begins + period_lengths[is_period]
+
+    # the end of the data follows the last bout, a period without a long enough sleep bout has its onset at the start
+    onset_starts = np.append(starts[(values == 1) & (lengths >= min_onset)], len(state))
+    onsets = onset_starts[np.searchsorted(onset_starts, begins)]
+    onsets = np.where(onsets < ends, onsets, begins)
+
+    sleep_bouts = starts[values == 1]
+    one_minute_bouts = starts[(values == 1) & (lengths == 1)]
+    counts = np.nan_to_num(counts)
+
+    minutes_in_bed = ends - begins
+    total_sleep = _range_sums(state == 1, begins, ends)
+    waso = _range_sums(state == 0, onsets, ends)
+    awakenings = _count_in_ranges(starts[values == 0], onsets, ends)
+    n_sleep_bouts = _count_in_ranges(sleep_bouts, onsets, ends)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'begin': begins,
+            'onset': onsets,
+            'end': ends,
+            'Latency': onsets - begins,
+            'Total Counts': _range_sums(counts, begins, ends),
+            'Efficiency': 100 * total_sleep / minutes_in_bed,
+            'Total Minutes in Bed': minutes_in_bed,
+            'Total Sleep Time (TST)': total_sleep,
+            'Wake After Sleep Onset (WASO)': waso,
+            'Number of Awakenings': awakenings,
+            'Average Awakening Length': np.where(awakenings > 0, waso / awakenings, 0.),
+            'Movement Index': 100 * _range_sums(counts > 0, begins, ends) / minutes_in_bed,
+            'Fragmentation Index': np.where(n_sleep_bouts > 0, 100 * _count_in_ranges(one_minute_bouts, onsets, ends)
+                                            / n_sleep_bouts, 0.),
+        }
+
+
+def score_sleep(reader, algorithm='sadeh', **period_kwargs):
+    """
+    Scores the sleep of a LeanAGD reader with the algorithm (sadeh or cole-kripke) and detects its sleep periods (see
+    sleep_periods). Returns a table with a row per sleep period and the columns of ActiLife's sleep reports, the
+    non-wear times of a masked reader are never counted as sleep.
+    """
+    scorers = {'sadeh': sadeh, 'cole-kripke': cole_kripke}
+    if algorithm not in scorers:
+        raise ValueError(f"Unknown sleep scoring algorithm {algorithm!r}, use one of {', '.join(ALGORITHMS)}")
+
+    counts, valid = minute_counts(reader)
+    periods = sleep_periods(scorers[algorithm](counts), valid, counts, **period_kwargs)
+
+    # the first minute of every scored minute and of the minute after the last one
+    times = pd.date_range(reader.raw_axis1.index[0], periods=len(counts) + 1, freq='60s')
+    data = pd.DataFrame({
+        'In Bed': times[periods.pop('begin')],
+        'Out Bed': times[periods.pop('end')],
+        'Onset': times[periods.pop('onset')],
+        **periods,
+    })
+    data['Sleep Fragmentation Index'] = data['Movement Index'] + data['Fragmentation Index']
+    return data[REPORT_COLUMNS]
+
+
+def scored_sleep_periods(reader, mask_set=False, algorithm='sadeh'):
+    """
+    Summary function for actigraphy_batch.process_subjects: the subject and its scored sleep periods.
+    """
+    return reader.display_name, score_sleep(reader, algorithm)
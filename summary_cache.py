@@ -0,0 +1,80 @@
+import os
+import pickle
+import sqlite3
+import hashlib
+import time
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "actigraphy", "summaries.sqlite")
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def file_hash(fname, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def bytes_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(*parts):
+    return hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()
+
+
+class SummaryCache:
+    """
+    Persistent cache of per-subject summaries stored in a sqlite file. Each entry is a pickled summary dict and keeps
+    the time it was last used. If there are more than max_entries entries, the least recently used ones are evicted.
+    """
+
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE, max_entries=DEFAULT_MAX_ENTRIES):
+        from pathlib import Path
+        Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS summaries "
+                                "(key TEXT PRIMARY KEY, summary BLOB NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+        self.connection.commit()
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        # stay below the sqlite limit of host parameters per statement
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT key, summary FROM summaries WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            found.update((key, pickle.loads(summary)) for key, summary in rows)
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("UPDATE summaries SET last_used = ? WHERE key = ?",
+                                        [(now, key) for key in found])
+        return found
+
+    def put_many(self, summaries):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO summaries (key, summary, last_used) VALUES (?, ?, ?)",
+                                        [(key, pickle.dumps(summary), now) for key, summary in summaries.items()])
+        self.evict()
+
+    def evict(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM summaries WHERE key NOT IN "
+                                    "(SELECT key FROM summaries ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM summaries")
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from agd_reader import TICKS_AT_UNIX_EPOCH
+
+# encodings of the sleep reports exported by ActiLife on different systems
+ENCODINGS = ['utf-8', 'cp1252', 'utf-8-sig', 'utf-16']
+
+WEAR_TIME_DATE_FORMAT = "%d.%m.%Y %H:%M:%S"
+
+REPORT_COLUMNS = ["In Bed Date", "In Bed Time", "Out Bed Date", "Out Bed Time", "Onset Date", "Onset Time", "Latency",
+                  "Total Counts", "Efficiency", "Total Minutes in Bed", "Total Sleep Time (TST)",
+                  "Wake After Sleep Onset (WASO)", "Number of Awakenings", "Average Awakening Length",
+                  "Movement Index", "Fragmentation Index", "Sleep Fragmentation Index"]
+
+
+def datetime_to_ticks(dt):
+    return int((np.datetime64(dt, 'ns') - np.datetime64(0, 'ns')).astype(np.int64)) // 100 + TICKS_AT_UNIX_EPOCH
+
+
+def activity_counts(start, n_epochs, epoch, rng):
+    """
+    Vertical axis counts with a day/night rhythm: high activity from 7 to 23 o'clock, low activity at night and
+    randomly scattered epochs without activity.
+    """
+    hours = (start.hour + start.minute / 60 + np.arange(n_epochs) * epoch / 3600) % 24
+    day = (hours > 7) & (hours < 23)
+    counts = np.where(day, rng.poisson(200, n_epochs), rng.poisson(2, n_epochs))
+    counts[rng.random(n_epochs) < 0.05] = 0
+    return counts
+
+
+def non_wear_gaps(start, end, gaps_per_week, rng):
+    """
+    Random non-wear periods of 1 to 6 hours, returned as sorted list of (start, end) datetimes.
+    """
+    n_gaps = int(round(gaps_per_week * (end - start) / timedelta(weeks=1)))
+    latest_start = (end - start) // timedelta(minutes=1) - 420
+    if n_gaps == 0 or latest_start <= 60:
+        return []
+    gap_starts = sorted(start + timedelta(minutes=int(minutes)) for minutes in rng.integers(60, latest_start, n_gaps))
+    gaps = []
+    for gap_start in gap_starts:
+        if gaps and gap_start <= gaps[-1][1]:
+            continue
+        gaps.append((gap_start, gap_start + timedelta(minutes=int(rng.integers(60, 360)))))
+    return gaps
+
+
+def write_agd(fname, subject, start, weeks=1, epoch=60, gaps_per_week=2, seed=0):
+    """
+    Writes an agd (sqlite) file with the settings and data tables read by pyActigraphy and the LeanAGD reader. There
+    is no activity during the non-wear gaps. Returns the wear time intervals, the recording without the gaps.
+    """
+    rng = np.random.default_rng(seed)
+    n_epochs = int(weeks * 7 * 86400 // epoch)
+    end = start + timedelta(seconds=n_epochs * epoch)
+
+    axis1 = activity_counts(start, n_epochs, epoch, rng)
+    gaps = non_wear_gaps(start, end, gaps_per_week, rng)
+    epoch_starts = np.datetime64(start, 's') + np.arange(n_epochs) * np.timedelta64(epoch, 's')
+    for gap_start, gap_end in gaps:
+        axis1[(epoch_starts >= np.datetime64(gap_start, 's')) & (epoch_starts < np.datetime64(gap_end, 's'))] = 0
+
+    start_ticks = datetime_to_ticks(start)
+    timestamps = start_ticks + np.arange(n_epochs, dtype=np.int64) * epoch * 10 ** 7
+    settings = {'subjectname': subject, 'deviceserial': f'MOS2D{seed:08d}', 'startdatetime': str(start_ticks),
+                'epochlength': str(epoch), 'devicename': 'GT3X+'}
+
+    if os.path.exists(fname):
+        os.remove(fname)
+    connection = sqlite3.connect(fname)
+    try:
+        connection.execute("CREATE TABLE settings (settingID INTEGER, settingName TEXT, settingValue TEXT)")
+        connection.executemany("INSERT INTO settings VALUES (?, ?, ?)",
+                               [(i, name, value) for i, (name, value) in enumerate(settings.items())])
+        connection.execute("CREATE TABLE data (dataTimestamp INTEGER, axis1 INTEGER, axis2 INTEGER, axis3 INTEGER, "
+                           "steps INTEGER, lux INTEGER, inclineOff INTEGER, inclineStanding INTEGER, "
+                           "inclineSitting INTEGER, inclineLying INTEGER)")
+        rows = np.column_stack([timestamps, axis1, axis1 // 2, axis1 // 3, np.zeros((n_epochs, 6), dtype=np.int64)])
+        connection.executemany("INSERT INTO data VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows.tolist())
+        connection.commit()
+    finally:
+        connection.close()
+
+    bounds = [start] + [time for gap in gaps for time in gap] + [end]
+    return [(bounds[i], bounds[i + 1]) for i in range(0, len(bounds), 2) if bounds[i] < bounds[i + 1]]
+
+
+def write_wear_times(fname, subject, intervals):
+    """
+    Writes the wear time intervals of a subject in the format of ActiLife's WearTimeValidationDetails.csv.
+    """
+    lines = ['"Subject","Wear Time Start","Wear Time End","Duration"']
+    for start, end in intervals:
+        lines.append(f'"{subject}","{start.strftime(WEAR_TIME_DATE_FORMAT)}","{end.strftime(WEAR_TIME_DATE_FORMAT)}",'
+                     f'"{(end - start) // timedelta(minutes=1)}"')
+    with open(fname, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def _report_row(in_bed, out_bed, onset, latency, tst, rng):
+    def decimal(low, high):
+        return f"{rng.uniform(low, high):.2f}".replace('.', ',')
+
+    tbt = (out_bed - in_bed) // timedelta(minutes=1)
+    values = [in_bed.strftime('%d.%m.%Y'), in_bed.strftime('%H:%M'), out_bed.strftime('%d.%m.%Y'),
+              out_bed.strftime('%H:%M'), onset.strftime('%d.%m.%Y'), onset.strftime('%H:%M'), latency,
+              int(rng.integers(1000, 20000)), decimal(70, 95), tbt, tst, tbt - latency - tst,
+              int(rng.integers(3, 30)), decimal(1, 6), decimal(1, 20), decimal(1, 30), decimal(5, 40)]
+    return ','.join(f'"{value}"' for value in values)
+
+
+def write_sleep_report(fname, subject, first_night, nights=14, encoding='utf-8', seed=0):
+    """
+    Writes an ActiLife style sleep report with a few header lines and one sleep period per night, the fourth night
+    has an additional nap in the morning. The report is encoded with encoding and has CRLF line endings.
+    """
+    rng = np.random.default_rng(seed)
+    lines = [f'"Subject Name: {subject}"', f'"Serial Number: MOS2D{seed:08d}"', '"Sleep Algorithm: Sadeh"',
+             f'"Exported: {(first_night + timedelta(days=nights + 1)).strftime("%d.%m.%Y %H:%M")}"', '',
+             ','.join(f'"{column}"' for column in REPORT_COLUMNS)]
+
+    for night in range(nights):
+        in_bed = first_night + timedelta(days=night, hours=22, minutes=int(rng.integers(-60, 120)))
+        duration = int(rng.integers(360, 560))
+        latency = int(rng.integers(0, 40))
+        out_bed = in_bed + timedelta(minutes=duration)
+        tst = duration - latency - int(rng.integers(10, 80))
+        lines.append(_report_row(in_bed, out_bed, in_bed + timedelta(minutes=latency), latency, tst, rng))
+        if night == 3:
+            nap = out_bed + timedelta(hours=2)
+            lines.append(_report_row(nap, nap + timedelta(minutes=60), nap + timedelta(minutes=5), 5, 50, rng))
+
+    with open(fname, 'w', encoding=encoding, newline='\r\n') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def write_cohort(folder, n_subjects, weeks=1, epoch=60, gaps_per_week=2, encodings=ENCODINGS, seed=0):
+    """
+    Writes a search folder with a sub-folder for each subject, containing its agd file, sleep report and wear time
+    validation file like the folders searched by crawl_files.search_folder. The reports cycle through the encodings.
+    Returns the subject names.
+    """
+    subjects = [f"{100 + i}" for i in range(n_subjects)]
+    first_day = datetime(2021, 3, 1)
+
+    for i, subject in enumerate(subjects):
+        subfolder = os.path.join(folder, subject)
+        os.makedirs(os.path.join(subfolder, 'wear'), exist_ok=True)
+
+        start = first_day + timedelta(days=i % 7, hours=9, minutes=17 * (i % 20))
+        intervals = write_agd(os.path.join(subfolder, f"{subject}.agd"), subject, start, weeks, epoch,
+                              gaps_per_week, seed + i)
+        write_wear_times(os.path.join(subfolder, 'wear', f"{subject}WearTimeValidationDetails.csv"), subject,
+                         intervals)
+        write_sleep_report(os.path.join(subfolder, f"{subject}-sleep-report.csv"), f"{subject} Müller",
+                           datetime(start.year, start.month, start.day), max(1, int(weeks * 7) - 1),
+                           encodings[i % len(encodings)], seed + i)
+
+    return subjects
+
+
+if __name__ == '__main__':
+
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Writes a search folder of synthetic subjects with agd files, wear time validation files and '
+                    'sleep reports, e.g. for benchmarks and testing without patient data.')
+
+    parser.add_argument('-o', '--output-folder', dest="output_folder", required=True,
+                        help='Search folder to write the subject sub-folders to')
+    parser.add_argument('-n', '--subjects', dest="subjects", type=int, default=10, help='Number of subjects')
+    parser.add_argument('--weeks', dest="weeks", type=float, default=1, help='Weeks of recording per subject')
+    parser.add_argument('--epoch', dest="epoch", type=int, default=60, help='Epoch length in seconds')
+    parser.add_argument('--gaps-per-week', dest="gaps_per_week", type=float, default=2,
+                        help='Average number of non-wear gaps per week')
+    parser.add_argument('--encodings', dest="encodings", nargs='+', default=ENCODINGS,
+                        help=f'Encodings of the sleep reports, default: {" ".join(ENCODINGS)}')
+    parser.add_argument('--seed', dest="seed", type=int, default=0, help='Seed of the random data')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    subjects = write_cohort(args.output_folder, args.subjects, args.weeks, args.epoch, args.gaps_per_week,
+                            args.encodings, args.seed)
+    print(f"Wrote {len(subjects)} subjects to {args.output_folder}")
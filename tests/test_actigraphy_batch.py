@@ -0,0 +1,18 @@
+import pandas as pd
+
+from actigraphy_batch import compute_summary_and_averages, search_folder_files
+from synthetic_data import write_cohort
+
+
+def test_averages_with_and_without_result_log(tmp_path):
+    search_folder = str(tmp_path / 'search')
+    write_cohort(search_folder, 7, weeks=1, epoch=60, gaps_per_week=3)
+    agd_files, wear_files, pattern = search_folder_files(search_folder)
+
+    data, averages = compute_summary_and_averages(agd_files, wear_files, pattern, n_jobs=1)
+    logged_data, logged_averages = compute_summary_and_averages(agd_files, wear_files, pattern, n_jobs=1,
+                                                                result_log_file=str(tmp_path / 'results.jsonl'))
+
+    pd.testing.assert_frame_equal(logged_data, data)
+    pd.testing.assert_series_equal(logged_averages, averages, check_exact=True)
+    assert logged_averages.to_csv() == averages.to_csv()
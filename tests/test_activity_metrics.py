@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from actigraphy_batch import read_agd, summarize_reader
+from synthetic_data import write_agd, write_wear_times
+from wear_times import read_wear_time_intervals
+
+LX_HOURS = (3, 7)
+MX_HOURS = (6,)
+
+
+def reference_summary(reader, lx_hours=LX_HOURS, mx_hours=MX_HOURS):
+    """
+    The metrics of a pyActigraphy reader computed by pyActigraphy. The Lx/Mx midpoints are sets of all midpoints of
+    windows with the same mean activity, as pyActigraphy breaks such ties by the rounding errors of its rolling sums.
+    """
+    from pyActigraphy.metrics.metrics import _lmx as lmx, _average_daily_activity
+
+    data = {'ADAT': reader.ADAT(), 'RA': reader.RA(), 'IS': reader.IS(), 'IV': reader.IV(), 'ISm': reader.ISm(),
+            'IVm': reader.IVm()}
+    profile = _average_daily_activity(reader.binarized_data(4), cyclic=True)
+    for prefix, hours_list, lowest in [('L', (5,) + lx_hours, True), ('M', (10,) + mx_hours, False)]:
+        for hours in hours_list:
+            _, value = lmx(reader.binarized_data(4), f'{hours}H', lowest=lowest)
+            n_epochs = int(pd.Timedelta(hours=hours) / profile.index.freq)
+            means = profile.rolling(f'{hours}H').sum().shift(-n_epochs + 1) / n_epochs
+            starts = means.index[np.isclose(means, value, rtol=0, atol=1e-12)]
+            data[f'{prefix}{hours}'] = value
+            data[f'{prefix}{hours} Midpoint'] = {(datetime(2021, 1, 1) + timedelta(hours=hours / 2) + start).time()
+                                                 for start in starts}
+    return data
+
+
+@pytest.fixture(scope='module')
+def subject_files(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('agd')
+    agd_file = str(folder / '100.agd')
+    wear_time_file = str(folder / '100WearTimeValidationDetails.csv')
+    intervals = write_agd(agd_file, '100', datetime(2021, 3, 1, 9, 17), weeks=2, epoch=30, gaps_per_week=3)
+    write_wear_times(wear_time_file, '100', intervals)
+    return agd_file, read_wear_time_intervals([wear_time_file])
+
+
+@pytest.mark.parametrize('masked', [False, True])
+@pytest.mark.parametrize('lean_reader', [True, False])
+def test_summary_matches_pyactigraphy(subject_files, masked, lean_reader):
+    agd_file, wear_time_intervals = subject_files
+    wear_time_intervals = wear_time_intervals if masked else None
+    result = summarize_reader(read_agd(agd_file, lean=lean_reader), wear_time_intervals,
+                              {'lx_hours': LX_HOURS, 'mx_hours': MX_HOURS})
+
+    reference_reader = read_agd(agd_file)
+    summarize_reader(reference_reader, wear_time_intervals, summarize=lambda reader, mask_set: None)
+    expected = reference_summary(reference_reader)
+
+    assert result['Mask_fraction'] > 0 if masked else result['Mask_fraction'] == 0
+    for metric, value in expected.items():
+        if metric.endswith('Midpoint'):
+            assert result[metric] in value, metric
+        else:
+            assert np.isclose(result[metric], value, rtol=1e-9, atol=1e-12), metric
@@ -0,0 +1,29 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from actigraphy_batch import compute_summary_and_averages, search_folder_files, summary_table
+from cli import subject
+from result_log import read_results
+from synthetic_data import write_agd, write_wear_times
+
+
+def test_subject_equals_its_batch_row(tmp_path):
+    search_folder = str(tmp_path / 'search')
+    for i, name in enumerate(['100', '101']):
+        os.makedirs(os.path.join(search_folder, name, 'wear'))
+        intervals = write_agd(os.path.join(search_folder, name, f"{name}.agd"), name, datetime(2021, 3, 1 + i, 9, 17),
+                              weeks=1, epoch=60, gaps_per_week=3, seed=i)
+        # the subject of the wear times is only given by the pattern of the file path
+        write_wear_times(os.path.join(search_folder, name, 'wear', f"{name}WearTimeValidationDetails.csv"),
+                         'unknown', intervals)
+    agd_files, wear_files, pattern = search_folder_files(search_folder)
+    data, _ = compute_summary_and_averages(agd_files, wear_files, pattern, n_jobs=1)
+
+    result_log_file = str(tmp_path / 'results.jsonl')
+    subject([agd_files[1], '-w', wear_files[1], '--subject-filename-pattern', pattern.pattern, '-o', result_log_file])
+    single = summary_table([subject_summary for _, subject_summary in read_results(result_log_file)])
+
+    assert data.loc[101, 'Mask_fraction'] > 0
+    pd.testing.assert_frame_equal(single, data.loc[[101]])
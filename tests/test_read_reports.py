@@ -0,0 +1,22 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from read_reports import detect_encoding, read_report
+from synthetic_data import write_sleep_report
+
+
+@pytest.mark.parametrize('encoding', ['utf-16-le', 'utf-16-be'])
+def test_utf16_report_without_bom(tmp_path, encoding):
+    expected_file = str(tmp_path / '100-sleep-report-utf8.csv')
+    report_file = str(tmp_path / '100-sleep-report.csv')
+    write_sleep_report(expected_file, '100', datetime(2021, 3, 1), encoding='utf-8')
+    write_sleep_report(report_file, '100', datetime(2021, 3, 1), encoding=encoding)
+
+    with open(report_file, 'rb') as file:
+        assert detect_encoding(file.read()) == encoding
+    subject, data, _ = read_report(report_file)
+    expected_subject, expected_data, _ = read_report(expected_file)
+    assert subject == expected_subject
+    pd.testing.assert_frame_equal(data, expected_data)
@@ -0,0 +1,61 @@
+from datetime import time
+
+import pandas as pd
+
+from results_db import ResultsDB, parse_condition
+
+
+def results_db(tmp_path):
+    db = ResultsDB(str(tmp_path / 'results.sqlite'))
+    db.upsert('acti', pd.DataFrame({'IS': [0.3, 0.5, 0.2], 'M10 Midpoint': [time(13, 37), time(15, 20), time(17, 36)],
+                                    'L5 Midpoint': [time(23, 50), time(2, 10), time(3, 30)]},
+                                   index=['100', '101', '102']))
+    db.upsert('reports', pd.DataFrame({'Average MPOS (Workdays)': [time(2, 30), time(23, 30), time(3, 30)]},
+                                      index=['100', '101', '102']))
+    return db
+
+
+def test_conditions_match_across_runs(tmp_path):
+    db = results_db(tmp_path)
+    table = db.query(conditions=[parse_condition("IS < 0.4"), parse_condition("Average MPOS (Workdays) > 03:00")])
+    db.close()
+
+    assert list(table.index) == ['102']
+    assert table.loc['102', 'IS'] == 0.2
+    assert table.loc['102', 'Average MPOS (Workdays)'] == '03:30:00'
+
+
+def test_times_compare_after_midnight(tmp_path):
+    db = results_db(tmp_path)
+    late = db.query(conditions=[parse_condition("Average MPOS (Workdays) > 23:00")])
+    early = db.query(conditions=[parse_condition("Average MPOS (Workdays) < 03:00")])
+    db.close()
+
+    assert list(late.index) == ['100', '101', '102']
+    assert list(early.index) == ['100', '101']
+
+
+def test_midpoints_compare_in_the_afternoon(tmp_path):
+    db = results_db(tmp_path)
+    afternoon = db.query(conditions=[parse_condition("M10 Midpoint > 13:00")])
+    late = db.query(conditions=[parse_condition("M10 Midpoint >= 15:20")])
+    night = db.query(conditions=[parse_condition("L5 Midpoint > 23:00"), parse_condition("L5 Midpoint < 03:00")])
+    db.close()
+
+    assert list(afternoon.index) == ['100', '101', '102']
+    assert list(late.index) == ['101', '102']
+    assert list(night.index) == ['100', '101']
+
+
+def test_aggregates_of_times_are_times_of_day(tmp_path):
+    db = results_db(tmp_path)
+    aggregates = db.aggregate(metrics=['M10 Midpoint', 'L5 Midpoint', 'Average MPOS (Workdays)', 'IS'])
+    db.close()
+
+    assert aggregates.loc[('acti', 'M10 Midpoint'), 'mean'] == time(15, 31)
+    assert aggregates.loc[('acti', 'M10 Midpoint'), 'min'] == time(13, 37)
+    assert aggregates.loc[('acti', 'M10 Midpoint'), 'max'] == time(17, 36)
+    assert aggregates.loc[('acti', 'L5 Midpoint'), 'mean'] == time(1, 50)
+    assert aggregates.loc[('reports', 'Average MPOS (Workdays)'), 'mean'] == time(1, 50)
+    assert aggregates.loc[('reports', 'Average MPOS (Workdays)'), 'max'] == time(3, 30)
+    assert abs(aggregates.loc[('acti', 'IS'), 'mean'] - 1 / 3) < 1e-12
@@ -0,0 +1,28 @@
+import os
+
+from agd_store import convert_agd_files, stored_data_files
+from sharding import file_subject, select_shard, shard_of
+from synthetic_data import write_cohort
+
+
+def test_files_of_a_subject_share_a_shard(tmp_path):
+    search_folder = str(tmp_path / 'search')
+    subjects = write_cohort(search_folder, 6, weeks=1)
+    agd_files = [os.path.join(search_folder, subject, f"{subject}.agd") for subject in subjects]
+    reports_files = [os.path.join(search_folder, subject, f"{subject}-sleep-report.csv") for subject in subjects]
+    convert_agd_files(agd_files, str(tmp_path / 'store'), n_jobs=1)
+    data_files = sorted(stored_data_files(str(tmp_path / 'store')))
+
+    assert [file_subject(fname) for fname in agd_files] == subjects
+    assert [file_subject(fname) for fname in reports_files] == subjects
+    assert [file_subject(fname, "(.*)-sleep-report*") for fname in reports_files] == subjects
+    assert [file_subject(fname) for fname in data_files] == subjects
+
+    for n_shards in (2, 3):
+        for index in range(1, n_shards + 1):
+            shard = (index, n_shards)
+            expected = [subject for subject in subjects if shard_of(subject, n_shards) == index]
+            assert [file_subject(fname) for fname in select_shard(agd_files, shard)] == expected
+            assert [file_subject(fname) for fname in select_shard(reports_files, shard, "(.*)-sleep-report*")] \
+                == expected
+            assert [file_subject(fname) for fname in select_shard(data_files, shard)] == expected
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from sleep_scoring import cole_kripke, sadeh
+
+
+def synthetic_minute_counts(seed=0, n_pairs=3000):
+    """
+    Counts per minute alternating between quiet stretches, stretches in the range counted by NAT (without its bounds
+    50 and 100, which pyActigraphy excludes) and active stretches up to the Sadeh cap. Each count is repeated for two
+    minutes.
+    """
+    rng = np.random.default_rng(seed)
+    levels = [(0, 10), (51, 100), (101, 301)]
+    stretches = [rng.integers(*levels[rng.integers(len(levels))], size=rng.integers(5, 60)) for _ in range(n_pairs)]
+    return np.repeat(np.concatenate(stretches)[:n_pairs], 2).astype(np.float64)
+
+
+def test_sadeh_matches_pyactigraphy():
+    from pyActigraphy.sleep.scoring_base import _sadeh
+
+    counts = synthetic_minute_counts()
+    expected = _sadeh(pd.Series(counts), 7.601, np.array([-0.065, -1.08, -0.056, -0.703]), -4).to_numpy()
+    asleep = sadeh(counts)
+
+    # pyActigraphy takes logAct from the minute after the scored one (data.shift(-1)), the first minute of each pair
+    # has the same count as the next one. The edges lack a full window in pyActigraphy.
+    first_minutes = np.arange(6, len(counts) - 6, 2)
+    assert asleep[first_minutes].any() and not asleep[first_minutes].all()
+    np.testing.assert_array_equal(asleep[first_minutes], expected[first_minutes] == 1)
+
+
+def test_cole_kripke_matches_pyactigraphy():
+    from pyActigraphy.sleep.scoring_base import _cole_kripke
+
+    counts = synthetic_minute_counts(seed=1)
+    # the weights of Cole and Kripke (1992) of the 4 minutes before to the 2 minutes after the scored minute, in
+    # pyActigraphy's centered window of 9 minutes
+    window = np.array([106, 54, 58, 76, 230, 74, 67, 0, 0])
+    expected = _cole_kripke(pd.Series(counts), 0.001 / 100, window, 1.0).to_numpy()
+    asleep = cole_kripke(counts)
+
+    assert asleep[4:-4].any() and not asleep[4:-4].all()
+    np.testing.assert_array_equal(asleep[4:-4], expected[4:-4] == 1)
@@ -0,0 +1,9 @@
+import benchmark
+
+
+def test_modules_defer_slow_imports():
+    assert benchmark.deferred_import_violations() == []
+
+
+def test_commands_defer_slow_imports():
+    assert benchmark.command_import_violations() == []
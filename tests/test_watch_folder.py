@@ -0,0 +1,58 @@
+import os
+
+import synthetic_data
+from watch_folder import FolderWatcher
+
+
+def age(path, seconds=3600):
+    # moves the mtime into the past, so that the listing of a directory is reused from the manifest
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - seconds * 10 ** 9))
+
+
+def age_all(folder):
+    for path in [*folder.rglob('*'), folder]:
+        age(path)
+
+
+def test_poll_finds_file_overwritten_in_place(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    folder = tmp_path / 'search'
+    synthetic_data.write_cohort(str(folder), 2, weeks=1 / 7, gaps_per_week=0)
+    agd_file = folder / '100' / '100.agd'
+    age_all(folder)
+
+    watcher = FolderWatcher(str(folder), settle=0)
+    watcher.manifest_file = str(tmp_path / 'manifest.json')
+    assert watcher.poll()
+    assert not watcher.poll()
+
+    # rewritten in place, the directory mtime does not change
+    directory_mtime = os.stat(agd_file.parent).st_mtime_ns
+    with open(agd_file, 'r+b') as file:
+        file.seek(0, os.SEEK_END)
+        file.write(b'\0' * 16)
+    assert os.stat(agd_file.parent).st_mtime_ns == directory_mtime
+    age(agd_file, 60)
+
+    assert watcher.poll()
+    assert not watcher.poll()
+
+
+def test_poll_waits_until_file_settled(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    folder = tmp_path / 'search'
+    synthetic_data.write_cohort(str(folder), 1, weeks=1 / 7, gaps_per_week=0)
+    agd_file = folder / '100' / '100.agd'
+    age_all(folder)
+
+    watcher = FolderWatcher(str(folder), settle=30)
+    watcher.manifest_file = str(tmp_path / 'manifest.json')
+    assert watcher.poll()
+
+    # a file that is still being written is not processed before it settled
+    with open(agd_file, 'ab') as file:
+        file.write(b'\0' * 16)
+    assert not watcher.poll()
+    age(agd_file, 60)
+    assert watcher.poll()
@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from actigraphy_batch import process_subject
+from synthetic_data import write_agd, write_wear_times
+from wear_times import read_wear_times, read_wear_time_intervals, wear_time_intervals_by_subject
+
+
+def test_no_wear_times_give_no_intervals(tmp_path):
+    wear_time_file = str(tmp_path / '100WearTimeValidationDetails.csv')
+    write_wear_times(wear_time_file, '100', [])
+
+    assert read_wear_time_intervals([wear_time_file]) == {}
+    assert wear_time_intervals_by_subject(read_wear_times([])) == {}
+
+
+def test_subject_without_wear_times_is_not_masked(tmp_path):
+    agd_file = str(tmp_path / '100.agd')
+    wear_time_file = str(tmp_path / '100WearTimeValidationDetails.csv')
+    write_agd(agd_file, '100', datetime(2021, 3, 1, 9, 17), weeks=1, gaps_per_week=0)
+    write_wear_times(wear_time_file, '100', [])
+
+    subject_summary = process_subject(agd_file, read_wear_time_intervals([wear_time_file]))
+    assert subject_summary['subject'] == '100'
+    assert subject_summary['Mask_fraction'] == 0
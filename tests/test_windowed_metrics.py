@@ -0,0 +1,70 @@
+import copy
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from activity_metrics import ActivityMetrics
+from actigraphy_batch import get_wear_time_mask, read_agd
+from synthetic_data import write_agd
+from windowed_metrics import METRICS, WindowedMetrics
+
+
+@pytest.fixture(scope='module')
+def masked_reader(tmp_path_factory):
+    agd_file = str(tmp_path_factory.mktemp('agd') / '100.agd')
+    intervals = write_agd(agd_file, '100', datetime(2021, 3, 1, 9, 17), weeks=2, epoch=60, gaps_per_week=4)
+    reader = read_agd(agd_file, lean=True)
+    starts, stops = (np.array([interval[i] for interval in intervals], dtype='datetime64[ns]') for i in (0, 1))
+    reader.mask = get_wear_time_mask(reader, {'100': (starts, stops)})
+    reader.mask_inactivity = True
+    return reader
+
+
+def reader_piece(reader, begin, end):
+    # a reader of the epochs from begin to end (exclusive) of a reader
+    piece = copy.copy(reader)
+    piece.raw_data = reader.raw_data.iloc[begin:end]
+    piece.mask = reader.mask.iloc[begin:end]
+    return piece
+
+
+def test_append_in_pieces_equals_single_pass(masked_reader):
+    whole = WindowedMetrics(masked_reader)
+    appended = WindowedMetrics()
+    # a piece ending at a day boundary, pieces ending within a day and a piece overlapping the data added before
+    for begin, end in [(0, 1440), (1440, 3000), (3000, 3001), (2900, 9000), (9000, masked_reader.length())]:
+        appended.append(reader_piece(masked_reader, begin, end))
+
+    for n_days in (1, 3, 7):
+        pd.testing.assert_frame_equal(appended.windows(n_days), whole.windows(n_days), rtol=1e-9)
+
+
+def test_whole_recording_window_equals_activity_metrics(masked_reader):
+    windowed = WindowedMetrics(masked_reader)
+    window = windowed.window_table([0], [windowed.n_days]).iloc[0]
+    metrics = ActivityMetrics(masked_reader)
+    expected = {'IS': metrics.IS(), 'IV': metrics.IV(), 'RA': metrics.RA(), 'L5': metrics.L5(), 'M10': metrics.M10()}
+
+    for metric in METRICS:
+        assert np.isclose(window[metric], expected[metric], rtol=1e-9), metric
+
+
+def test_masked_epochs_are_not_counted_as_inactive(masked_reader):
+    days = WindowedMetrics(masked_reader).windows(1)
+    binarized = np.where(masked_reader.data.to_numpy() > 4, 1., 0.)
+    binarized[np.isnan(masked_reader.data.to_numpy())] = np.nan
+    binarized = binarized.reshape(-1, 1440)
+    partly_masked = [day for day in range(len(binarized)) if 0 < np.isnan(binarized[day]).sum() < 1440 - 300]
+    assert partly_masked
+
+    for day in partly_masked:
+        # the least active 5 hours of the day among the windows without masked epochs
+        windows = np.lib.stride_tricks.sliding_window_view(np.concatenate([binarized[day], binarized[day][:299]]), 300)
+        expected = np.nanmin(np.where(np.isnan(windows).any(axis=1), np.nan, windows.mean(axis=1)))
+        assert days.loc[day, 'L5'] > 0
+        # NaN if the day has no 10 hours without masked epochs
+        assert np.isnan(days.loc[day, 'RA']) or days.loc[day, 'RA'] < 1
+        assert np.isclose(days.loc[day, 'L5'], expected)
+    assert days['IS'].isna().all()
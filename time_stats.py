@@ -0,0 +1,140 @@
+import numbers
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+from datetime import time
+
+DAY_MINUTES = 24 * 60
+
+
+def mid_point_of_sleep(onset, tst):
+    """
+    Mid point of sleep of each night, the sleep onset plus half of the total sleep time (TST) in minutes.
+    """
+    return onset + pd.to_timedelta(tst / 2, unit='m')
+
+
+def minutes_of_day(times):
+    """
+    Minutes since midnight (seconds are dropped) of datetimes or datetime.time objects as int64 array.
+    """
+    times = pd.Series(times)
+    if pd.api.types.is_datetime64_any_dtype(times):
+        return (times.dt.hour * 60 + times.dt.minute).to_numpy(dtype=np.int64)
+    offsets = pd.to_timedelta(times.astype(str)).to_numpy()
+    return (offsets // np.timedelta64(1, 'm')).astype(np.int64)
+
+
+def pivot_minutes(minutes, pivot=14):
+    """
+    Moves times up to the pivot hour to the next day, so that times around midnight can be averaged on a 48h scale.
+    """
+    return np.where(minutes // 60 > pivot, minutes, minutes + DAY_MINUTES)
+
+
+def minutes_to_time(minutes):
+    """
+    Time of day of a number of minutes since midnight, truncated to whole minutes. NaN gives None.
+    """
+    if pd.isna(minutes):
+        return None
+    h, m = divmod(int(minutes) % DAY_MINUTES, 60)
+    return time(hour=h, minute=m, second=0)
+
+
+def _pivoted_table(data, columns, pivot):
+    return pd.DataFrame({column: pivot_minutes(minutes_of_day(data[column]), pivot) for column in columns},
+                        index=data.index)
+
+
+def _group_keys(data, by):
+    # column names of data are replaced by the columns, as the grouped tables do not contain them
+    keys = by if isinstance(by, list) else [by]
+    return [data[key] if isinstance(key, str) and key in data else key for key in keys]
+
+
+def average_times_48(data, columns, pivot=14, by=None):
+    """
+    Averages the times of day of the columns on a 48h scale: times up to the pivot hour count as times of the next
+    day. Without by, returns a Series with the average time of each column. Otherwise the rows are grouped by the
+    given keys (column names of data or anything else accepted by DataFrame.groupby) and a DataFrame with one row per
+    group is returned. Columns without any values average to None.
+    """
+    minutes = _pivoted_table(data, columns, pivot)
+    means = minutes.mean() if by is None else minutes.groupby(_group_keys(data, by)).mean()
+    means = means.where(means < DAY_MINUTES, means - DAY_MINUTES)
+    return means.map(minutes_to_time) if by is None else means.applymap(minutes_to_time)
+
+
+def circular_time_stats(data, columns, by=None):
+    """
+    Circular mean (as time of day) and circular standard deviation (in minutes) of the times of day of the columns,
+    which needs no pivot hour. Returns a Series (or with by, a DataFrame with one row per group) with the columns
+    '<column> Circular Mean' and '<column> Circular SD'.
+    """
+    angles = pd.DataFrame({column: minutes_of_day(data[column]) * (2 * np.pi / DAY_MINUTES) for column in columns},
+                          index=data.index)
+    sines, cosines = np.sin(angles), np.cos(angles)
+    if by is None:
+        sines, cosines = sines.mean(), cosines.mean()
+    else:
+        sines, cosines = sines.groupby(_group_keys(data, by)).mean(), cosines.groupby(_group_keys(data, by)).mean()
+
+    mean_minutes = np.mod(np.arctan2(sines, cosines), 2 * np.pi) * (DAY_MINUTES / (2 * np.pi))
+    resultant = np.minimum(np.hypot(sines, cosines), 1.)
+    with np.errstate(divide='ignore'):
+        sd_minutes = np.sqrt(-2 * np.log(resultant)) * (DAY_MINUTES / (2 * np.pi))
+
+    # rounded so that float errors do not truncate e.g. 23:00 to 22:59
+    mean_minutes = mean_minutes.round(6)
+    means = mean_minutes.map(minutes_to_time) if by is None else mean_minutes.applymap(minutes_to_time)
+    return pd.concat([means.add_suffix(' Circular Mean'), sd_minutes.add_suffix(' Circular SD')],
+                     axis=0 if by is None else 1)
+
+
+class RunningAverages:
+    """
+    Averages over the rows of a table, kept up to date when rows are added or removed without going over all rows
+    again. The times of day of the time_names columns are averaged on a 48h scale with the pivot hour like
+    compute_time_averages, the other numeric values as they are. Missing values are skipped. The sums are exact
+    (floats are added as fractions), so that the averages do not depend on the order of the rows and removing a row
+    leaves no rounding errors behind.
+    """
+
+    def __init__(self, time_names=(), pivot=14):
+        self.time_names = list(time_names)
+        self.pivot = pivot
+        self.sums = {}
+        self.counts = {}
+
+    def _values(self, row):
+        for name, value in row.items():
+            if name in self.time_names:
+                if isinstance(value, time):
+                    yield name, int(pivot_minutes(value.hour * 60 + value.minute, self.pivot))
+            elif isinstance(value, numbers.Integral) and not isinstance(value, (bool, np.bool_)):
+                yield name, int(value)
+            elif isinstance(value, numbers.Real) and not np.isnan(value):
+                yield name, Fraction(float(value))
+
+    def add(self, row):
+        for name, value in self._values(row):
+            self.sums[name] = self.sums.get(name, 0) + value
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def remove(self, row):
+        for name, value in self._values(row):
+            self.sums[name] -= value
+            self.counts[name] -= 1
+            if not self.counts[name]:
+                del self.sums[name], self.counts[name]
+
+    def averages(self):
+        averages = pd.Series(dtype=object)
+        for name in [name for name in self.sums if name not in self.time_names]:
+            averages[name] = float(self.sums[name] / self.counts[name])
+        for name in [name for name in self.time_names if name in self.sums]:
+            minutes = self.sums[name] / self.counts[name]
+            averages[name] = minutes_to_time(minutes if minutes < DAY_MINUTES else minutes - DAY_MINUTES)
+        return averages
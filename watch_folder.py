@@ -0,0 +1,230 @@
+import os
+import time
+
+import pandas as pd
+
+import crawl_files
+from output_writers import write_outputs, FORMATS, DEFAULT_FORMATS
+from time_stats import RunningAverages
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class FolderWatcher:
+    """
+    Keeps the actigraphy summaries and the sleep report averages of the subject sub-folders of a search folder up to
+    date. Each poll searches the folder (with a manifest, so that only changed directories are listed) and processes
+    only the subjects whose files were added, changed or removed since the last poll. Files modified less than settle
+    seconds ago are skipped until a later poll, as they may still be uploaded. The output tables are rewritten after
+    each poll that changed them, the actigraphy averages over all subjects are kept as running averages.
+    """
+
+    def __init__(self, search_folder, acti_output=None, reports_output=None, n_jobs=None, cache=None,
+                 summary_kwargs=None, subject_filename_pattern=None, report_filename_pattern="(.*)-sleep-report*",
+                 settle=30, formats=DEFAULT_FORMATS):
+        import re
+        from actigraphy_batch import search_folder_pattern
+
+        self.search_folder = search_folder
+        self.acti_output = acti_output
+        self.reports_output = reports_output
+        self.n_jobs = n_jobs
+        self.cache = cache
+        self.summary_kwargs = summary_kwargs
+        self.fname_pattern = search_folder_pattern(search_folder, subject_filename_pattern)
+        self.report_pattern = re.compile(report_filename_pattern) if report_filename_pattern else None
+        self.settle_ns = int(settle * 10 ** 9)
+        self.formats = formats
+        self.manifest_file = crawl_files.default_manifest_file(search_folder)
+
+        self.processed = {}  # sub-folder -> signature (path, size and mtime of its files) when it was processed
+        self.summaries = {}  # sub-folder -> actigraphy summary
+        self.report_rows = {}  # sub-folder -> sleep report averages
+        self.acti_averages = None
+
+    def poll(self):
+        group_map = crawl_files.search_folder(self.search_folder, manifest_file=self.manifest_file)
+
+        # the files found are stat'ed on every poll: the manifest reuses the listing of a directory whose mtime did
+        # not change, which misses files overwritten in place or still being written
+        signatures = {}
+        vanished = set()
+        for item, files in group_map.items():
+            try:
+                signatures[item] = tuple((path, *file_signature(path)) if path else None for path in files.values())
+            except FileNotFoundError:
+                # removed since the search, the sub-folder is looked at again by the next poll
+                vanished.add(item)
+
+        settled_before = time.time_ns() - self.settle_ns
+        changed = [item for item, signature in signatures.items() if self.processed.get(item) != signature
+                   and all(entry is None or entry[2] < settled_before for entry in signature)]
+        removed = [item for item in self.processed if item not in signatures and item not in vanished]
+
+        if not changed and not removed:
+            return False
+        print(f"{len(changed)} new or changed and {len(removed)} removed subjects")
+
+        for item in removed:
+            del self.processed[item]
+        for item in changed:
+            self.processed[item] = signatures[item]
+
+        if self.acti_output:
+            self.update_summaries([(item, group_map[item]) for item in changed], removed)
+            self.write_summaries()
+        if self.reports_output:
+            self.update_report_rows([(item, group_map[item]) for item in changed], removed)
+            self.write_report_rows()
+        return True
+
+    def set_summary(self, item, subject_summary):
+        old_summary = self.summaries.pop(item, None)
+        if old_summary is not None:
+            self.acti_averages.remove(old_summary)
+        if subject_summary is not None:
+            if self.acti_averages is None:
+                from actigraphy_batch import summary_time_names
+                self.acti_averages = RunningAverages(summary_time_names(subject_summary), pivot=5)
+            self.acti_averages.add(subject_summary)
+            self.summaries[item] = subject_summary
+
+    def update_summaries(self, changed, removed):
+        from actigraphy_batch import process_subjects, summary_cache_keys
+        from wear_times import read_wear_time_intervals
+
+        for item in removed:
+            self.set_summary(item, None)
+
+        agd_items = {files['agd_file']: item for item, files in changed if files['agd_file']}
+        for item, files in changed:
+            if not files['agd_file']:
+                self.set_summary(item, None)
+
+        wear_files = [files['wear_time'] for item, files in changed if files['agd_file'] and files['wear_time']]
+        wear_time_intervals = None
+        if wear_files:
+            wear_time_intervals = read_wear_time_intervals(wear_files, self.fname_pattern, self.n_jobs)
+
+        agd_files = list(agd_items)
+        cached_summaries = {}
+        if self.cache is not None:
+            keys = dict(zip(agd_files, summary_cache_keys(agd_files, wear_time_intervals, self.fname_pattern,
+                                                          self.n_jobs, self.summary_kwargs, lean_reader=True)))
+            cached_summaries = self.cache.get_many(keys.values())
+            for agd_file in [agd_file for agd_file in agd_files if keys[agd_file] in cached_summaries]:
+                self.set_summary(agd_items[agd_file], cached_summaries[keys[agd_file]])
+            agd_files = [agd_file for agd_file in agd_files if keys[agd_file] not in cached_summaries]
+
+        summaries = process_subjects(agd_files, wear_time_intervals, self.fname_pattern, self.n_jobs,
+                                     self.summary_kwargs, lean_reader=True)
+        for agd_file, subject_summary in zip(agd_files, summaries):
+            self.set_summary(agd_items[agd_file], subject_summary)
+
+        if self.cache is not None:
+            self.cache.put_many({keys[agd_file]: subject_summary for agd_file, subject_summary
+                                 in zip(agd_files, summaries) if subject_summary is not None})
+
+    def write_summaries(self):
+        from actigraphy_batch import summary_table
+
+        if not self.summaries:
+            return
+        write_outputs({self.acti_output: summary_table(list(self.summaries.values())),
+                       f"{self.acti_output}_averages": self.acti_averages.averages()}, self.formats)
+
+    def update_report_rows(self, changed, removed):
+        from read_reports import read_all_nights, compute_cohort_averages
+
+        for item in removed:
+            self.report_rows.pop(item, None)
+
+        for item, files in changed:
+            if not files['sleep_report']:
+                self.report_rows.pop(item, None)
+
+        reports = [(item, files['sleep_report']) for item, files in changed if files['sleep_report']]
+        results = read_all_nights([report_file for _, report_file in reports], self.report_pattern, self.n_jobs)
+        read = []
+        for (item, _), result in zip(reports, results):
+            if result is None:
+                self.report_rows.pop(item, None)
+            else:
+                read.append((item, result))
+        if not read:
+            return
+
+        average_data = compute_cohort_averages([meta_data for _, (meta_data, _) in read],
+                                               [nights for _, (_, nights) in read])
+        for position, (item, _) in enumerate(read):
+            self.report_rows[item] = average_data.iloc[[position]]
+
+    def write_report_rows(self):
+        if not self.report_rows:
+            return
+        average_data = pd.concat([self.report_rows[item] for item in sorted(self.report_rows)]).sort_index(axis=1)
+        write_outputs({self.reports_output: average_data}, self.formats)
+
+    def watch(self, interval=60, max_polls=None):
+        """
+        Polls the search folder every interval seconds until interrupted or after max_polls polls.
+        """
+        polls = 0
+        try:
+            while True:
+                self.poll()
+                polls += 1
+                if max_polls is not None and polls >= max_polls:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("Stopped watching", self.search_folder)
+
+
+if __name__ == '__main__':
+
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Watches a search folder with sub-folders for each subject and keeps the actigraphy summaries and '
+                    'sleep report averages up to date. Only new or changed subjects are processed.')
+
+    parser.add_argument('-s', '--search-folder', dest="search_folder", required=True,
+                        help='Folder containing sub-folders for each subject')
+    parser.add_argument('-o', '--acti-output', dest="acti_output",
+                        help='File for storing the actigraphy summaries, the averages are stored in <file>_averages')
+    parser.add_argument('--reports-output', dest="reports_output",
+                        help='File for storing the sleep report averages')
+    parser.add_argument('--interval', dest="interval", type=float, default=60,
+                        help='Seconds between two searches of the folder. Default is 60')
+    parser.add_argument('--settle', dest="settle", type=float, default=30,
+                        help='Files modified less than this many seconds ago are processed by a later search, as they '
+                             'may still be uploaded. Default is 30')
+    parser.add_argument('--formats', dest="formats", nargs='+', choices=FORMATS, default=DEFAULT_FORMATS,
+                        help=f'Formats of the output files, default: {" ".join(DEFAULT_FORMATS)}')
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=None,
+                        help='Number of worker processes. Default is the number of cpus')
+    parser.add_argument('--cache-file', dest="cache_file", default=None,
+                        help='Summary cache file. Default is ~/.cache/actigraphy/summaries.sqlite')
+    parser.add_argument('--no-cache', dest="no_cache", action='store_true',
+                        help='Process the subjects without reading or writing the summary cache')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if not args.acti_output and not args.reports_output:
+        parser.error('at least one of --acti-output and --reports-output is required')
+    if not os.path.isdir(args.search_folder):
+        parser.error(f'search folder {args.search_folder} does not exist')
+
+    cache = None
+    if not args.no_cache:
+        import summary_cache
+        cache = summary_cache.SummaryCache(args.cache_file or summary_cache.DEFAULT_CACHE_FILE)
+
+    watcher = FolderWatcher(args.search_folder, args.acti_output, args.reports_output, n_jobs=args.jobs, cache=cache,
+                            settle=args.settle, formats=args.formats)
+    watcher.watch(args.interval)
@@ -0,0 +1,79 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# date format of ActiLife's WearTimeValidationDetails.csv files
+WEAR_TIME_DATE_FORMAT = "%d.%m.%Y %H:%M:%S"
+
+FIELDS = {
+    "Subject": "subject",
+    "Wear Time Start": "start",
+    "Wear Time End": "stop",
+}
+
+
+def read_wear_time_file(wear_time_file, fname_pattern=None, subject=None):
+    """
+    Reads the wear time intervals of a wear time validation details file. With fname_pattern, the subject is taken
+    from the path of the file (group 1 of the pattern) instead of the Subject column, a given subject replaces it.
+    """
+    # the subjects are read as text, so that e.g. leading zeros are kept
+    data = pd.read_csv(wear_time_file, delimiter=',', quotechar='"', decimal=",", usecols=list(FIELDS),
+                       dtype={"Subject": str})
+    data = data[list(FIELDS)].rename(columns=FIELDS)
+
+    # a single vectorized parse instead of strptime per value
+    data['start'] = pd.to_datetime(data['start'], format=WEAR_TIME_DATE_FORMAT)
+    data['stop'] = pd.to_datetime(data['stop'], format=WEAR_TIME_DATE_FORMAT)
+
+    if subject is not None:
+        data['subject'] = subject
+    elif fname_pattern:
+        match = re.match(fname_pattern, wear_time_file)
+        data['subject'] = match.group(1) if match else None
+    return data
+
+
+def read_wear_times(wear_time_files, fname_pattern=None, n_jobs=None, subjects=None):
+    """
+    Reads one or many wear time files by a pool of n_jobs threads into one table with the columns subject, start and
+    stop, sorted by subject. If given, subjects holds the subject of each file (see read_wear_time_file).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    files = [wear_time_files] if type(wear_time_files) is str else list(wear_time_files)
+    subjects = subjects if subjects is not None else [None] * len(files)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        tables = list(executor.map(lambda file, subject: read_wear_time_file(file, fname_pattern, subject), files,
+                                   subjects))
+
+    all_data = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=list(FIELDS.values()))
+    all_data['subject'] = all_data['subject'].astype(str)
+    return all_data.sort_values(by=['subject'], kind='mergesort', ignore_index=True)
+
+
+def wear_time_intervals_by_subject(wear_times):
+    """
+    Splits the wear time table of all subjects in one grouped pass into sorted start and stop arrays per subject.
+    Returns a dict mapping each subject to a tuple (starts, stops) of datetime64 arrays.
+    """
+    wear_times = wear_times.dropna(subset=['start', 'stop']).sort_values(by=['subject', 'start'], kind='mergesort')
+    if wear_times.empty:
+        return {}
+    subjects = wear_times['subject'].to_numpy()
+    starts = wear_times['start'].to_numpy(dtype='datetime64[ns]')
+    stops = wear_times['stop'].to_numpy(dtype='datetime64[ns]')
+
+    # rows where a new subject begins
+    bounds = np.concatenate([[0], np.flatnonzero(subjects[1:] != subjects[:-1]) + 1, [len(subjects)]])
+    return {subjects[begin]: (starts[begin:end], stops[begin:end]) for begin, end in zip(bounds[:-1], bounds[1:])}
+
+
+def read_wear_time_intervals(wear_time_files, fname_pattern=None, n_jobs=None):
+    """
+    Reads the wear time files and returns the sorted wear time intervals of each subject, ready for masking (see
+    wear_time_intervals_by_subject).
+    """
+    return wear_time_intervals_by_subject(read_wear_times(wear_time_files, fname_pattern, n_jobs))
@@ -0,0 +1,233 @@
+import numpy as np
+import pandas as pd
+
+from activity_metrics import DAY, circular_window_means
+
+HOUR = pd.Timedelta('1H')
+
+METRICS = ['IS', 'IV', 'RA', 'L5', 'M10']
+
+
+def _prefix(rows):
+    # prefix sums over the days (first axis) of the per-day rows, starting with a row of zeros
+    return np.concatenate([np.zeros((1,) + rows.shape[1:], dtype=rows.dtype), np.cumsum(rows, axis=0)])
+
+
+def _extend(prefix, rows):
+    # appends the prefix sums of new days, continuing from the sums of the days before
+    return np.concatenate([prefix, prefix[-1] + np.cumsum(rows, axis=0)])
+
+
+def _var(sums, sums_of_squares, counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 1, (sums_of_squares - sums ** 2 / counts) / (counts - 1), np.nan)
+
+
+def _extreme_windows(profiles, n_epochs, lowest):
+    """
+    Mean activity of the window of lowest/highest activity in each row of daily profiles, like ActivityMetrics.lmx.
+    Only windows with data at every epoch are candidates, a masked epoch must not count as an epoch without activity.
+    A row without such a window is NaN.
+    """
+    n_slots = profiles.shape[1]
+    circular = np.concatenate([profiles, profiles[:, :n_epochs]], axis=1)
+    profile_cumsum = np.concatenate([np.zeros((len(profiles), 1), dtype=np.longdouble),
+                                     np.cumsum(np.nan_to_num(circular), axis=1, dtype=np.longdouble)], axis=1)
+    valid_cumsum = np.concatenate([np.zeros((len(profiles), 1), dtype=np.int64),
+                                   np.cumsum(~np.isnan(circular), axis=1)], axis=1)
+    means = circular_window_means(profile_cumsum.T, valid_cumsum.T, n_epochs).T[:, :n_slots]
+    covered = (valid_cumsum[:, n_epochs:] - valid_cumsum[:, :-n_epochs])[:, :n_slots] == n_epochs
+    means = np.where(covered, means, np.nan)
+
+    # ties are broken by the earliest onset, also when the sums only differ by rounding errors
+    rounded = np.round(means, 12)
+    no_data = np.isnan(rounded).all(axis=1)
+    rounded = np.where(np.isnan(rounded), np.inf if lowest else -np.inf, rounded)
+    onsets = np.argmin(rounded, axis=1) if lowest else np.argmax(rounded, axis=1)
+    return np.where(no_data, np.nan, means[np.arange(len(means)), onsets])
+
+
+class WindowedMetrics:
+    """
+    IS, IV, RA, L5 and M10 of every day and of sliding windows of several days. The recording is split into days of
+    24 hours from its first epoch, and each day is reduced once to its sums: the hourly values per hour of the day,
+    their sum, sum of squares and squared successive differences, and the binarized activity per epoch of the day.
+    Prefix sums over the days give the sums of any window of days with two lookups, so sliding a window by one day
+    costs the same whatever its length. Appended data only adds days (and completes the last, partial day), the sums
+    of the days before are kept. The sums are only kept in memory, by the object.
+
+    IS compares the hours of the day over the days of a window, with a single day every hour of the day has one value
+    and IS would be 1 by construction, so it is NaN for windows of one day. L5 and M10 only consider windows with data
+    at every epoch of the window's daily profile. A window over the whole recording gives the values of
+    ActivityMetrics if every epoch of the day has data on at least one day.
+    """
+
+    def __init__(self, reader=None, threshold=4):
+        self.threshold = threshold
+        # whether an hour with any masked epoch is missing, set from the first reader (see ActivityMetrics._resample)
+        self.exclude_if_mask = True
+        self.epoch = None
+        self.start = None
+        self.n_days = 0
+        # number of epochs added so far, the epochs of the partial last day and the last hourly value of the day before
+        self._end = 0
+        self._tail = None
+        self._last_hour = np.nan
+        if reader is not None:
+            self.append(reader)
+
+    def append(self, reader):
+        """
+        Adds the data of a reader that continues the data added before, e.g. the next days of a recording. Epochs
+        before the end of the data added before are ignored, a gap is treated as missing data.
+        """
+        data = reader.data
+        values = data.to_numpy(dtype=float)
+        binarized = np.where(values > self.threshold, 1., 0.)
+        binarized[np.isnan(values)] = np.nan
+
+        # whether an epoch counts for the hourly values, see ActivityMetrics._resample
+        unmasked = np.ones(len(values), dtype=bool)
+        if reader.mask_inactivity and reader.mask is not None:
+            unmasked = reader.mask.reindex(data.index).to_numpy() > 0
+
+        if self.epoch is None:
+            self.exclude_if_mask = getattr(reader, 'exclude_if_mask', True)
+            self.epoch = pd.Timedelta(reader.frequency)
+            if DAY % self.epoch or HOUR % self.epoch:
+                raise ValueError(f"The epoch length {self.epoch} does not divide an hour.")
+            self.start = data.index[0]
+            self.epochs_per_day = DAY // self.epoch
+            self._first_slot = (self.start - self.start.normalize()) // self.epoch
+        elif pd.Timedelta(reader.frequency) != self.epoch:
+            raise ValueError(f"The epoch length {reader.frequency} differs from {self.epoch}.")
+
+        positions = (data.index.asi8 - self.start.value) // self.epoch.value
+        new = positions >= self._end
+        positions, binarized, unmasked = positions[new], binarized[new], unmasked[new]
+        if not len(positions):
+            return self
+
+        # the partial last day is computed again with the new epochs
+        first_day = self.n_days - 1 if self._tail is not None else self.n_days
+        offset = first_day * self.epochs_per_day
+        n_epochs = positions[-1] + 1 - offset
+        day_binarized = np.full(n_epochs, np.nan)
+        day_real = np.zeros(n_epochs, dtype=bool)
+        day_unmasked = np.zeros(n_epochs, dtype=bool)
+        if self._tail is not None:
+            tail_binarized, tail_real, tail_unmasked = self._tail
+            day_binarized[:len(tail_binarized)] = tail_binarized
+            day_real[:len(tail_real)] = tail_real
+            day_unmasked[:len(tail_unmasked)] = tail_unmasked
+        day_binarized[positions - offset] = binarized
+        day_real[positions - offset] = True
+        day_unmasked[positions - offset] = unmasked
+
+        self._add_days(first_day, day_binarized, day_real, day_unmasked)
+        self._end = positions[-1] + 1
+        return self
+
+    def _add_days(self, first_day, binarized, real, unmasked):
+        n_days = -(-len(binarized) // self.epochs_per_day)
+        n_epochs = n_days * self.epochs_per_day
+        partial = len(binarized) < n_epochs
+        self._tail = (binarized[(n_days - 1) * self.epochs_per_day:], real[(n_days - 1) * self.epochs_per_day:],
+                      unmasked[(n_days - 1) * self.epochs_per_day:]) if partial else None
+
+        # one row per day, the epochs after the end of the data are neither real nor valid
+        binarized = np.pad(binarized, (0, n_epochs - len(binarized)), constant_values=np.nan).reshape(n_days, -1)
+        real = np.pad(real, (0, n_epochs - len(real))).reshape(n_days, -1)
+        unmasked = np.pad(unmasked, (0, n_epochs - len(unmasked))).reshape(n_days, -1) & real
+
+        # hourly sums from the first epoch, an hour is missing if it is (partially) masked or has no data at all
+        epochs_per_hour = HOUR // self.epoch
+        hour_shape = (n_days, 24, epochs_per_hour)
+        n_real = real.reshape(hour_shape).sum(axis=2)
+        n_unmasked = unmasked.reshape(hour_shape).sum(axis=2)
+        valid_hours = (n_real > 0) & ((n_unmasked == n_real) if self.exclude_if_mask else (n_unmasked > 0))
+        hourly = np.where(valid_hours, np.nansum(binarized.reshape(hour_shape), axis=2), np.nan)
+
+        # the difference between the last hour of the day before and the first hour of each day
+        previous_hours = np.concatenate([[self._last_hour], hourly[:-1, -1]])
+        entry_diffs = hourly[:, 0] - previous_hours
+        diffs = np.diff(hourly, axis=1)
+
+        # the binarized activity per epoch of the day (from midnight), for the daily profiles of L5 and M10
+        profile_sums = np.roll(np.nan_to_num(binarized), self._first_slot, axis=1)
+        profile_counts = np.roll(~np.isnan(binarized), self._first_slot, axis=1).astype(np.int64)
+
+        rows = {
+            'slot_sums': np.nan_to_num(hourly),
+            'slot_counts': valid_hours.astype(np.int64),
+            'sums': np.nansum(hourly, axis=1),
+            'squares': np.nansum(hourly ** 2, axis=1),
+            'counts': valid_hours.sum(axis=1),
+            'diff_squares': np.nansum(diffs ** 2, axis=1),
+            'diff_counts': (~np.isnan(diffs)).sum(axis=1),
+            'entry_squares': np.nan_to_num(entry_diffs ** 2),
+            'entry_counts': (~np.isnan(entry_diffs)).astype(np.int64),
+            'profile_sums': profile_sums,
+            'profile_counts': profile_counts,
+        }
+        if first_day == 0:
+            self._prefix = {name: _prefix(day_rows) for name, day_rows in rows.items()}
+        else:
+            # the prefix sums up to the first (re)computed day are kept
+            self._prefix = {name: _extend(self._prefix[name][:first_day + 1], day_rows)
+                            for name, day_rows in rows.items()}
+        self._last_hour = hourly[-1, -1] if not partial else hourly[-2, -1] if n_days > 1 else self._last_hour
+        self.n_days = first_day + n_days
+
+    def windows(self, n_days=1, step=1):
+        """
+        Metrics of the windows of n_days days, starting every step days, the last day may be partial. Returns a table
+        with the first day, the start time and the metrics (see METRICS) of each window.
+        """
+        if self.n_days < n_days:
+            return pd.DataFrame(columns=['first_day', 'start'] + METRICS)
+        first_days = np.arange(0, self.n_days - n_days + 1, step)
+        return self.window_table(first_days, first_days + n_days)
+
+    def window_table(self, first_days, end_days):
+        """
+        Metrics of the windows from the first days to the end days (exclusive), all computed at once from the prefix
+        sums.
+        """
+        first_days, end_days = np.asarray(first_days), np.asarray(end_days)
+
+        def window_sums(name):
+            return self._prefix[name][end_days] - self._prefix[name][first_days]
+
+        counts = window_sums('counts')
+        values_var = _var(window_sums('sums'), window_sums('squares'), counts)
+
+        # the variance of the mean of each hour of the day, over the hours with data
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hour_means = window_sums('slot_sums') / window_sums('slot_counts')
+        n_hours = (~np.isnan(hour_means)).sum(axis=1)
+        hour_means_var = _var(np.nansum(hour_means, axis=1), np.nansum(hour_means ** 2, axis=1), n_hours)
+
+        # the successive differences within the window, without the one into its first day
+        diff_squares = window_sums('diff_squares') + self._prefix['entry_squares'][end_days] - \
+            self._prefix['entry_squares'][first_days + 1]
+        diff_counts = window_sums('diff_counts') + self._prefix['entry_counts'][end_days] - \
+            self._prefix['entry_counts'][first_days + 1]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            profiles = window_sums('profile_sums') / window_sums('profile_counts')
+            # a single day has one value per hour of the day, its IS would always be 1
+            IS = np.where(end_days - first_days > 1, hour_means_var / values_var, np.nan)
+            IV = np.where(diff_counts > 0, diff_squares / diff_counts, np.nan) / values_var
+        L5 = _extreme_windows(profiles, int(pd.Timedelta('5H') / self.epoch), lowest=True)
+        M10 = _extreme_windows(profiles, int(pd.Timedelta('10H') / self.epoch), lowest=False)
+
+        return pd.DataFrame({
+            'first_day': first_days,
+            'start': self.start + first_days * DAY,
+            'IS': IS,
+            'IV': IV,
+            'RA': (M10 - L5) / (M10 + L5),
+            'L5': L5,
+            'M10': M10,
+        })